@@ -1,40 +1,232 @@
 
-from fastapi import FastAPI
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from app.api.schemas import QueryRequest, AnswerResponse, Passage
+from app.llm.generate import agenerate_answer, generate_answer_stream, start_preload
+from app.llm.ollama_client import get_client
+from app.llm.router import get_router, telemetry_labels
+from app.llm.scheduler import SchedulerBusy, get_scheduler
+from monitoring.logger import flush_telemetry, log_interaction
+from monitoring import metrics
+from retrieval.deadline import Deadline
 from retrieval.hybrid import HybridRetriever
-from retrieval.prompt_builder import build_prompt
+from retrieval.rerank import CrossEncoderReranker
+from retrieval.rewrite import rewrite_query
 
-app = FastAPI(title="RAG-PRL API")
+# Retrieval (BM25 scoring, query encoding, Chroma) is blocking CPU/IO work: it runs in this
+# bounded pool so the event loop keeps serving other requests while it waits on the LLM.
+RETRIEVAL_WORKERS = int(os.getenv("API_RETRIEVAL_WORKERS", "4"))
+_retrieval_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+# Deadlines (QueryRequest.deadline_ms): time kept for the LLM is the router's measured p50,
+# or DEADLINE_LLM_MIN_MS before it has samples; rerank needs DEADLINE_RERANK_MIN_MS on top.
+DEADLINE_LLM_MIN_MS = float(os.getenv("DEADLINE_LLM_MIN_MS", "1000"))
+DEADLINE_RERANK_MIN_MS = float(os.getenv("DEADLINE_RERANK_MIN_MS", "50"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_preload()  # warm model weights + prompt prefix (OLLAMA_PRELOAD=0 to skip)
+    yield
+    _retrieval_pool.shutdown(wait=False)
+    await get_client().aclose()
+    await asyncio.to_thread(flush_telemetry)
+
+app = FastAPI(title="RAG-PRL API", lifespan=lifespan)
 
 retriever = HybridRetriever()  # lazy init inside
+reranker = CrossEncoderReranker()
+
+def _llm_reserve_ms() -> float:
+    p50 = get_router().expected_ms()
+    return p50 if p50 is not None else DEADLINE_LLM_MIN_MS
+
+def _retrieve(req: QueryRequest, deadline: Optional[Deadline] = None) -> Tuple[List[Dict], float]:
+    """
+    Retrieval honoring the request switches: rewrite (query expansion), use_hybrid
+    (BM25 + dense with RRF, else BM25 only) and use_rerank (rerank a wider candidate
+    set down to top_k). With a deadline, dense search and rerank are dropped when they
+    would eat into the time kept for the LLM. Returns (passages, retrieval_ms).
+    """
+    t0 = time.time()
+    deadline = deadline or Deadline(req.deadline_ms)
+    reserve = _llm_reserve_ms() if deadline.enabled else 0.0
+    q = rewrite_query(req.query) if req.rewrite else req.query
+    n = max(req.top_k * 4, 20) if req.use_rerank else req.top_k
+    if req.use_hybrid:
+        hits = retriever.search(q, k=n, deadline=deadline, reserve_ms=reserve)
+    else:
+        hits = retriever.bm25.search(q, k=n)
+    if req.use_rerank and reranker.enabled:
+        if deadline.remaining_ms() - reserve < DEADLINE_RERANK_MIN_MS:
+            deadline.degrade("rerank_skipped")
+        else:
+            hits = reranker.rerank(q, hits)
+    return hits[:req.top_k], (time.time() - t0) * 1000
+
+def _record(endpoint: str, status: int, deadline: Deadline, total_ms: float,
+            retrieval_ms: Optional[float] = None, llm_ms: Optional[float] = None) -> None:
+    """Request-level metrics for /metrics (stage-level ones are recorded where they run)."""
+    metrics.REQUESTS.inc(endpoint=endpoint, status=str(status))
+    metrics.observe_ms("retrieval", retrieval_ms)
+    metrics.observe_ms("llm", llm_ms)
+    metrics.observe_ms("total", total_ms)
+    for kind in deadline.degradations:
+        metrics.DEGRADATIONS.inc(kind=kind)
+
+@app.exception_handler(SchedulerBusy)
+async def scheduler_busy(request, exc: SchedulerBusy):
+    metrics.REQUESTS.inc(endpoint=request.url.path, status="429")
+    # fast backpressure instead of queueing into a timeout
+    return JSONResponse(status_code=429, content={"detail": str(exc)},
+                        headers={"Retry-After": str(max(1, round(exc.retry_after_s)))})
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    return {"status": "ok", "llm_scheduler": get_scheduler().snapshot()}
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint (monitoring/metrics.py)."""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.post("/query", response_model=AnswerResponse)
-def query_api(req: QueryRequest):
-    passages = retriever.search(
-        req.query,
-        top_k=req.top_k,
-        use_hybrid=req.use_hybrid,
-        use_rerank=req.use_rerank,
-        rewrite=req.rewrite
-    )
+async def query_api(req: QueryRequest):
+    """
+    Non-blocking RAG: retrieval in the retrieval pool, generation through the async LLM client.
+    With deadline_ms the pipeline degrades instead of running late (see retrieval/deadline.py);
+    `degradations` lists what was dropped and `answer` is None if the LLM did not fit.
+    """
+    t0 = time.time()
+    deadline = Deadline(req.deadline_ms)
+    loop = asyncio.get_running_loop()
+    try:
+        passages, retrieval_ms = await loop.run_in_executor(_retrieval_pool, _retrieve, req, deadline)
+    except Exception:
+        metrics.ERRORS.inc(stage="retrieval")
+        raise
 
-    prompt = build_prompt(req.query, passages)
+    info: dict = {}
+    answer: Optional[str] = None
+    t1 = time.time()
+    if deadline.enabled and deadline.remaining_ms() < _llm_reserve_ms():
+        deadline.degrade("llm_skipped")
+    else:
+        try:
+            answer = await asyncio.wait_for(agenerate_answer(req.query, passages, info=info), deadline.remaining_s())
+        except asyncio.TimeoutError:
+            deadline.degrade("llm_timeout")  # a coalesced generation still finishes into the cache
+        except SchedulerBusy:
+            raise
+        except Exception as e:
+            metrics.ERRORS.inc(stage="llm")
+            _record("/query", 503, deadline, (time.time() - t0) * 1000, retrieval_ms)
+            raise HTTPException(status_code=503, detail=f"LLM unavailable: {e}")
+    llm_ms = (time.time() - t1) * 1000
+    _record("/query", 200, deadline, (time.time() - t0) * 1000, retrieval_ms,
+            llm_ms if "llm_skipped" not in deadline.degradations else None)
 
-    # Placeholder de respuesta (completa con tu proveedor LLM)
-    answer = (
-        "🔧 LLM no configurado. Este es un placeholder.\n\n"
-        "Contexto recuperado:\n- "
-        + "\n- ".join([p["text"][:160].replace("\n", " ") + "..." for p in passages])
-        + "\n\nConfigura tu proveedor LLM en .env y completa la llamada."
+    provider, model = telemetry_labels(info)
+    log_interaction(  # only enqueues: the telemetry writer batches the INSERTs off the request path
+        query=req.query,
+        retriever="hybrid" if req.use_hybrid else "bm25",
+        topk=req.top_k,
+        fanout=20,
+        latency_ms=int((time.time() - t0) * 1000),
+        provider=provider,
+        model=model,
+        answer=answer,
+        sources=[p["source"] for p in passages],
+        hits=passages,
+        ctx_len=len(passages),
+        latency_ms_retrieval=retrieval_ms,
+        latency_ms_llm=llm_ms,
+        tokens_per_s=info.get("tokens_per_s"),
+        prompt_tokens=info.get("prompt_tokens"),
+        completion_tokens=info.get("completion_tokens"),
+        prefill_ms=info.get("prefill_ms"),
+        decode_ms=info.get("decode_ms"),
+        queue_wait_ms=info.get("queue_wait_ms"),
     )
 
     return AnswerResponse(
         answer=answer,
         passages=[Passage(**p) for p in passages],
-        prompt_tokens=None,
-        completion_tokens=None,
+        prompt_tokens=info.get("prompt_tokens"),
+        completion_tokens=info.get("completion_tokens"),
+        prefill_ms=info.get("prefill_ms"),
+        decode_ms=info.get("decode_ms"),
+        tokens_per_s=info.get("tokens_per_s"),
+        queue_wait_ms=info.get("queue_wait_ms"),
+        retrieval_ms=retrieval_ms,
+        llm_ms=llm_ms,
+        degradations=deadline.degradations,
     )
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/query/stream")
+def query_stream(req: QueryRequest):
+    """
+    Server-Sent Events: one `passages` event, then a `token` event per generated piece,
+    then `done` with timing stats (ttft_ms, tokens_per_s, ...) or `error`. With deadline_ms
+    the stream stops at the deadline and `done` lists the degradations.
+    """
+    get_scheduler().check("interactive")  # reject with 429 before the stream starts
+    t0 = time.time()
+    deadline = Deadline(req.deadline_ms)
+    passages, retrieval_ms = _retrieve(req, deadline)
+
+    def events():
+        yield _sse("passages", {"passages": [Passage(**p).model_dump() for p in passages]})
+        stats: dict = {}
+        pieces = []
+        stream = generate_answer_stream(req.query, passages, stats=stats)
+        try:
+            for piece in stream:
+                pieces.append(piece)
+                yield _sse("token", {"token": piece})
+                if deadline.expired():
+                    deadline.degrade("answer_truncated")
+                    break
+        except Exception as e:
+            metrics.ERRORS.inc(stage="llm")
+            yield _sse("error", {"detail": str(e)})
+        finally:
+            stream.close()
+        _record("/query/stream", 200, deadline, (time.time() - t0) * 1000, retrieval_ms, stats.get("total_ms"))
+        yield _sse("done", {"retrieval_ms": retrieval_ms, **stats, "degradations": deadline.degradations})
+        provider, model = telemetry_labels(stats)
+        log_interaction(
+            query=req.query,
+            retriever="hybrid" if req.use_hybrid else "bm25",
+            topk=req.top_k,
+            fanout=20,
+            latency_ms=int((time.time() - t0) * 1000),
+            provider=provider,
+            model=model,
+            answer="".join(pieces) or None,
+            sources=[p["source"] for p in passages],
+            hits=passages,
+            ctx_len=len(passages),
+            latency_ms_retrieval=retrieval_ms,
+            latency_ms_llm=stats.get("total_ms"),
+            ttft_ms=stats.get("ttft_ms"),
+            tokens_per_s=stats.get("tokens_per_s"),
+            prompt_tokens=stats.get("prompt_tokens"),
+            completion_tokens=stats.get("completion_tokens"),
+            prefill_ms=stats.get("prefill_ms"),
+            decode_ms=stats.get("decode_ms"),
+            queue_wait_ms=stats.get("queue_wait_ms"),
+        )
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -8,6 +8,7 @@ class QueryRequest(BaseModel):
     use_hybrid: bool = True
     use_rerank: bool = True
     rewrite: bool = True
+    deadline_ms: Optional[int] = None   # latency budget; stages degrade instead of running late
 
 class Passage(BaseModel):
     text: str
@@ -16,7 +17,14 @@ class Passage(BaseModel):
     meta: Dict[str, Any] = {}
 
 class AnswerResponse(BaseModel):
-    answer: str
+    answer: Optional[str]               # None when the deadline left no time for the LLM
     passages: List[Passage]
     prompt_tokens: Optional[int] = None
     completion_tokens: Optional[int] = None
+    prefill_ms: Optional[float] = None
+    decode_ms: Optional[float] = None
+    tokens_per_s: Optional[float] = None
+    queue_wait_ms: Optional[float] = None
+    retrieval_ms: Optional[float] = None
+    llm_ms: Optional[float] = None
+    degradations: List[str] = []
@@ -0,0 +1,126 @@
+# app/llm/answer_cache.py
+"""
+Persistent exact-match answer cache (SQLite).
+
+The key is a sha256 over the normalized query, the ordered context `source` ids, the model,
+PROMPT_STYLE and the generation options, so any change in retrieval or generation settings
+is a miss. Entries expire after a TTL; when the table grows past `max_entries` the least
+recently used entries are evicted.
+
+Env vars:
+  - ANSWER_CACHE          "0" disables the cache (default "1")
+  - ANSWER_CACHE_PATH     (default data/cache/answers.db)
+  - ANSWER_CACHE_TTL_S    seconds (default 604800 = 7 days)
+  - ANSWER_CACHE_MAX      max entries (default 20000)
+"""
+from __future__ import annotations
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", (query or "").strip().lower())
+
+def make_key(query: str, sources: List[str], model: str, prompt_style: str, options: Dict) -> str:
+    payload = {
+        "q": normalize_query(query),
+        "sources": list(sources),
+        "model": model,
+        "style": (prompt_style or "strict").lower(),
+        "options": options,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def cache_enabled() -> bool:
+    return os.getenv("ANSWER_CACHE", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl_s: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ) -> None:
+        self.path = pathlib.Path(path or os.getenv("ANSWER_CACHE_PATH", "data/cache/answers.db"))
+        self.ttl_s = ttl_s if ttl_s is not None else float(os.getenv("ANSWER_CACHE_TTL_S", str(7 * 24 * 3600)))
+        self.max_entries = max_entries or int(os.getenv("ANSWER_CACHE_MAX", "20000"))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+              key TEXT PRIMARY KEY,
+              answer TEXT NOT NULL,
+              model TEXT,
+              created REAL NOT NULL,
+              last_used REAL NOT NULL,
+              hits INTEGER DEFAULT 0
+            )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers(last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(str(self.path), timeout=10)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT answer, created FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_s:
+                if row is not None:
+                    conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            conn.execute("UPDATE answers SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, answer: str, model: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, model, created, last_used, hits) VALUES (?, ?, ?, ?, ?, 0)",
+                (key, answer, model, now, now),
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl_s,))
+        n = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        if n > self.max_entries:
+            # drop down to 90% so eviction does not run on every insert
+            conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_used ASC LIMIT ?)",
+                (n - int(self.max_entries * 0.9),),
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM answers")
+
+    def stats(self) -> Dict:
+        with self._connect() as conn:
+            n = conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        total = self.hits + self.misses
+        return {"entries": n, "hits": self.hits, "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0}
+
+
+_cache: Optional[AnswerCache] = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> AnswerCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AnswerCache()
+        return _cache
@@ -0,0 +1,174 @@
+# app/llm/context_packer.py
+"""
+Token-budgeted context packing for the generation prompt.
+
+1. Passages that are consecutive chunks of the same file (`file#chunkN`, `file#chunkN+1`, ...)
+   are merged into one contiguous span and the overlap the chunker repeats between them is removed.
+2. Spans are selected greedily by fused score (highest first) until the token budget derived
+   from the model context window (OLLAMA_NUM_CTX minus a reserve for instructions, question
+   and answer) is full; the last span that does not fit is cut to the remaining budget.
+
+Each packed span keeps `refs`, the 1-based positions of its passages in the caller's list, so
+the [n] citations in the answer still match the sources shown to the user.
+
+Env vars:
+  - OLLAMA_NUM_CTX          model context window in tokens (default 2048, Ollama's default)
+  - CONTEXT_RESERVE_TOKENS  tokens kept free for instructions, question and answer (default 640)
+"""
+from __future__ import annotations
+import math
+import os
+import re
+from typing import Dict, List, Optional
+
+_CHUNK_RE = re.compile(r"^(?P<file>.+)#chunk(?P<n>\d+)$")
+
+def estimate_tokens(text: str) -> int:
+    """Cheap tokenizer-free estimate (~4 chars or ~0.75 words per token for English)."""
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / 4), math.ceil(len(text.split()) * 4 / 3))
+
+_tiktoken_enc = None
+_tiktoken_missing = False
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken (cl100k_base) when installed, else estimate_tokens()."""
+    global _tiktoken_enc, _tiktoken_missing
+    if not text:
+        return 0
+    if _tiktoken_enc is None and not _tiktoken_missing:
+        try:
+            import tiktoken
+            _tiktoken_enc = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _tiktoken_missing = True
+    if _tiktoken_enc is not None:
+        return len(_tiktoken_enc.encode(text))
+    return estimate_tokens(text)
+
+def context_budget(num_ctx: Optional[int] = None, reserve: Optional[int] = None) -> int:
+    if num_ctx is None:
+        try:
+            num_ctx = int(os.getenv("OLLAMA_NUM_CTX") or 2048)
+        except ValueError:
+            num_ctx = 2048
+    if reserve is None:
+        reserve = int(os.getenv("CONTEXT_RESERVE_TOKENS", "640"))
+    return max(256, num_ctx - reserve)
+
+def _overlap(a: List[str], b: List[str], max_words: int = 400) -> int:
+    """Length of the longest suffix of `a` that is also a prefix of `b`."""
+    for k in range(min(len(a), len(b), max_words), 0, -1):
+        if a[-k:] == b[:k]:
+            return k
+    return 0
+
+def merge_adjacent(contexts: List[Dict]) -> List[Dict]:
+    """
+    Merge consecutive chunks of the same file into spans. Returns spans in the order of their
+    first passage, each with: text, source (e.g. 'osha.pdf#chunk3-5'), sources, refs, score.
+    """
+    items = []
+    for i, c in enumerate(contexts):
+        m = _CHUNK_RE.match(c.get("source") or "")
+        score = c.get("score")
+        items.append({
+            "text": c.get("text") or "",
+            "source": c.get("source") or "",
+            "file": m.group("file") if m else None,
+            "n": int(m.group("n")) if m else None,
+            "ref": i + 1,
+            # without a fused score fall back to the rank (RRF-shaped, so it mixes with real ones)
+            "score": float(score) if score is not None else 1.0 / (60.0 + i + 1),
+        })
+
+    by_file: Dict[str, List[Dict]] = {}
+    spans: List[Dict] = []
+    for it in items:
+        if it["file"] is None:
+            spans.append({"text": it["text"], "source": it["source"], "sources": [it["source"]],
+                          "refs": [it["ref"]], "score": it["score"]})
+        else:
+            by_file.setdefault(it["file"], []).append(it)
+
+    for file, group in by_file.items():
+        group.sort(key=lambda x: x["n"])
+        cur = None
+        for it in group:
+            if cur is not None and it["n"] == cur["last_n"] + 1:
+                words = it["text"].split()
+                k = _overlap(cur["words"], words)
+                cur["words"] += words[k:]
+                cur["last_n"] = it["n"]
+                cur["sources"].append(it["source"])
+                cur["refs"].append(it["ref"])
+                cur["score"] = max(cur["score"], it["score"])
+                continue
+            if cur is not None:
+                spans.append(_close_span(file, cur))
+            cur = {"words": it["text"].split(), "first_n": it["n"], "last_n": it["n"],
+                   "sources": [it["source"]], "refs": [it["ref"]], "score": it["score"]}
+        if cur is not None:
+            spans.append(_close_span(file, cur))
+
+    spans.sort(key=lambda s: min(s["refs"]))
+    return spans
+
+def _close_span(file: str, cur: Dict) -> Dict:
+    a, b = cur["first_n"], cur["last_n"]
+    return {
+        "text": " ".join(cur["words"]),
+        "source": f"{file}#chunk{a}" if a == b else f"{file}#chunk{a}-{b}",
+        "sources": cur["sources"],
+        "refs": sorted(cur["refs"]),
+        "score": cur["score"],
+    }
+
+def _truncate_to_tokens(text: str, budget: int) -> str:
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:  # largest prefix that fits
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(" ".join(words[:mid])) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo])
+
+def pack_contexts(
+    contexts: List[Dict],
+    budget_tokens: Optional[int] = None,
+    merge: bool = True,
+    min_partial_tokens: int = 64,
+) -> List[Dict]:
+    """
+    Merge adjacent chunks and fill `budget_tokens` (default: context_budget()) by score.
+    Returned spans are in the original passage order; each has a `tokens` estimate.
+    """
+    budget = context_budget() if budget_tokens is None else budget_tokens
+    if merge:
+        spans = merge_adjacent(contexts)
+    else:
+        spans = [{"text": c.get("text") or "", "source": c.get("source") or "", "sources": [c.get("source") or ""],
+                  "refs": [i + 1], "score": c["score"] if c.get("score") is not None else 1.0 / (60.0 + i + 1)}
+                 for i, c in enumerate(contexts)]
+
+    chosen: List[Dict] = []
+    left = budget
+    for span in sorted(spans, key=lambda s: -s["score"]):
+        cost = estimate_tokens(span["text"])
+        if cost <= left:
+            chosen.append({**span, "tokens": cost})
+            left -= cost
+        elif left >= min_partial_tokens:
+            text = _truncate_to_tokens(span["text"], left)
+            if text:
+                cost = estimate_tokens(text)
+                chosen.append({**span, "text": text, "tokens": cost, "truncated": True})
+                left -= cost
+    chosen.sort(key=lambda s: min(s["refs"]))
+    return chosen
+
+def format_refs(refs: List[int]) -> str:
+    return "".join(f"[{r}]" for r in refs)
@@ -1,51 +1,67 @@
 # app/llm/generate.py
 from __future__ import annotations
+import asyncio
 import os
-import json
+import threading
 import time
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional
 
-import requests  # required for Ollama
+from app.llm.answer_cache import cache_enabled, get_cache, make_key
+from app.llm.context_packer import context_budget, count_tokens, format_refs, pack_contexts
+from app.llm.ollama_client import get_client
+from app.llm.scheduler import get_scheduler
+from monitoring.metrics import ANSWER_CACHE, observe_ms, timed
+from retrieval.singleflight import SingleFlight, StreamFlight, singleflight_enabled
 
-def _build_prompt_strict(query: str, contexts: list[dict]) -> str:
-    lines = []
-    lines.append("You are a careful assistant. Answer IN ENGLISH using ONLY the given passages.")
-    lines.append('If the answer is not fully supported, say: "Not found in the indexed sources."')
-    lines.append("Cite sources with [n] mapping to the passages list.")
-    lines.append("")
-    lines.append(f"User question: {query}")
-    lines.append("")
-    lines.append("Context passages:")
-    for i, c in enumerate(contexts, start=1):
-        lines.append(f"[{i}] {(c.get('text') or '')[:2000]}")
-    lines.append("")
-    lines.append("Now write a concise, accurate answer in English with citations [n].")
-    return "\n".join(lines)
+def _passage_lines(contexts: list[dict]) -> list[str]:
+    """Adjacent chunks merged and packed into the context-window budget (app/llm/context_packer.py);
+    merged spans keep the [n] of every passage they contain."""
+    return [f"{format_refs(span['refs'])} {span['text']}" for span in pack_contexts(contexts)]
 
-def _build_prompt_structured(query: str, contexts: list[dict]) -> str:
-    lines = []
-    lines.append("You are an OSHA legal assistant. Answer IN ENGLISH using ONLY the given passages.")
-    lines.append("Structure the answer as: Summary (2-3 lines), Key Points (bullets), Sources.")
-    lines.append("Cite each claim with [n], refer to the passages below. If missing, say it.")
+# Prompt layout: a constant prefix (identical for every request and style) first, the
+# variable content last. LLM servers reuse the KV cache of a matching prompt prefix, so
+# only the passages, question and style instruction are prefilled on each request.
+SYSTEM_PREFIX = "\n".join([
+    "You are a careful occupational safety (OSHA) assistant. Answer IN ENGLISH using ONLY the context passages below.",
+    'If the answer is not fully supported by the passages, say: "Not found in the indexed sources."',
+    "Cite sources with [n] mapping to the passages list.",
+    "",
+    "Context passages:",
+])
+
+STYLE_INSTRUCTIONS = {
+    "strict": "Now write a concise, accurate answer in English with citations [n].",
+    "structured": (
+        "Structure the answer as: Summary (2-3 lines), Key Points (bullets), Sources. "
+        "Cite each claim with [n]; if something is missing, say it."
+    ),
+}
+
+def _build_prompt_layout(query: str, contexts: list[dict], style: str) -> str:
+    lines = [SYSTEM_PREFIX]
+    lines.extend(_passage_lines(contexts))
     lines.append("")
     lines.append(f"Question: {query}")
     lines.append("")
-    lines.append("Passages:")
-    for i, c in enumerate(contexts, start=1):
-        lines.append(f"[{i}] {(c.get('text') or '')[:2000]}")
-    lines.append("")
-    lines.append("Write the answer now, structured, concise, with citations [n].")
+    lines.append(STYLE_INSTRUCTIONS.get(style, STYLE_INSTRUCTIONS["strict"]))
     return "\n".join(lines)
 
+def _build_prompt_strict(query: str, contexts: list[dict]) -> str:
+    return _build_prompt_layout(query, contexts, "strict")
+
+def _build_prompt_structured(query: str, contexts: list[dict]) -> str:
+    return _build_prompt_layout(query, contexts, "structured")
+
 
 # =========================
 # Prompt helpers
 # =========================
 def _build_prompt(query: str, contexts: list[dict]) -> str:
     style = (os.getenv("PROMPT_STYLE") or "strict").lower()
-    if style == "structured":
-        return _build_prompt_structured(query, contexts)
-    return _build_prompt_strict(query, contexts)
+    with timed("prompt_build"):
+        if style == "structured":
+            return _build_prompt_structured(query, contexts)
+        return _build_prompt_strict(query, contexts)
 
 
 # =========================
@@ -54,45 +70,190 @@ def _build_prompt(query: str, contexts: list[dict]) -> str:
 def _ollama_url() -> str:
     return os.getenv("OLLAMA_HOST", "http://localhost:11434").rstrip("/")
 
-def _is_ollama_up(timeout: float = 2.5) -> bool:
+def _is_ollama_up(max_age_s: float = 30.0) -> bool:
+    """Cached health (circuit breaker state + an /api/tags probe at most every max_age_s)."""
+    return get_client(_ollama_url()).health(max_age_s=max_age_s)
+
+def _ollama_options() -> Dict:
+    temperature = float(os.getenv("OLLAMA_TEMPERATURE", "0.2"))
+    num_ctx_env = os.getenv("OLLAMA_NUM_CTX")
+    options = {"temperature": temperature}
+    if num_ctx_env:
+        try:
+            options["num_ctx"] = int(num_ctx_env)
+        except ValueError:
+            pass
+    return options
+
+def _keep_alive():
+    """OLLAMA_KEEP_ALIVE: how long Ollama keeps the model loaded after a request
+    ('30m', '1h', '-1' = forever, '0' = unload). Default 30m."""
+    v = os.getenv("OLLAMA_KEEP_ALIVE", "30m").strip()
     try:
-        r = requests.get(f"{_ollama_url()}/api/tags", timeout=timeout)
-        return r.status_code == 200
-    except Exception:
-        return False
+        return int(v)  # plain numbers are seconds (or -1)
+    except ValueError:
+        return v
+
+def _ollama_payload(model: str, prompt: str) -> Dict:
+    return {"model": model, "prompt": prompt, "options": _ollama_options(), "keep_alive": _keep_alive()}
+
+# =========================
+# Token accounting
+# =========================
+def _fill_token_stats(
+    stats: Dict,
+    prompt: str,
+    answer: str,
+    t0: float,
+    t_first: Optional[float],
+    t_end: float,
+    usage: Optional[Dict] = None,
+) -> None:
+    """
+    Fill `stats` with total_ms, prompt_tokens, completion_tokens, prefill_ms, decode_ms and
+    tokens_per_s. `usage` holds the server's counters in Ollama's format (prompt_eval_count,
+    eval_count, prompt_eval_duration / eval_duration in ns); whatever it lacks falls back to
+    count_tokens() and client timings (prefill = time to first token, decode = the rest).
+    With a reused prompt prefix Ollama counts only the prefilled prompt tokens.
+    """
+    usage = usage or {}
+    stats["total_ms"] = (t_end - t0) * 1000
+    # 0 is a real count (e.g. the whole prompt was served from the prefix cache)
+    n = usage.get("prompt_eval_count")
+    stats["prompt_tokens"] = n if n is not None else count_tokens(prompt)
+    n = usage.get("eval_count")
+    stats["completion_tokens"] = n if n is not None else count_tokens(answer)
+    if usage.get("prompt_eval_duration"):
+        stats["prefill_ms"] = usage["prompt_eval_duration"] / 1e6
+    elif t_first is not None:
+        stats["prefill_ms"] = (t_first - t0) * 1000
+    if usage.get("eval_duration"):
+        stats["decode_ms"] = usage["eval_duration"] / 1e6
+    elif t_first is not None:
+        stats["decode_ms"] = (t_end - t_first) * 1000
+    if stats["completion_tokens"] and stats.get("decode_ms"):
+        stats["tokens_per_s"] = stats["completion_tokens"] / (stats["decode_ms"] / 1000)
+    observe_ms("prefill", stats.get("prefill_ms"))
+    observe_ms("decode", stats.get("decode_ms"))
+
+def preload_model(model: Optional[str] = None, warm_prefix: bool = True) -> float:
+    """
+    Load the model into memory (and with warm_prefix, prefill SYSTEM_PREFIX into the KV cache)
+    so the first user request does not pay the cold start. Returns the elapsed ms.
+    """
+    model = model or os.getenv("OLLAMA_MODEL", "llama3.1")
+    payload: Dict = {"model": model, "keep_alive": _keep_alive()}
+    if warm_prefix:
+        payload.update(prompt=SYSTEM_PREFIX, options={**_ollama_options(), "num_predict": 1})
+    t0 = time.perf_counter()
+    get_client(_ollama_url()).generate(payload)
+    return (time.perf_counter() - t0) * 1000
 
-def answer_with_ollama(query: str, contexts: List[Dict], model: Optional[str] = None) -> str:
+def start_preload() -> Optional[threading.Thread]:
+    """preload_model() in a daemon thread at service start (skipped with OLLAMA_PRELOAD=0);
+    failures only log a warning since Ollama may come up later."""
+    if os.getenv("OLLAMA_PRELOAD", "1").strip().lower() in {"0", "false", "no", "off"}:
+        return None
+    def run():
+        try:
+            ms = preload_model()
+            print(f"[INFO] Ollama model preloaded in {ms:.0f} ms")
+        except Exception as e:
+            print(f"[WARN] Ollama preload failed: {e}")
+    t = threading.Thread(target=run, name="ollama-preload", daemon=True)
+    t.start()
+    return t
+
+def answer_with_ollama(
+    query: str,
+    contexts: List[Dict],
+    model: Optional[str] = None,
+    host: Optional[str] = None,
+    stats: Optional[Dict] = None,
+) -> str:
     """
     Generate with Ollama. Requires `ollama serve` running and a model available (e.g. `ollama pull llama3.1`).
     Useful env vars:
       - OLLAMA_MODEL (e.g. 'llama3.1')
-      - OLLAMA_HOST  (e.g. 'http://localhost:11434')
+      - OLLAMA_HOST  (e.g. 'http://localhost:11434'; `host` overrides it)
       - OLLAMA_TEMPERATURE (optional float)
       - OLLAMA_NUM_CTX (optional int)
+      - OLLAMA_KEEP_ALIVE (default '30m')
+      - OLLAMA_CONNECT_TIMEOUT / OLLAMA_READ_TIMEOUT (seconds, see app/llm/ollama_client.py)
+    Raises ProviderUnavailable without contacting Ollama while its circuit is open.
+    `stats`, if given, receives the token counts and timings (see _fill_token_stats).
     """
-    if not _is_ollama_up():
-        raise RuntimeError("Ollama not responding at 11434. Is 'ollama serve' running?")
+    model = model or os.getenv("OLLAMA_MODEL", "llama3.1")
+    prompt = _build_prompt(query, contexts)
+
+    t0 = time.perf_counter()
+    data = get_client(host or _ollama_url()).generate(_ollama_payload(model, prompt))
+    answer = (data.get("response") or "").strip()
+    if stats is not None:
+        _fill_token_stats(stats, prompt, answer, t0, None, time.perf_counter(), usage=data)
+    return answer
+
 
+async def aanswer_with_ollama(
+    query: str,
+    contexts: List[Dict],
+    model: Optional[str] = None,
+    host: Optional[str] = None,
+    stats: Optional[Dict] = None,
+) -> str:
+    """Async counterpart of answer_with_ollama (pooled httpx client; never blocks the event loop)."""
     model = model or os.getenv("OLLAMA_MODEL", "llama3.1")
-    temperature = float(os.getenv("OLLAMA_TEMPERATURE", "0.2"))
-    num_ctx_env = os.getenv("OLLAMA_NUM_CTX")
-    options = {"temperature": temperature}
-    if num_ctx_env:
-        try:
-            options["num_ctx"] = int(num_ctx_env)
-        except ValueError:
-            pass
+    prompt = _build_prompt(query, contexts)
+
+    t0 = time.perf_counter()
+    data = await get_client(host or _ollama_url()).agenerate(_ollama_payload(model, prompt))
+    answer = (data.get("response") or "").strip()
+    if stats is not None:
+        _fill_token_stats(stats, prompt, answer, t0, None, time.perf_counter(), usage=data)
+    return answer
+
 
+def stream_with_ollama(
+    query: str,
+    contexts: List[Dict],
+    model: Optional[str] = None,
+    stats: Optional[Dict] = None,
+    host: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Same as answer_with_ollama but yields the answer piece by piece as Ollama emits it.
+    If `stats` is given it is filled (also on early exit) with:
+      ttft_ms, total_ms, prompt_tokens, completion_tokens, prefill_ms, decode_ms, tokens_per_s
+    """
+    stats = stats if stats is not None else {}
+    model = model or os.getenv("OLLAMA_MODEL", "llama3.1")
     prompt = _build_prompt(query, contexts)
 
-    r = requests.post(
-        f"{_ollama_url()}/api/generate",
-        json={"model": model, "prompt": prompt, "options": options, "stream": False},
-        timeout=180,
-    )
-    r.raise_for_status()
-    data = r.json()
-    return (data.get("response") or "").strip()
+    t0 = time.perf_counter()
+    t_first = None
+    pieces: List[str] = []
+    final: Dict = {}
+    messages = None
+    try:
+        messages = get_client(host or _ollama_url()).generate_stream(_ollama_payload(model, prompt))
+        for obj in messages:
+            if obj.get("error"):
+                raise RuntimeError(f"Ollama error: {obj['error']}")
+            piece = obj.get("response") or ""
+            if piece:
+                if t_first is None:
+                    t_first = time.perf_counter()
+                    stats["ttft_ms"] = (t_first - t0) * 1000
+                pieces.append(piece)
+                yield piece
+            if obj.get("done"):
+                final = obj
+                break
+    finally:
+        if messages is not None:
+            messages.close()  # release the pooled connection even when the consumer stops early
+        # Ollama reports the counters in the last message; an early exit never sees it
+        _fill_token_stats(stats, prompt, "".join(pieces), t0, t_first, time.perf_counter(), usage=final)
 
 
 # =========================
@@ -127,20 +288,226 @@ def answer_with_openai(query: str, contexts: List[Dict], model: Optional[str] =
     return (resp.choices[0].message.content or "").strip()
 
 
+def stream_with_openai(
+    query: str,
+    contexts: List[Dict],
+    model: Optional[str] = None,
+    stats: Optional[Dict] = None,
+) -> Iterator[str]:
+    """Streaming counterpart of answer_with_openai; fills `stats` like stream_with_ollama."""
+    try:
+        from openai import OpenAI
+    except Exception as e:
+        raise RuntimeError("Package 'openai' not available or incompatible. Install 'openai>=1.0.0' if you want to use this fallback.") from e
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY is not set. Configure it or use Ollama instead.")
+
+    stats = stats if stats is not None else {}
+    model = model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    prompt = _build_prompt(query, contexts)
+
+    t0 = time.perf_counter()
+    t_first = None
+    pieces: List[str] = []
+    usage: Dict = {}
+    resp = None
+    try:
+        resp = OpenAI(api_key=api_key).chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2,
+            max_tokens=700,
+            stream=True,
+            stream_options={"include_usage": True},  # last chunk carries the token usage
+        )
+        for chunk in resp:
+            if getattr(chunk, "usage", None):
+                usage = {"prompt_eval_count": chunk.usage.prompt_tokens, "eval_count": chunk.usage.completion_tokens}
+            piece = chunk.choices[0].delta.content if chunk.choices else None
+            if piece:
+                if t_first is None:
+                    t_first = time.perf_counter()
+                    stats["ttft_ms"] = (t_first - t0) * 1000
+                pieces.append(piece)
+                yield piece
+    finally:
+        if resp is not None:
+            resp.close()
+        _fill_token_stats(stats, prompt, "".join(pieces), t0, t_first, time.perf_counter(), usage=usage)
+
+
 # =========================
 # Router
 # =========================
-def generate_answer(query, ctx):
-    model = os.getenv("OLLAMA_MODEL", "llama3.1")  # default: llama3.1
-    prompt = f"Answer in English, using the following sources:\n\n{ctx}\n\nQuestion: {query}"
-
-    r = requests.post(
-        "http://localhost:11434/api/generate",
-        json={"model": model, "prompt": prompt, "stream": False},
-        timeout=120
+def _answer_cache_key(query: str, ctx: List[Dict]) -> str:
+    return make_key(
+        query,
+        [c.get("source", "") for c in ctx],
+        os.getenv("LLM_PROVIDERS") or os.getenv("OLLAMA_MODEL", "llama3.1"),
+        os.getenv("PROMPT_STYLE") or "strict",
+        {**_ollama_options(), "context_budget": context_budget()},
     )
-    r.raise_for_status()
-    return r.json().get("response", "").strip()
+
+_answer_flight = SingleFlight()
+_stream_flight = StreamFlight()
+
+def _merge_flight_info(info: Dict, run_info: Dict, shared: bool) -> None:
+    # a coalesced caller did not spend tokens of its own: like a cache hit it only gets the provider
+    if shared:
+        info.update(coalesced=True, **{k: run_info.get(k) for k in ("provider", "provider_kind", "model")})
+    else:
+        info.update(run_info)
+
+def generate_answer(
+    query: str,
+    ctx: List[Dict],
+    use_cache: bool = True,
+    refresh: bool = False,
+    info: Optional[Dict] = None,
+    priority: str = "interactive",
+) -> str:
+    """
+    Answer using the PROMPT_STYLE prompt over the passages. The provider is chosen by the
+    router (app/llm/router.py; default: Ollama at OLLAMA_HOST / OLLAMA_MODEL), which may hedge
+    slow requests (LLM_HEDGE=1). `info` receives the provider that answered (provider,
+    provider_kind, model) and the token
+    counts and timings of the generation (see stream_with_ollama).
+    Identical (query, ctx sources, model, style, options) are served from the answer cache
+    (app/llm/answer_cache.py); use_cache=False bypasses it, refresh=True regenerates and overwrites.
+    Identical requests already being generated share that generation (retrieval/singleflight.py);
+    their `info` gets coalesced=True.
+    Generations wait for a slot of the LLM scheduler (app/llm/scheduler.py) in their `priority`
+    class ("interactive" or "batch"); info["queue_wait_ms"] is the wait. Raises SchedulerBusy
+    when the queue is full.
+    """
+    from app.llm.router import get_router
+    info = info if info is not None else {}
+    use_cache = use_cache and cache_enabled()
+    key = _answer_cache_key(query, ctx)
+    if use_cache and not refresh:
+        cached = get_cache().get(key)
+        ANSWER_CACHE.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            info["cached"] = True
+            return cached
+
+    def produce():
+        run_info: Dict = {}
+        scheduler = get_scheduler()
+        with scheduler.slot(priority) as wait_ms:
+            run_info["queue_wait_ms"] = wait_ms
+            observe_ms("queue_wait", wait_ms)
+            ans = get_router().answer(query, ctx, info=run_info)
+            for fut in run_info.pop("stragglers", []):
+                scheduler.occupy(priority, fut)  # a hedged loser keeps a slot until its request exits
+        if ans and use_cache:
+            get_cache().put(key, ans, model=run_info.get("provider"))
+        return ans, run_info
+
+    if singleflight_enabled():
+        (ans, run_info), shared = _answer_flight.do(key, produce)
+    else:
+        (ans, run_info), shared = produce(), False
+    _merge_flight_info(info, run_info, shared)
+    return ans
+
+
+async def agenerate_answer(
+    query: str,
+    ctx: List[Dict],
+    use_cache: bool = True,
+    refresh: bool = False,
+    info: Optional[Dict] = None,
+    priority: str = "interactive",
+) -> str:
+    """Async counterpart of generate_answer for the API (router.aanswer; cache I/O off the event loop)."""
+    from app.llm.router import get_router
+    info = info if info is not None else {}
+    use_cache = use_cache and cache_enabled()
+    key = _answer_cache_key(query, ctx)
+    if use_cache and not refresh:
+        cached = await asyncio.to_thread(get_cache().get, key)
+        ANSWER_CACHE.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            info["cached"] = True
+            return cached
+
+    async def produce():
+        run_info: Dict = {}
+        async with get_scheduler().aslot(priority) as wait_ms:
+            run_info["queue_wait_ms"] = wait_ms
+            observe_ms("queue_wait", wait_ms)
+            ans = await get_router().aanswer(query, ctx, info=run_info)
+        if ans and use_cache:
+            await asyncio.to_thread(get_cache().put, key, ans, run_info.get("provider"))
+        return ans, run_info
+
+    if singleflight_enabled():
+        (ans, run_info), shared = await _answer_flight.ado(key, produce)
+    else:
+        (ans, run_info), shared = await produce(), False
+    _merge_flight_info(info, run_info, shared)
+    return ans
+
+
+def generate_answer_stream(
+    query: str,
+    ctx: List[Dict],
+    stats: Optional[Dict] = None,
+    use_cache: bool = True,
+    refresh: bool = False,
+    priority: str = "interactive",
+) -> Iterator[str]:
+    """
+    Streaming counterpart of generate_answer (routed to the fastest healthy provider, with
+    failover before the first token). See stream_with_ollama for `stats`; stats["provider"]
+    names the provider that answered (stats["provider_kind"] / stats["model"] its parts).
+    A cache hit is yielded as a single piece with stats["cached"] = True; a fully streamed
+    answer is stored in the cache. A request identical to one being streamed joins that
+    stream (stats["coalesced"] = True, with its own ttft_ms / total_ms). The scheduler slot is
+    held for the whole stream; stats["queue_wait_ms"] is the wait for it.
+    """
+    from app.llm.router import get_router
+    stats = stats if stats is not None else {}
+    use_cache = use_cache and cache_enabled()
+    key = _answer_cache_key(query, ctx)
+    if use_cache and not refresh:
+        t0 = time.perf_counter()
+        cached = get_cache().get(key)
+        ANSWER_CACHE.inc(result="miss" if cached is None else "hit")
+        if cached is not None:
+            stats.update(cached=True, ttft_ms=(time.perf_counter() - t0) * 1000, completion_tokens=0)
+            stats["total_ms"] = stats["ttft_ms"]
+            yield cached
+            return
+
+    def produce() -> Iterator[str]:
+        pieces: List[str] = []
+        with get_scheduler().slot(priority) as wait_ms:
+            stats["queue_wait_ms"] = wait_ms
+            observe_ms("queue_wait", wait_ms)
+            for piece in get_router().stream(query, ctx, stats=stats):
+                pieces.append(piece)
+                yield piece
+        ans = "".join(pieces).strip()
+        if ans and use_cache:
+            get_cache().put(key, ans, model=stats.get("provider"))
+
+    if not singleflight_enabled():
+        yield from produce()
+        return
+    pieces, shared = _stream_flight.stream(key, produce)
+    if not shared:
+        yield from pieces
+        return
+    stats["coalesced"] = True
+    t0 = time.perf_counter()
+    for piece in pieces:
+        stats.setdefault("ttft_ms", (time.perf_counter() - t0) * 1000)
+        yield piece
+    stats["total_ms"] = (time.perf_counter() - t0) * 1000
 
 
 # Alternative version for OpenAI (commented out)
@@ -0,0 +1,264 @@
+# app/llm/ollama_client.py
+"""
+Ollama HTTP client with persistent connection pools (sync: requests.Session, async: httpx)
+and a circuit breaker, so generations reuse warm TCP connections and skip the /api/tags
+probe: health is inferred from the outcome of real calls.
+
+Env vars:
+  - OLLAMA_HOST              (default http://localhost:11434)
+  - OLLAMA_CONNECT_TIMEOUT   seconds (default 3)
+  - OLLAMA_READ_TIMEOUT      seconds (default 180)
+  - OLLAMA_POOL_SIZE         max pooled connections (default 10)
+  - OLLAMA_BREAKER_FAILURES  consecutive failures that open the circuit (default 3)
+  - OLLAMA_BREAKER_RESET_S   seconds before a half-open trial call (default 15)
+"""
+from __future__ import annotations
+import json
+import os
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class ProviderUnavailable(RuntimeError):
+    """The provider's circuit is open: fail fast instead of waiting for a timeout."""
+
+
+class CircuitBreaker:
+    """
+    closed    -> calls go through; `failure_threshold` consecutive failures open the circuit
+    open      -> calls are rejected until `reset_timeout_s` has passed
+    half_open -> a single trial call; success closes the circuit, failure re-opens it, an
+                 error unrelated to provider health (4xx) leaves the trial to the next call
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout_s: float = 15.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+                return self.HALF_OPEN
+            return self._state
+
+    def retry_in(self) -> float:
+        return max(0.0, self._opened_at + self.reset_timeout_s - time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_neutral(self) -> None:
+        """An outcome that says nothing about provider health (4xx, client-side bug): frees a
+        half-open trial for the next call without closing or opening the circuit."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def _is_provider_failure(exc: BaseException) -> bool:
+    # connection problems, timeouts and 5xx count against the provider; 4xx (e.g. unknown model) do not
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500
+    try:
+        import httpx
+        if isinstance(exc, (httpx.TransportError, httpx.TimeoutException)):
+            return True
+        if isinstance(exc, httpx.HTTPStatusError):
+            return exc.response.status_code >= 500
+    except ImportError:
+        pass
+    return False
+
+
+class OllamaClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        pool_size: Optional[int] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ) -> None:
+        self.base_url = (base_url or os.getenv("OLLAMA_HOST", "http://localhost:11434")).rstrip("/")
+        self.connect_timeout = connect_timeout or float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "3"))
+        self.read_timeout = read_timeout or float(os.getenv("OLLAMA_READ_TIMEOUT", "180"))
+        self.pool_size = pool_size or int(os.getenv("OLLAMA_POOL_SIZE", "10"))
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=int(os.getenv("OLLAMA_BREAKER_FAILURES", "3")),
+            reset_timeout_s=float(os.getenv("OLLAMA_BREAKER_RESET_S", "15")),
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._async = None
+        self._health: Optional[bool] = None
+        self._health_at = 0.0
+
+    def timeout(self, read_timeout: Optional[float] = None):
+        return (self.connect_timeout, read_timeout or self.read_timeout)
+
+    def _check(self) -> None:
+        if not self.breaker.allow():
+            raise ProviderUnavailable(
+                f"Ollama at {self.base_url} is failing (circuit open); retry in {self.breaker.retry_in():.0f}s"
+            )
+
+    def _fail(self, exc: BaseException) -> None:
+        if _is_provider_failure(exc):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()  # only real successes close the circuit / reset the streak
+
+    # ---------- Health (cached; generation calls never probe) ----------
+    def health(self, max_age_s: float = 30.0) -> bool:
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return False
+        if self._health is not None and time.monotonic() - self._health_at < max_age_s:
+            return self._health
+        try:
+            r = self.session.get(f"{self.base_url}/api/tags", timeout=(self.connect_timeout, 2.5))
+            self._health = r.status_code == 200
+        except requests.RequestException:
+            self._health = False
+        self._health_at = time.monotonic()
+        return self._health
+
+    # ---------- Sync ----------
+    def post(self, path: str, payload: Dict, read_timeout: Optional[float] = None) -> Dict:
+        self._check()
+        try:
+            r = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout(read_timeout))
+            r.raise_for_status()
+            data = r.json()
+        except Exception as e:
+            self._fail(e)
+            raise
+        self.breaker.record_success()
+        return data
+
+    def generate(self, payload: Dict, read_timeout: Optional[float] = None) -> Dict:
+        return self.post("/api/generate", {**payload, "stream": False}, read_timeout=read_timeout)
+
+    def generate_stream(self, payload: Dict, read_timeout: Optional[float] = None) -> Iterator[Dict]:
+        """Yields the NDJSON messages of a streaming /api/generate call."""
+        self._check()
+        try:
+            with self.session.post(
+                f"{self.base_url}/api/generate",
+                json={**payload, "stream": True},
+                timeout=self.timeout(read_timeout),
+                stream=True,
+            ) as r:
+                r.raise_for_status()
+                self.breaker.record_success()  # the provider answered; consumers may stop early
+                for line in r.iter_lines():
+                    if line:
+                        yield json.loads(line)
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            self._fail(e)
+            raise
+
+    # ---------- Async ----------
+    def _async_client(self):
+        if self._async is None:
+            import httpx
+            self._async = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        return self._async
+
+    async def apost(self, path: str, payload: Dict, read_timeout: Optional[float] = None) -> Dict:
+        self._check()
+        kwargs = {}
+        if read_timeout:
+            import httpx
+            kwargs["timeout"] = httpx.Timeout(read_timeout, connect=self.connect_timeout)
+        try:
+            r = await self._async_client().post(path, json=payload, **kwargs)
+            r.raise_for_status()
+            data = r.json()
+        except Exception as e:
+            self._fail(e)
+            raise
+        except BaseException:  # cancelled (e.g. a hedged loser): nothing learned about the provider
+            self.breaker.record_neutral()
+            raise
+        self.breaker.record_success()
+        return data
+
+    async def agenerate(self, payload: Dict, read_timeout: Optional[float] = None) -> Dict:
+        return await self.apost("/api/generate", {**payload, "stream": False}, read_timeout=read_timeout)
+
+    async def agenerate_stream(self, payload: Dict) -> AsyncIterator[Dict]:
+        self._check()
+        try:
+            async with self._async_client().stream("POST", "/api/generate", json={**payload, "stream": True}) as r:
+                r.raise_for_status()
+                self.breaker.record_success()
+                async for line in r.aiter_lines():
+                    if line.strip():
+                        yield json.loads(line)
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            self._fail(e)
+            raise
+
+    def close(self) -> None:
+        self.session.close()
+
+    async def aclose(self) -> None:
+        if self._async is not None:
+            await self._async.aclose()
+            self._async = None
+
+
+_clients: Dict[str, OllamaClient] = {}
+_clients_lock = threading.Lock()
+
+def get_client(base_url: Optional[str] = None) -> OllamaClient:
+    """Process-wide client per base URL (shares the pool and the breaker state)."""
+    url = (base_url or os.getenv("OLLAMA_HOST", "http://localhost:11434")).rstrip("/")
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = OllamaClient(base_url=url)
+        return _clients[url]
@@ -0,0 +1,359 @@
+# app/llm/router.py
+"""
+Latency-aware routing (and optional hedging) across LLM providers.
+
+Each provider/model keeps rolling latency and error statistics over the last
+LLM_STATS_WINDOW_S seconds. A request goes to the healthy provider with the lowest p50;
+providers without enough samples are tried first so every backend gets measured. Unhealthy
+providers (open circuit, or error rate above LLM_MAX_ERROR_RATE) are only used as a last
+resort. With hedging on, if the primary has not answered after its p95 a second request is
+sent to the next provider; the first answer wins and the loser's stream is closed, which
+makes Ollama stop generating.
+
+Env vars:
+  - LLM_PROVIDERS        comma-separated 'kind:model[@host]', e.g.
+                         'ollama:llama3.1@http://gpu1:11434,ollama:llama3.1@http://gpu2:11434,openai:gpt-4o-mini'
+                         (default: 'ollama:$OLLAMA_MODEL@$OLLAMA_HOST')
+  - LLM_HEDGE            "1" enables hedged requests (default "0")
+  - LLM_HEDGE_MIN_MS     never hedge earlier than this (default 300)
+  - LLM_STATS_WINDOW_S   statistics window in seconds (default 300)
+  - LLM_MAX_ERROR_RATE   error rate above which a provider is unhealthy (default 0.5)
+"""
+from __future__ import annotations
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from app.llm.generate import aanswer_with_ollama, stream_with_ollama, stream_with_openai
+from app.llm.ollama_client import CircuitBreaker, get_client
+
+class Cancelled(Exception):
+    """Raised inside a losing hedged request once the other one has answered."""
+
+
+class LatencyStats:
+    """Rolling (time-windowed) latency quantiles and error rate for one provider."""
+    def __init__(self, window_s: float = 300.0, max_samples: int = 500, min_samples: int = 5) -> None:
+        self.window_s = window_s
+        self.min_samples = min_samples
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=max_samples)  # (ts, ms, ok)
+        self._lock = threading.Lock()
+
+    def record(self, ms: float, ok: bool) -> None:
+        with self._lock:
+            self._samples.append((time.monotonic(), ms, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        cutoff = time.monotonic() - self.window_s
+        with self._lock:
+            while self._samples and self._samples[0][0] < cutoff:
+                self._samples.popleft()
+            return list(self._samples)
+
+    def quantile(self, q: float) -> Optional[float]:
+        lat = sorted(ms for _, ms, ok in self._recent() if ok)
+        if len(lat) < self.min_samples:
+            return None
+        return lat[min(len(lat) - 1, int(q * len(lat)))]
+
+    def error_rate(self) -> float:
+        s = self._recent()
+        if len(s) < self.min_samples:
+            return 0.0
+        return sum(1 for _, _, ok in s if not ok) / len(s)
+
+    def snapshot(self) -> Dict:
+        s = self._recent()
+        return {"n": len(s), "p50_ms": self.quantile(0.5), "p95_ms": self.quantile(0.95),
+                "error_rate": round(self.error_rate(), 3)}
+
+
+@dataclass
+class Provider:
+    kind: str                    # "ollama" | "openai"
+    model: str
+    host: Optional[str] = None   # Ollama base URL (default OLLAMA_HOST)
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}:{self.model}" + (f"@{self.host}" if self.host else "")
+
+    def describe(self) -> Dict[str, str]:
+        """What callers record about the provider that answered (telemetry provider / model)."""
+        return {"provider": self.name, "provider_kind": self.kind, "model": self.model}
+
+    def stream(self, query: str, ctx: List[Dict], stats: Optional[Dict] = None) -> Iterator[str]:
+        if self.kind == "ollama":
+            return stream_with_ollama(query, ctx, model=self.model, stats=stats, host=self.host)
+        if self.kind == "openai":
+            return stream_with_openai(query, ctx, model=self.model, stats=stats)
+        raise ValueError(f"Unknown provider kind: {self.kind}")
+
+    async def agenerate(self, query: str, ctx: List[Dict], stats: Optional[Dict] = None) -> str:
+        if self.kind == "ollama":
+            return await aanswer_with_ollama(query, ctx, model=self.model, host=self.host, stats=stats)
+        if self.kind == "openai":
+            # the OpenAI SDK call is blocking: keep it off the event loop
+            return await asyncio.to_thread(lambda: "".join(self.stream(query, ctx, stats=stats)).strip())
+        raise ValueError(f"Unknown provider kind: {self.kind}")
+
+    def circuit_open(self) -> bool:
+        if self.kind == "ollama":
+            return get_client(self.host).breaker.state == CircuitBreaker.OPEN
+        return not os.getenv("OPENAI_API_KEY")
+
+def parse_providers(spec: Optional[str] = None) -> List[Provider]:
+    spec = spec if spec is not None else os.getenv("LLM_PROVIDERS", "")
+    providers = []
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        kind, _, rest = item.partition(":")
+        model, _, host = rest.partition("@")
+        providers.append(Provider(kind=kind.strip().lower(), model=model.strip(), host=host.strip() or None))
+    if not providers:
+        providers.append(Provider("ollama", os.getenv("OLLAMA_MODEL", "llama3.1"), os.getenv("OLLAMA_HOST") or None))
+    return providers
+
+
+class ProviderRouter:
+    def __init__(
+        self,
+        providers: List[Provider],
+        hedge: bool = False,
+        hedge_min_ms: float = 300.0,
+        window_s: float = 300.0,
+        max_error_rate: float = 0.5,
+    ) -> None:
+        assert providers, "at least one provider is required"
+        self.providers = providers
+        self.hedge = hedge
+        self.hedge_min_ms = hedge_min_ms
+        self.max_error_rate = max_error_rate
+        self.stats: Dict[str, LatencyStats] = {p.name: LatencyStats(window_s=window_s) for p in providers}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._pool = ThreadPoolExecutor(max_workers=max(4, 2 * len(providers)), thread_name_prefix="llm-router")
+
+    @classmethod
+    def from_env(cls) -> "ProviderRouter":
+        return cls(
+            parse_providers(),
+            hedge=os.getenv("LLM_HEDGE", "0").strip().lower() in {"1", "true", "yes", "on"},
+            hedge_min_ms=float(os.getenv("LLM_HEDGE_MIN_MS", "300")),
+            window_s=float(os.getenv("LLM_STATS_WINDOW_S", "300")),
+            max_error_rate=float(os.getenv("LLM_MAX_ERROR_RATE", "0.5")),
+        )
+
+    def signature(self) -> str:
+        return ",".join(p.name for p in self.providers)
+
+    def rank(self) -> List[Provider]:
+        """Healthy providers by p50 (unmeasured first), then unhealthy ones as a last resort."""
+        def key(p: Provider):
+            st = self.stats[p.name]
+            unhealthy = p.circuit_open() or st.error_rate() > self.max_error_rate
+            p50 = st.quantile(0.5)
+            return (unhealthy, -1.0 if p50 is None else p50)
+        return sorted(self.providers, key=key)
+
+    def expected_ms(self) -> Optional[float]:
+        """p50 of the provider a request would go to now (None until it has enough samples)."""
+        return self.stats[self.rank()[0].name].quantile(0.5)
+
+    def _hedge_delay_s(self, p: Provider) -> Optional[float]:
+        p95 = self.stats[p.name].quantile(0.95)
+        return None if p95 is None else max(p95, self.hedge_min_ms) / 1000
+
+    # ---------- Non-streaming (hedged) ----------
+    def _run(self, p: Provider, query: str, ctx: List[Dict], cancel: threading.Event, stats: Dict) -> str:
+        t0 = time.perf_counter()
+        pieces: List[str] = []
+        stream = p.stream(query, ctx, stats=stats)
+        try:
+            for piece in stream:
+                if cancel.is_set():
+                    raise Cancelled(p.name)
+                pieces.append(piece)
+        except Cancelled:
+            # lower bound of its latency; keeps a backend that keeps losing from looking fast
+            self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=True)
+            raise
+        except Exception:
+            self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=False)
+            raise
+        finally:
+            stream.close()  # a cancelled loser closes its HTTP stream here
+        self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=True)
+        return "".join(pieces).strip()
+
+    def answer(self, query: str, ctx: List[Dict], info: Optional[Dict] = None) -> str:
+        """
+        Route (and maybe hedge) one generation; failed providers fail over to the next one.
+        `info`, if given, receives provider (the winner's name), provider_kind and model,
+        hedged (bool), attempts (names tried) and the winner's token counts and timings
+        (prompt_tokens, completion_tokens, prefill_ms, ...). When a hedged loser is still
+        running, info["stragglers"] holds its future.
+        """
+        info = info if info is not None else {}
+        info.update(hedged=False, attempts=[])
+        ranked = self.rank()
+        cancel = threading.Event()
+        errors: List[str] = []
+
+        hedge_after = self._hedge_delay_s(ranked[0]) if self.hedge and len(ranked) > 1 else None
+        if hedge_after is None:
+            # no hedging: run in the caller's thread
+            for p in ranked:
+                info["attempts"].append(p.name)
+                stats: Dict = {}
+                try:
+                    text = self._run(p, query, ctx, cancel, stats)
+                except Exception as e:
+                    errors.append(f"{p.name}: {e}")
+                    continue
+                info.update(stats, **p.describe())
+                return text
+            raise RuntimeError("All LLM providers failed: " + "; ".join(errors))
+
+        queue = list(ranked)
+        pending: Dict[Future, Tuple[Provider, Dict]] = {}
+
+        def launch() -> None:
+            p = queue.pop(0)
+            info["attempts"].append(p.name)
+            stats: Dict = {}
+            pending[self._pool.submit(self._run, p, query, ctx, cancel, stats)] = (p, stats)
+
+        launch()
+        done, _ = wait(list(pending), timeout=hedge_after)
+        if not done:
+            info["hedged"] = True
+            self.hedges += 1
+            launch()
+
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for fut in done:
+                p, stats = pending.pop(fut)
+                try:
+                    text = fut.result()
+                except Exception as e:
+                    errors.append(f"{p.name}: {e}")
+                    if not pending and queue:
+                        launch()  # failover to the next provider
+                    continue
+                cancel.set()  # the loser stops at its next token
+                # ... but one still in prefill keeps its request until then: the caller holds a
+                # scheduler slot for each of these (see generate_answer)
+                info["stragglers"] = list(pending)
+                if info["hedged"] and p is not ranked[0]:
+                    self.hedge_wins += 1
+                info.update(stats, **p.describe())
+                return text
+        raise RuntimeError("All LLM providers failed: " + "; ".join(errors))
+
+    # ---------- Async (API event loop; hedging with tasks) ----------
+    async def _arun(self, p: Provider, query: str, ctx: List[Dict], stats: Dict) -> str:
+        t0 = time.perf_counter()
+        try:
+            text = await p.agenerate(query, ctx, stats=stats)
+        except asyncio.CancelledError:
+            self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=True)  # lower bound, as in _run
+            raise
+        except Exception:
+            self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=False)
+            raise
+        self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=True)
+        return text
+
+    async def aanswer(self, query: str, ctx: List[Dict], info: Optional[Dict] = None) -> str:
+        """Async counterpart of answer(): same ranking, failover and hedging; the loser task is cancelled."""
+        info = info if info is not None else {}
+        info.update(hedged=False, attempts=[])
+        ranked = self.rank()
+        queue = list(ranked)
+        errors: List[str] = []
+        pending: Dict[asyncio.Task, Tuple[Provider, Dict]] = {}
+
+        def launch() -> None:
+            p = queue.pop(0)
+            info["attempts"].append(p.name)
+            stats: Dict = {}
+            pending[asyncio.ensure_future(self._arun(p, query, ctx, stats))] = (p, stats)
+
+        hedge_after = self._hedge_delay_s(ranked[0]) if self.hedge and len(ranked) > 1 else None
+        launch()
+        if hedge_after is not None:
+            done, _ = await asyncio.wait(list(pending), timeout=hedge_after)
+            if not done:
+                info["hedged"] = True
+                self.hedges += 1
+                launch()
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    p, stats = pending.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        errors.append(f"{p.name}: {e}")
+                        if not pending and queue:
+                            launch()  # failover to the next provider
+                        continue
+                    if info["hedged"] and p is not ranked[0]:
+                        self.hedge_wins += 1
+                    info.update(stats, **p.describe())
+                    return text
+        finally:
+            for task in pending:
+                task.cancel()  # the loser (or everything, if the caller was cancelled) closes its request
+        raise RuntimeError("All LLM providers failed: " + "; ".join(errors))
+
+    # ---------- Streaming (routed, failover before the first token) ----------
+    def stream(self, query: str, ctx: List[Dict], stats: Optional[Dict] = None) -> Iterator[str]:
+        stats = stats if stats is not None else {}
+        errors: List[str] = []
+        for p in self.rank():
+            t0 = time.perf_counter()
+            started = False
+            try:
+                for piece in p.stream(query, ctx, stats=stats):
+                    started = True
+                    yield piece
+            except Exception as e:
+                self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=False)
+                if started:
+                    raise
+                errors.append(f"{p.name}: {e}")
+                continue
+            self.stats[p.name].record((time.perf_counter() - t0) * 1000, ok=True)
+            stats.update(p.describe())
+            return
+        raise RuntimeError("All LLM providers failed: " + "; ".join(errors))
+
+    def snapshot(self) -> Dict:
+        return {"providers": {name: st.snapshot() for name, st in self.stats.items()},
+                "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+
+_router: Optional[ProviderRouter] = None
+_router_lock = threading.Lock()
+
+def get_router() -> ProviderRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ProviderRouter.from_env()
+        return _router
+
+def telemetry_labels(info: Dict) -> Tuple[str, str]:
+    """(provider, model) to log for a generation: the ones that answered, or the first configured
+    provider when no provider ran for this caller (cache hit, coalesced stream)."""
+    first = get_router().providers[0]
+    return info.get("provider_kind") or first.kind, info.get("model") or first.model
@@ -0,0 +1,223 @@
+# app/llm/scheduler.py
+"""
+Admission control and priority queueing for LLM generations.
+
+Ollama decodes only OLLAMA_NUM_PARALLEL requests at a time; sending more just makes every
+request slower until they all time out. Generations therefore take a slot first:
+
+- at most LLM_MAX_CONCURRENT generations run at once (match OLLAMA_NUM_PARALLEL)
+- waiters are served by priority class ("interactive" before "batch"), FIFO within a class
+- "batch" never holds more than LLM_BATCH_MAX_CONCURRENT slots, so an interactive request
+  always finds a free slot or is next in line, however long the batch job is
+- when a class queue is full (LLM_MAX_QUEUE_INTERACTIVE / LLM_MAX_QUEUE_BATCH) SchedulerBusy
+  is raised at once (the API answers 429); it is also raised to a waiter after
+  LLM_QUEUE_TIMEOUT_S (interactive, default 30) / LLM_BATCH_QUEUE_TIMEOUT_S (default 600)
+
+The limits are per process: run batch_qa.py with a batch share below OLLAMA_NUM_PARALLEL
+to leave slots for the UI/API processes.
+"""
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+class SchedulerBusy(RuntimeError):
+    """No LLM slot available within the queue limits; retry after `retry_after_s`."""
+    def __init__(self, message: str, retry_after_s: float = 1.0) -> None:
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class _Waiter:
+    __slots__ = ("priority", "event", "loop", "future", "granted", "cancelled")
+
+    def __init__(self, priority: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> None:
+        self.priority = priority
+        self.loop = loop
+        self.future: Optional[asyncio.Future] = loop.create_future() if loop else None
+        self.event = None if loop else threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class LLMScheduler:
+    def __init__(
+        self,
+        max_concurrent: int = 4,
+        max_queue: Optional[Dict[str, int]] = None,
+        batch_max_concurrent: Optional[int] = None,
+        queue_timeout_s: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = {"interactive": 16, "batch": 256, **(max_queue or {})}
+        self.batch_max_concurrent = max(1, batch_max_concurrent if batch_max_concurrent is not None
+                                        else self.max_concurrent - 1)
+        self.queue_timeout_s = {"interactive": 30.0, "batch": 600.0, **(queue_timeout_s or {})}
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[int, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self.running = {p: 0 for p in PRIORITIES}
+        self.queued = {p: 0 for p in PRIORITIES}
+        self.rejected = {p: 0 for p in PRIORITIES}
+        self._recent_ms: List[float] = []  # recent generation times, for Retry-After
+
+    @classmethod
+    def from_env(cls) -> "LLMScheduler":
+        limit = int(os.getenv("LLM_MAX_CONCURRENT", "4"))
+        batch = os.getenv("LLM_BATCH_MAX_CONCURRENT")
+        return cls(
+            max_concurrent=limit,
+            max_queue={"interactive": int(os.getenv("LLM_MAX_QUEUE_INTERACTIVE", "16")),
+                       "batch": int(os.getenv("LLM_MAX_QUEUE_BATCH", "256"))},
+            batch_max_concurrent=int(batch) if batch else None,
+            queue_timeout_s={"interactive": float(os.getenv("LLM_QUEUE_TIMEOUT_S", "30")),
+                             "batch": float(os.getenv("LLM_BATCH_QUEUE_TIMEOUT_S", "600"))},
+        )
+
+    # ---------- Admission ----------
+    def _eligible(self, priority: str) -> bool:
+        if sum(self.running.values()) >= self.max_concurrent:
+            return False
+        return priority != "batch" or self.running["batch"] < self.batch_max_concurrent
+
+    def _retry_after_s(self) -> float:
+        recent = sorted(self._recent_ms)
+        return round(recent[len(recent) // 2] / 1000, 1) if recent else 1.0
+
+    def _admit(self, priority: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> Optional[_Waiter]:
+        """Take a slot (returns None) or enqueue a waiter; raises SchedulerBusy if the queue is full."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}; expected one of {sorted(PRIORITIES)}")
+        with self._lock:
+            ahead = any(not w.cancelled and PRIORITIES[w.priority] <= PRIORITIES[priority] for _, _, w in self._heap)
+            if not ahead and self._eligible(priority):
+                self.running[priority] += 1
+                return None
+            if self.queued[priority] >= self.max_queue[priority]:
+                self.rejected[priority] += 1
+                raise SchedulerBusy(f"LLM queue full ({self.queued[priority]} {priority} requests waiting)",
+                                    retry_after_s=self._retry_after_s())
+            w = _Waiter(priority, loop)
+            heapq.heappush(self._heap, (PRIORITIES[priority], next(self._seq), w))
+            self.queued[priority] += 1
+            return w
+
+    def check(self, priority: str = "interactive") -> None:
+        """Best-effort early rejection (e.g. before a streaming response has started)."""
+        with self._lock:
+            full = self.queued[priority] >= self.max_queue[priority] and not self._eligible(priority)
+        if full:
+            raise SchedulerBusy(f"LLM queue full ({self.queued[priority]} {priority} requests waiting)",
+                                retry_after_s=self._retry_after_s())
+
+    def _grant_next(self) -> None:
+        """Hand freed capacity to the best eligible waiter (called with the lock held)."""
+        while self._heap:
+            _, _, w = self._heap[0]
+            if w.cancelled:
+                heapq.heappop(self._heap)  # already uncounted by _give_up
+                continue
+            if not self._eligible(w.priority):
+                return  # the head is a capped batch waiter: interactive ones would be ahead of it
+            heapq.heappop(self._heap)
+            self.queued[w.priority] -= 1
+            self.running[w.priority] += 1
+            w.granted = True
+            if w.event is not None:
+                w.event.set()
+            else:
+                w.loop.call_soon_threadsafe(self._wake_async, w)
+            return
+
+    def _wake_async(self, w: _Waiter) -> None:
+        if w.future.done():  # the waiter was cancelled while the grant was in transit
+            self.release(w.priority)
+        else:
+            w.future.set_result(True)
+
+    def release(self, priority: str, elapsed_ms: Optional[float] = None) -> None:
+        with self._lock:
+            self.running[priority] -= 1
+            if elapsed_ms is not None:
+                self._recent_ms = (self._recent_ms + [elapsed_ms])[-50:]
+            self._grant_next()
+
+    def occupy(self, priority: str, fut: Future) -> None:
+        """
+        Count one more running generation until `fut` is done. Used for a hedged request that
+        lost but is still in prefill (requests cannot interrupt it): the caller hands its slot
+        over, so Ollama is never busier than the scheduler believes.
+        """
+        with self._lock:
+            self.running[priority] += 1
+        fut.add_done_callback(lambda _: self.release(priority))
+
+    def _give_up(self, w: _Waiter) -> bool:
+        """Withdraw a waiter; returns True if it had been granted in the meantime (slot is held)."""
+        with self._lock:
+            if w.granted:
+                return True
+            w.cancelled = True
+            self.queued[w.priority] -= 1
+            return False
+
+    # ---------- Sync / async slots ----------
+    @contextmanager
+    def slot(self, priority: str = "interactive", timeout_s: Optional[float] = None) -> Iterator[float]:
+        """Hold one generation slot; yields the queue wait in ms."""
+        t0 = time.perf_counter()
+        w = self._admit(priority)
+        if w is not None and not w.event.wait(self.queue_timeout_s[priority] if timeout_s is None else timeout_s):
+            if not self._give_up(w):
+                raise SchedulerBusy(f"Timed out waiting for an LLM slot ({priority})", self._retry_after_s())
+        t1 = time.perf_counter()
+        try:
+            yield (t1 - t0) * 1000
+        finally:
+            self.release(priority, (time.perf_counter() - t1) * 1000)
+
+    @asynccontextmanager
+    async def aslot(self, priority: str = "interactive", timeout_s: Optional[float] = None) -> AsyncIterator[float]:
+        """Async counterpart of slot(); waiting does not block the event loop."""
+        t0 = time.perf_counter()
+        w = self._admit(priority, loop=asyncio.get_running_loop())
+        if w is not None:
+            try:
+                await asyncio.wait_for(w.future, self.queue_timeout_s[priority] if timeout_s is None else timeout_s)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if w.future.done() and not w.future.cancelled():
+                    self.release(priority)  # granted just before we gave up
+                else:
+                    self._give_up(w)  # if already granted, _wake_async releases it
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise SchedulerBusy(f"Timed out waiting for an LLM slot ({priority})", self._retry_after_s())
+        t1 = time.perf_counter()
+        try:
+            yield (t1 - t0) * 1000
+        finally:
+            self.release(priority, (time.perf_counter() - t1) * 1000)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"max_concurrent": self.max_concurrent, "batch_max_concurrent": self.batch_max_concurrent,
+                    "running": dict(self.running), "queued": dict(self.queued), "rejected": dict(self.rejected)}
+
+
+_scheduler: Optional[LLMScheduler] = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> LLMScheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler.from_env()
+        return _scheduler
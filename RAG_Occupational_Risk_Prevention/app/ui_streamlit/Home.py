@@ -7,10 +7,13 @@ sys.path.append(str(ROOT))
 import time
 import streamlit as st
 
-from retrieval.retrieval import BM25Client, VectorClient, HybridRetriever
-from app.llm.generate import generate_answer
+from retrieval.retrieval import VectorClient, HybridRetriever, open_bm25
+from app.llm.generate import generate_answer_stream, start_preload
+from app.llm.router import telemetry_labels
+from app.llm.scheduler import SchedulerBusy
 
 from monitoring.logger import log_interaction, update_feedback
+from monitoring.metrics import start_http_server
 import os
 
 DEFAULT_KB = str(ROOT / "data" / "kb" / "bm25.jsonl")
@@ -25,7 +28,8 @@ st.set_page_config(page_title="RAG‑OSHA", page_icon="🦺", layout="wide")
 # ---------- Client cache ----------
 @st.cache_resource(show_spinner=False)
 def get_bm25(kb_path: str = DEFAULT_KB):
-    return BM25Client(kb_path)
+    # segmented index when BM25_INDEX_DIR is set (follows ingestion's checkpoints), else the KB JSONL
+    return open_bm25(kb_path)
 
 @st.cache_resource(show_spinner=False)
 def get_vec(persist_dir: str = DEFAULT_CHROMA_DIR, collection: str = DEFAULT_COLLECTION):
@@ -35,6 +39,21 @@ def get_vec(persist_dir: str = DEFAULT_CHROMA_DIR, collection: str = DEFAULT_COL
 def get_hybrid(kb_path=DEFAULT_KB, persist_dir=DEFAULT_CHROMA_DIR, collection=DEFAULT_COLLECTION):
     return HybridRetriever(bm25_kb_path=kb_path, chroma_dir=persist_dir, chroma_collection=collection)
 
+@st.cache_resource(show_spinner=False)
+def warm_llm():
+    # once per server process: load the model and its prompt prefix before the first question
+    return start_preload()
+
+warm_llm()
+
+@st.cache_resource(show_spinner=False)
+def serve_metrics():
+    # Prometheus /metrics for this process (the API serves its own); off unless METRICS_PORT is set
+    port = os.getenv("METRICS_PORT")
+    return start_http_server(int(port)) if port else None
+
+serve_metrics()
+
 # ---------- Sidebar ----------
 st.sidebar.header("Settings")
 topk = st.sidebar.slider("Top‑k results", min_value=3, max_value=20, value=5, step=1)
@@ -106,6 +125,7 @@ with tab_ret:
                 st.caption(f"BM25 time: {(t1 - t0)*1000:.0f} ms")
                 render_hits("BM25", bm25_hits, q)
                 st.session_state["last_hits"] = bm25_hits
+                st.session_state["last_retriever"] = "bm25"
                 st.session_state["last_query"] = q
             else:
                 colA, colB, colC = st.columns(3)
@@ -120,6 +140,7 @@ with tab_ret:
 
                 # Guardar para la pestaña Answer: preferimos híbrido
                 st.session_state["last_hits"] = hyb_hits if run_all else bm25_hits
+                st.session_state["last_retriever"] = "hybrid" if run_all else "bm25"
                 st.session_state["last_query"] = q
 
 # =========================
@@ -140,20 +161,29 @@ with tab_ans:
         if not hits:
             st.warning("Please run a retrieval first in the 'Retrieval' tab.")
         else:
-            ctx = [{"text": h["text"], "source": h["source"]} for h in hits[:max_ctx]]
+            ctx = [{"text": h["text"], "source": h["source"], "score": h.get("score")} for h in hits[:max_ctx]]
 
             t0 = time.time()
-            with st.spinner("Generating with LLM..."):
-                try:
-                    ans = generate_answer(q2, ctx)
-                except Exception as e:
-                    st.error(f"Could not generate the answer: {e}")
-                    ans = None
+            gen_stats = {}
+            st.markdown("### Answer")
+            try:
+                # tokens are rendered as Ollama emits them
+                ans = st.write_stream(generate_answer_stream(q2, ctx, stats=gen_stats)) or None
+            except SchedulerBusy as e:
+                st.warning(f"The model is busy right now, please retry in a few seconds ({e}).")
+                ans = None
+            except Exception as e:
+                st.error(f"Could not generate the answer: {e}")
+                ans = None
             latency_ms = int((time.time() - t0) * 1000)
-
-            if ans:
-                st.markdown("### Answer")
-                st.write(ans)
+            if gen_stats.get("cached"):
+                st.caption(f"Served from the answer cache • total: {latency_ms} ms")
+            elif gen_stats.get("ttft_ms") is not None:
+                st.caption(
+                    f"First token: {gen_stats['ttft_ms']:.0f} ms • "
+                    f"{gen_stats.get('prompt_tokens') or 0} prompt / {gen_stats.get('completion_tokens') or 0} answer tokens • "
+                    f"{gen_stats.get('tokens_per_s') or 0:.1f} tokens/s • total: {latency_ms} ms"
+                )
 
             st.markdown("### Sources")
             for i, c in enumerate(ctx, start=1):
@@ -167,13 +197,12 @@ with tab_ans:
             # =========================
             # LOG INTERACTION
             # =========================
-            provider = "ollama"
-            model = os.getenv("OLLAMA_MODEL", "llama3.1")
+            provider, model = telemetry_labels(gen_stats)  # the provider the router actually used
 
             sources_list = [c["source"] for c in ctx]
             interaction_id = log_interaction(
                 query=q2,
-                retriever="hybrid",       # or "bm25" if only BM25 is used
+                retriever=st.session_state.get("last_retriever", "hybrid"),  # engine that produced last_hits
                 topk=topk,
                 fanout=fanout,
                 latency_ms=latency_ms,
@@ -181,7 +210,16 @@ with tab_ans:
                 model=model,
                 answer=ans,
                 sources=sources_list,
+                hits=hits[:max_ctx],  # fused hits: keep the per-engine ranks and scores
                 ctx_len=len(ctx),
+                latency_ms_llm=gen_stats.get("total_ms"),
+                ttft_ms=gen_stats.get("ttft_ms"),
+                tokens_per_s=gen_stats.get("tokens_per_s"),
+                prompt_tokens=gen_stats.get("prompt_tokens"),
+                completion_tokens=gen_stats.get("completion_tokens"),
+                prefill_ms=gen_stats.get("prefill_ms"),
+                decode_ms=gen_stats.get("decode_ms"),
+                queue_wait_ms=gen_stats.get("queue_wait_ms"),
             )
             st.session_state["last_interaction_id"] = interaction_id
 
@@ -2,40 +2,79 @@
 from __future__ import annotations
 import sys, pathlib, sqlite3, time
 import pandas as pd
-import numpy as np
 import streamlit as st
 
 ROOT = pathlib.Path(__file__).resolve().parents[3]
 sys.path.append(str(ROOT))
 from monitoring.logger import DB_PATH
+from monitoring.rollups import LogSketch, load_rollups, merge_all
 
 st.set_page_config(page_title="📈 Metrics & Monitoring", layout="wide")
 st.title("📈 Metrics & Monitoring")
 
+# Las páginas leen solo los agregados por hora/minuto (monitoring/rollups.py) más las filas
+# aún no agregadas: el coste no crece con el histórico.
 @st.cache_data(show_spinner=False, ttl=10)
-def load_interactions(limit: int = 10000) -> pd.DataFrame:
+def load_hourly() -> pd.DataFrame:
     db = pathlib.Path(DB_PATH)
     if not db.exists():
         return pd.DataFrame()
     with sqlite3.connect(str(db)) as conn:
-        # Carga todo y deja que abajo añadamos columnas faltantes
-        df = pd.read_sql_query("SELECT * FROM interactions ORDER BY id DESC LIMIT ?", conn, params=(limit,))
-    # Normaliza columnas que podrían faltar
-    for col in ["latency_ms_retrieval", "latency_ms_llm", "ctx_len", "feedback"]:
-        if col not in df.columns:
-            df[col] = pd.NA
-    # Tipos seguros
-    df["feedback"] = df["feedback"].apply(lambda v: int(v) if pd.notna(v) else 0)
-    # Timestamps legibles
-    if "ts_utc" in df.columns:
-        df["ts"] = df["ts_utc"].apply(lambda x: time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(x)) if pd.notna(x) else "")
-        df["date"] = df["ts_utc"].apply(lambda x: time.strftime("%Y-%m-%d", time.gmtime(x)) if pd.notna(x) else "")
-    else:
-        df["ts"] = ""
-        df["date"] = ""
+        rows = load_rollups(conn, "hour")
+    if not rows:
+        return pd.DataFrame()
+    df = pd.DataFrame([{"bucket": r["bucket"], "provider": r["provider"], "model": r["model"],
+                        "n": r["cell"].n, "likes": r["cell"].likes, "dislikes": r["cell"].dislikes,
+                        "cell": r["cell"]} for r in rows])
+    ts = pd.to_datetime(df["bucket"], unit="s", utc=True)
+    df["date"] = ts.dt.strftime("%Y-%m-%d")
+    df["hour"] = ts.dt.strftime("%Y-%m-%d %H:00")
     return df
 
-df = load_interactions()
+@st.cache_data(show_spinner=False, ttl=10)
+def load_last_hour() -> pd.DataFrame:
+    with sqlite3.connect(str(DB_PATH)) as conn:
+        rows = load_rollups(conn, "minute", since=time.time() - 3600)
+    return pd.DataFrame([{"bucket": r["bucket"], "provider": r["provider"], "model": r["model"],
+                          "n": r["cell"].n, "cell": r["cell"]} for r in rows])
+
+@st.cache_data(show_spinner=False, ttl=10)
+def top_queries(feedback: int, since: float, until: float, provider: str, model: str) -> pd.Series:
+    # usa el índice (feedback, ts_utc): solo lee las filas con feedback del rango
+    sql = "SELECT query, COUNT(*) AS n FROM interactions WHERE feedback = ? AND ts_utc >= ? AND ts_utc < ?"
+    params: list = [feedback, since, until]
+    if provider != "All":
+        sql += " AND provider = ?"
+        params.append(provider)
+    if model != "All":
+        sql += " AND model = ?"
+        params.append(model)
+    sql += " GROUP BY query ORDER BY n DESC LIMIT 10"
+    with sqlite3.connect(str(DB_PATH)) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    return pd.Series({q: n for q, n in rows}, dtype="int64")
+
+def merged(cells, metric: str) -> LogSketch:
+    return merge_all(c.sketches.get(metric) for c in cells)
+
+def quantile_by(frame: pd.DataFrame, key: str, metric: str, q: float) -> pd.Series:
+    """Quantile of `metric` per value of `key`, merging the sketches of each group."""
+    out = {k: merged(g["cell"], metric).quantile(q) for k, g in frame.groupby(key)}
+    return pd.Series(out, dtype="float64").dropna().sort_index()
+
+def keyed_medians(cells, prefix: str) -> pd.Series:
+    """Medians of the metric family prefix<n> (e.g. latency_ms@ctx3), indexed by n."""
+    sketches: dict = {}
+    for c in cells:
+        for m, sk in c.sketches.items():
+            if m.startswith(prefix):
+                sketches.setdefault(int(m[len(prefix):]), LogSketch()).merge(sk)
+    return pd.Series({k: s.quantile(0.5) for k, s in sketches.items()}, dtype="float64").sort_index()
+
+def fmt(v, spec: str = ".0f") -> str:
+    return format(v, spec) if v is not None else "—"
+
+df = load_hourly()
 
 if df.empty:
     st.info("No interactions recorded yet.")
@@ -45,36 +84,38 @@ if df.empty:
 # ======= Filtros globales =======
 with st.sidebar:
     st.header("Filters")
-    providers = ["All"] + sorted([x for x in df["provider"].dropna().unique()])
-    models = ["All"] + sorted([x for x in df["model"].dropna().unique()])
+    providers = ["All"] + sorted([x for x in df["provider"].unique() if x])
+    models = ["All"] + sorted([x for x in df["model"].unique() if x])
     provider_sel = st.selectbox("Provider", providers, index=0)
     model_sel = st.selectbox("Model", models, index=0)
-    date_min, date_max = st.date_input(
+    date_range = st.date_input(
         "Date range",
         value=(pd.to_datetime(df["date"]).min(), pd.to_datetime(df["date"]).max())
     )
+    date_min, date_max = (pd.Timestamp(d).strftime("%Y-%m-%d") for d in
+                          (date_range if len(date_range) == 2 else (date_range[0], date_range[0])))
 
-def within_date(s: str) -> bool:
-    if not s: return True
-    d = pd.to_datetime(s).date()
-    return (d >= date_min) and (d <= date_max)
-
-mask = df["date"].apply(within_date)
+mask = (df["date"] >= date_min) & (df["date"] <= date_max)
 if provider_sel != "All":
     mask &= df["provider"] == provider_sel
 if model_sel != "All":
     mask &= df["model"] == model_sel
-df_f = df[mask].copy()
+df_f = df[mask]
+cells = list(df_f["cell"])
+since = pd.Timestamp(date_min, tz="UTC").timestamp()
+until = (pd.Timestamp(date_max, tz="UTC") + pd.Timedelta(days=1)).timestamp()
 
 # ======= KPIs =======
+n_total = int(df_f["n"].sum())
+likes_total, dislikes_total = int(df_f["likes"].sum()), int(df_f["dislikes"].sum())
+lat = merged(cells, "latency_ms")
 c1, c2, c3, c4, c5 = st.columns(5)
-c1.metric("Interactions", len(df_f))
-c2.metric("👍 Likes", int((df_f["feedback"] == 1).sum()))
-c3.metric("👎 Dislikes", int((df_f["feedback"] == -1).sum()))
-fb_rate = (df_f["feedback"] != 0).mean() * 100 if len(df_f) else 0
+c1.metric("Interactions", n_total)
+c2.metric("👍 Likes", likes_total)
+c3.metric("👎 Dislikes", dislikes_total)
+fb_rate = (likes_total + dislikes_total) / n_total * 100 if n_total else 0
 c4.metric("Feedback rate", f"{fb_rate:.1f}%")
-lat_med = df_f["latency_ms"].median() if "latency_ms" in df_f.columns and len(df_f) else np.nan
-c5.metric("Median latency (ms)", f"{lat_med:.0f}" if pd.notna(lat_med) else "—")
+c5.metric("Median latency (ms)", fmt(lat.quantile(0.5)))
 
 st.divider()
 
@@ -82,15 +123,7 @@ st.divider()
 # 1) Time series: likes vs dislikes por día
 # ==========================================================
 st.subheader("1) Likes vs Dislikes over time")
-ts = (
-    df_f.groupby(["date","feedback"])["id"]
-    .count()
-    .reset_index()
-    .pivot(index="date", columns="feedback", values="id")
-    .fillna(0)
-    .rename(columns={-1:"Dislikes", 0:"No feedback", 1:"Likes"})
-    .sort_index()
-)
+ts = df_f.groupby("date")[["likes", "dislikes"]].sum().rename(columns={"likes": "Likes", "dislikes": "Dislikes"}).sort_index()
 if not ts.empty:
     st.line_chart(ts[["Likes","Dislikes"]])
 else:
@@ -103,11 +136,7 @@ st.subheader("2) Top queries by feedback")
 left, right = st.columns(2)
 
 # Likes
-top_likes = (
-    df_f[df_f["feedback"] == 1]
-    .groupby("query")["id"].count().sort_values(ascending=False).head(10)
-    .rename("Likes")
-)
+top_likes = top_queries(1, since, until, provider_sel, model_sel).rename("Likes")
 with left:
     st.markdown("**Most liked queries**")
     if not top_likes.empty:
@@ -116,11 +145,7 @@ with left:
         st.caption("No likes in current filter.")
 
 # Dislikes
-top_dislikes = (
-    df_f[df_f["feedback"] == -1]
-    .groupby("query")["id"].count().sort_values(ascending=False).head(10)
-    .rename("Dislikes")
-)
+top_dislikes = top_queries(-1, since, until, provider_sel, model_sel).rename("Dislikes")
 with right:
     st.markdown("**Most disliked queries**")
     if not top_dislikes.empty:
@@ -132,17 +157,12 @@ with right:
 # 3) Feedback rate by model/provider
 # ==========================================================
 st.subheader("3) Feedback rate by model / provider")
-grp = df_f.copy()
-grp["has_feedback"] = (grp["feedback"] != 0).astype(int)
-by_model = grp.groupby(["provider","model"]).agg(
-    interactions=("id","count"),
-    fb_rate=("has_feedback","mean"),
-    likes=("feedback", lambda s: (s==1).sum()),
-    dislikes=("feedback", lambda s: (s==-1).sum()),
-).reset_index()
+by_model = df_f.groupby(["provider","model"])[["n", "likes", "dislikes"]].sum().reset_index() \
+    .rename(columns={"n": "interactions"})
 if not by_model.empty:
     by_model_display = by_model.copy()
-    by_model_display["fb_rate"] = (by_model_display["fb_rate"]*100).round(1).astype(str) + "%"
+    by_model_display["fb_rate"] = ((by_model["likes"] + by_model["dislikes"]) / by_model["interactions"] * 100) \
+        .round(1).astype(str) + "%"
     st.dataframe(by_model_display, use_container_width=True, hide_index=True)
 else:
     st.caption("No data in current filter.")
@@ -151,10 +171,11 @@ else:
 # 4) Latency distribution
 # ==========================================================
 st.subheader("4) Latency distribution (ms)")
-lat_series = df_f["latency_ms"].dropna().astype(float)
-if not lat_series.empty:
-    st.bar_chart(lat_series, height=180)
-    st.caption(f"Median: {lat_series.median():.0f} ms • P90: {lat_series.quantile(0.9):.0f} ms")
+if lat.n:
+    hist = pd.Series(dict(lat.histogram()), name="interactions").rename_axis("latency_ms")
+    st.bar_chart(hist, height=180)
+    st.caption(f"Median: {fmt(lat.quantile(0.5))} ms • P90: {fmt(lat.quantile(0.9))} ms • "
+               f"P99: {fmt(lat.quantile(0.99))} ms (bars: lower bound in ms, log-spaced)")
 else:
     st.caption("No latency data in current filter.")
 
@@ -162,15 +183,81 @@ else:
 # 5) Context length vs latency (scatter-ish via binning)
 # ==========================================================
 st.subheader("5) Context length vs. latency (binned)")
-if "ctx_len" in df_f.columns and "latency_ms" in df_f.columns:
-    df_bin = df_f.dropna(subset=["ctx_len","latency_ms"]).copy()
-    if not df_bin.empty:
-        df_bin["ctx_len"] = df_bin["ctx_len"].astype(int)
-        agg = df_bin.groupby("ctx_len")["latency_ms"].median().reset_index()
-        agg = agg.sort_values("ctx_len")
-        st.line_chart(agg.set_index("ctx_len"))
-        st.caption("Median latency by number of context passages.")
-    else:
-        st.caption("No ctx_len/latency data in current filter.")
+agg = keyed_medians(cells, "latency_ms@ctx")
+if not agg.empty:
+    st.line_chart(agg.rename("latency_ms"))
+    st.caption("Median latency by number of context passages.")
+else:
+    st.caption("No ctx_len/latency data in current filter.")
+
+# ==========================================================
+# 6) Where generation time goes: prefill (prompt) vs decode (answer)
+# ==========================================================
+st.subheader("6) Generation time: prefill vs. decode")
+prefill, decode = merged(cells, "prefill_ms"), merged(cells, "decode_ms")
+if prefill.n and decode.n:
+    tps = merged(cells, "tokens_per_s")
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("Median prompt tokens", fmt(merged(cells, "prompt_tokens").quantile(0.5)))
+    k2.metric("Median prefill (ms)", fmt(prefill.quantile(0.5)))
+    k3.metric("Median decode (ms)", fmt(decode.quantile(0.5)))
+    k4.metric("Median tokens/s", fmt(tps.quantile(0.5), ".1f"))
+
+    left, right = st.columns(2)
+    with left:
+        st.markdown("**Median prefill / decode per day (ms)**")
+        by_day = pd.DataFrame({"prefill_ms": quantile_by(df_f, "date", "prefill_ms", 0.5),
+                               "decode_ms": quantile_by(df_f, "date", "decode_ms", 0.5)})
+        st.bar_chart(by_day)
+    with right:
+        st.markdown("**Decode speed over time (tokens/s, hourly median)**")
+        speed = quantile_by(df_f, "hour", "tokens_per_s", 0.5)
+        if not speed.empty:
+            st.line_chart(speed)
+        else:
+            st.caption("No tokens/s data in current filter.")
+
+    st.markdown("**Prompt size vs. prefill time (median per 256-token bin)**")
+    by_bin = pd.DataFrame({"prefill_ms": keyed_medians(cells, "prefill_ms@pbin"),
+                           "decode_ms": keyed_medians(cells, "decode_ms@pbin")})
+    if not by_bin.empty:
+        st.line_chart(by_bin)
+        st.caption("Prefill growing with the bin → long contexts; flat prefill with high decode → slow decoding.")
+else:
+    st.caption("No token accounting in current filter (recorded for generations since prompt/decode tracking was added).")
+
+# ==========================================================
+# 7) LLM scheduler queue wait
+# ==========================================================
+st.subheader("7) LLM queue wait (ms)")
+qw = merged(cells, "queue_wait_ms")
+if qw.n:
+    q1, q2, q3 = st.columns(3)
+    q1.metric("Median wait", f"{fmt(qw.quantile(0.5))} ms")
+    q2.metric("P95 wait", f"{fmt(qw.quantile(0.95))} ms")
+    q3.metric("Queued (> 10 ms)", f"{qw.fraction_above(10) * 100:.1f}%")
+    st.line_chart(quantile_by(df_f, "date", "queue_wait_ms", 0.95).rename("P95 queue wait (ms)"))
+    st.caption("Time spent waiting for a generation slot (LLM_MAX_CONCURRENT) before calling the model.")
+else:
+    st.caption("No queue wait data in current filter.")
+
+# ==========================================================
+# 8) Last hour, per minute
+# ==========================================================
+st.subheader("8) Last hour (per minute)")
+live = load_last_hour()
+if provider_sel != "All" and not live.empty:
+    live = live[live["provider"] == provider_sel]
+if model_sel != "All" and not live.empty:
+    live = live[live["model"] == model_sel]
+if not live.empty:
+    live = live.assign(minute=pd.to_datetime(live["bucket"], unit="s", utc=True).dt.strftime("%H:%M"))
+    left, right = st.columns(2)
+    with left:
+        st.markdown("**Requests per minute**")
+        st.bar_chart(live.groupby("minute")["n"].sum())
+    with right:
+        st.markdown("**P95 latency per minute (ms)**")
+        st.line_chart(quantile_by(live, "minute", "latency_ms", 0.95).rename("P95 latency (ms)"))
 else:
-    st.caption("ctx_len / latency columns not found.")
+    st.caption("No interactions in the last hour.")
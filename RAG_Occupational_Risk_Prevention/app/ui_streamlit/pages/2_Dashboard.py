@@ -6,7 +6,7 @@ import streamlit as st
 ROOT = pathlib.Path(__file__).resolve().parents[3]  # .../rag-prl
 sys.path.append(str(ROOT))
 
-from monitoring.logger import recent, DB_PATH  # DB_PATH is useful to show the DB location
+from monitoring.logger import count_interactions, search_interactions, DB_PATH  # DB_PATH is useful to show the DB location
 
 st.set_page_config(page_title="RAG-PRL — Dashboard", page_icon="📊", layout="wide")
 st.title("📊 Interaction Dashboard")
@@ -24,53 +24,28 @@ with col_q:
 with col_fb:
     fb_filter = st.selectbox("Filter by feedback", options=["All", "👍 Like", "👎 Dislike", "No feedback"])
 
-# Load recent data
-rows = recent(300)  # fetch more to allow filtering
-if not rows:
+# Filters run in SQL; the KPIs come from the telemetry rollups (monitoring/rollups.py)
+FB_FILTERS = {"All": None, "👍 Like": 1, "👎 Dislike": -1, "No feedback": 0}
+rows_f = search_interactions(q_filter.strip(), FB_FILTERS[fb_filter], limit=300)
+if not rows_f and not q_filter and fb_filter == "All":
     st.info("No interactions recorded yet.")
     st.caption(f"DB path: {DB_PATH.resolve()}")
 else:
-    # Apply filters
     def norm_fb(v):
         # Normalize feedback to int: 1 / -1 / 0
-        if v is None:
-            return 0
         try:
-            return int(v)
-        except Exception:
-            # handle strings like "1", "-1", "0", or anything odd
-            s = str(v).strip()
-            if s in {"1", "+1"}:
-                return 1
-            if s in {"-1"}:
-                return -1
+            return int(v or 0)
+        except (TypeError, ValueError):
             return 0
 
-    def match_row(r):
-        ok_q = (q_filter.lower() in r.get("query", "").lower()) if q_filter else True
-        fbi = norm_fb(r.get("feedback"))
-        if fb_filter == "👍 Like":
-            ok_fb = (fbi == 1)
-        elif fb_filter == "👎 Dislike":
-            ok_fb = (fbi == -1)
-        elif fb_filter == "No feedback":
-            ok_fb = (fbi == 0)
-        else:
-            ok_fb = True
-        return ok_q and ok_fb
-
-    rows_f = [r for r in rows if match_row(r)]
-
     # KPIs
-    total = len(rows_f)
-    likes = sum(1 for r in rows_f if norm_fb(r.get("feedback")) == 1)
-    dislikes = sum(1 for r in rows_f if norm_fb(r.get("feedback")) == -1)
+    totals = count_interactions(q_filter.strip(), FB_FILTERS[fb_filter])
 
     col1, col2, col3, col4 = st.columns(4)
-    col1.metric("Interactions (filtered)", total)
-    col2.metric("👍 Likes", likes)
-    col3.metric("👎 Dislikes", dislikes)
-    col4.caption(f"DB: {DB_PATH.resolve()}")
+    col1.metric("Interactions (filtered)", totals["interactions"])
+    col2.metric("👍 Likes", totals["likes"])
+    col3.metric("👎 Dislikes", totals["dislikes"])
+    col4.caption(f"DB: {DB_PATH.resolve()} • showing the latest {len(rows_f)}")
 
     # Nice table + CSV download
     def fmt_ts(ts): return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
@@ -93,7 +68,7 @@ else:
     st.dataframe(table, use_container_width=True, hide_index=True)
 
     # Download CSV
-    if st.button("⬇️ Download CSV (filtered)"):
+    if st.button("⬇️ Download CSV (filtered)") and table:
         output = io.StringIO()
         writer = csv.DictWriter(output, fieldnames=list(table[0].keys()))
         writer.writeheader()
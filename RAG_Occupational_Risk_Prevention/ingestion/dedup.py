@@ -0,0 +1,110 @@
+# ingestion/dedup.py
+"""
+Near-duplicate chunk detection with MinHash + LSH banding (single pass, ~linear time).
+
+Each chunk is shingled into word n-grams, summarized by a MinHash signature and bucketed
+band by band. Only chunks sharing a bucket with an already kept (canonical) chunk are
+compared, and a chunk is a duplicate when the estimated Jaccard similarity of the shingle
+sets is >= threshold. Canonical chunks remember the sources of their duplicates.
+"""
+from __future__ import annotations
+import hashlib
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+def _hash32(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+
+def shingles(tokens: Sequence[str], size: int = 5) -> set:
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows) with bands*rows <= num_perm minimizing false positives + false negatives around threshold."""
+    def prob(s: float, b: int, r: int) -> float:
+        return 1.0 - (1.0 - s ** r) ** b
+
+    def integrate(f, a: float, z: float, steps: int = 50) -> float:
+        h = (z - a) / steps
+        return sum(f(a + (i + 0.5) * h) for i in range(steps)) * h
+
+    best, best_err = (1, num_perm), math.inf
+    for b in range(1, num_perm + 1):
+        for r in range(1, num_perm // b + 1):
+            fp = integrate(lambda s: prob(s, b, r), 0.0, threshold)
+            fn = integrate(lambda s: 1.0 - prob(s, b, r), threshold, 1.0)
+            if fp + fn < best_err:
+                best, best_err = (b, r), fp + fn
+    return best
+
+
+class MinHashDeduper:
+    """
+    Streaming near-duplicate filter:
+
+        dd = MinHashDeduper(threshold=0.85)
+        for rec in records:
+            if dd.add(rec["source"], rec["tokens"]) is None:
+                keep(rec)                       # canonical
+        dd.duplicates                           # canonical source -> [duplicate sources]
+    """
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, shingle_size: int = 5, seed: int = 1) -> None:
+        assert 0.0 < threshold <= 1.0
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, int]] = [dict() for _ in range(self.bands)]
+        self._signatures: List[np.ndarray] = []   # canonical chunks only
+        self._sources: List[str] = []
+        self.duplicates: Dict[str, List[str]] = {}
+        self.seen = 0
+
+    def signature(self, tokens: Sequence[str]) -> np.ndarray:
+        sh = shingles(tokens, self.shingle_size)
+        if not sh:
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        hv = np.fromiter((_hash32(s) for s in sh), dtype=np.uint64, count=len(sh))
+        # (a*x + b) mod p, truncated to 32 bits; a, x < 2^32 so the product fits in uint64
+        ph = ((np.outer(hv, self._a) + self._b) % _MERSENNE_PRIME) & _MAX_HASH
+        return ph.min(axis=0)
+
+    def add(self, source: str, tokens: Sequence[str]) -> Optional[str]:
+        """Returns the canonical source if `source` is a near-duplicate of a kept chunk, else None (kept)."""
+        self.seen += 1
+        sig = self.signature(tokens)
+        keys = [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+        checked = set()
+        for band, key in enumerate(keys):
+            j = self._buckets[band].get(key)
+            if j is None or j in checked:
+                continue
+            checked.add(j)
+            if float(np.mean(self._signatures[j] == sig)) >= self.threshold:
+                canonical = self._sources[j]
+                self.duplicates.setdefault(canonical, []).append(source)
+                return canonical
+
+        idx = len(self._signatures)
+        self._signatures.append(sig)
+        self._sources.append(source)
+        for band, key in enumerate(keys):
+            self._buckets[band].setdefault(key, idx)
+        return None
+
+    @property
+    def kept(self) -> int:
+        return len(self._signatures)
+
+    def reduction_ratio(self) -> float:
+        return (1.0 - self.kept / self.seen) if self.seen else 0.0
@@ -1,6 +1,7 @@
 
 import argparse, pathlib, json, re
-from pypdf import PdfReader
+from functools import partial
+from ingestion.pdf_backends import extract_best
 from bs4 import BeautifulSoup
 from retrieval.utils import tokenize
 
@@ -9,11 +10,11 @@ def clean_text(s: str) -> str:
     return s.strip()
 
 def parse_pdf(path: pathlib.Path) -> str:
-    text = []
-    r = PdfReader(str(path))
-    for page in r.pages:
-        text.append(page.extract_text() or "")
-    return clean_text(" \n".join(text))
+    # no OCR in this flow: a text layer below the quality guard is still better than nothing
+    text, used, passed = extract_best(path)
+    if not passed and text.strip():
+        print(f"[WARN] {path.name}: sparse text layer ({used}), indexing it as is")
+    return clean_text(text)
 
 def parse_html(path: pathlib.Path) -> str:
     html = path.read_text(encoding="utf-8", errors="ignore")
@@ -32,50 +33,44 @@ def chunk_text(text: str, chunk_size: int, overlap: int):
         i += max(1, chunk_size - overlap)
     return chunks
 
-def main(args):
-    raw = pathlib.Path("data/raw")
-    kb_bm25 = pathlib.Path("data/kb/bm25.jsonl")
-    kb_bm25.parent.mkdir(parents=True, exist_ok=True)
+def parse_any(p: pathlib.Path) -> str:
+    if p.suffix.lower() == ".pdf":
+        return parse_pdf(p)
+    if p.suffix.lower() in {".html", ".htm"}:
+        return parse_html(p)
+    return clean_text(p.read_text(encoding="utf-8", errors="ignore"))
 
-    entries = []
-    for p in raw.rglob("*"):
-        if p.is_file() and p.suffix.lower() in {".pdf", ".html", ".htm", ".txt"}:
-            try:
-                if p.suffix.lower() == ".pdf":
-                    txt = parse_pdf(p)
-                elif p.suffix.lower() in {".html", ".htm"}:
-                    txt = parse_html(p)
-                else:
-                    txt = clean_text(p.read_text(encoding="utf-8", errors="ignore"))
-                chunks = chunk_text(txt, args.chunk_size, args.overlap)
-                for j, ch in enumerate(chunks):
-                    entries.append({"text": ch, "tokens": tokenize(ch), "source": f"{p.name}#chunk{j}", "meta": {"file": p.name}})
-            except Exception as e:
-                print(f"[WARN] Processing error {p}: {e}")
+def to_entries(p: pathlib.Path, txt: str, chunk_size: int, overlap: int):
+    chunks = chunk_text(txt, chunk_size, overlap)
+    return [{"text": ch, "tokens": tokenize(ch), "source": f"{p.name}#chunk{j}", "meta": {"file": p.name}}
+            for j, ch in enumerate(chunks)]
 
-    with open(kb_bm25, "w", encoding="utf-8") as f:
-        for e in entries:
-            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+def main(args):
+    # Stream files through parse -> chunk -> embed -> write instead of accumulating all entries in memory.
+    from ingestion.pipeline import run_pipeline, print_stage_report
 
-    # También indexamos en Chroma
+    persist_dir = None if args.no_vectors else "data/chroma"
     try:
-        import chromadb
-        from chromadb.utils import embedding_functions
-        client = chromadb.Client()
-        model = "intfloat/multilingual-e5-small"
-        embedder = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model)
-        col = client.get_or_create_collection("osha", embedding_function=embedder)
-        ids = [str(i) for i in range(len(entries))]
-        docs = [e["text"] for e in entries]
-        metas = [{"source": e["source"], **e.get("meta", {})} for e in entries]
-        if len(ids) > 0:
-            col.add(ids=ids, documents=docs, metadatas=metas)
-        print(f"Indexed {len(entries)} chunks into BM25 and Chroma")
+        res = run_pipeline(
+            raw_dir="data/raw",
+            kb_out="data/kb/bm25.jsonl",
+            persist_dir=persist_dir,
+            collection="osha",
+            parse_fn=parse_any,
+            chunk_fn=partial(to_entries, chunk_size=args.chunk_size, overlap=args.overlap),
+            parse_workers=args.workers,
+            processes=True,
+        )
     except Exception as e:
-        print(f"[WARN] Failed to index into Chroma: {e}")
+        print(f"[WARN] Failed to index: {e}")
+        return
+    print_stage_report(res["stages"])
+    print(f"Indexed {res['chunks']} chunks into BM25" + (" and Chroma" if persist_dir else ""))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--chunk_size", type=int, default=800)
     parser.add_argument("--overlap", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=2, help="Parallel parse workers")
+    parser.add_argument("--no_vectors", action="store_true", help="Only write the BM25 JSONL")
     main(parser.parse_args())
@@ -1,23 +1,72 @@
 from __future__ import annotations
 import argparse
+import threading
+import time
+from typing import Dict
 from retrieval.vector_client import VectorClient
 
+def blue_green_reindex(
+    vc: VectorClient,
+    kb_jsonl: str,
+    batch_size: int = 512,
+    keep_versions: int = 2,
+    smoke_query: str = "safety",
+) -> Dict:
+    """
+    Zero-downtime rebuild: index into a new version (alias.vN+1) while the current one keeps
+    serving, smoke-test it, switch the alias atomically and garbage-collect old versions.
+    If indexing or the smoke test fails the alias is left untouched and the new version dropped
+    (build_version deletes a failed build itself).
+    """
+    t0 = time.time()
+    previous = vc.resolve()
+    name, n = vc.build_version(kb_jsonl, batch_size=batch_size)
+    try:
+        vc.smoke_test(name, expected=n, probe_query=smoke_query)
+    except Exception:
+        vc.client.delete_collection(name)
+        raise
+    vc.swap_alias(name)
+    removed = vc.gc_versions(keep=keep_versions)
+    return {"collection": name, "previous": previous, "indexed": n, "removed": removed,
+            "seconds": round(time.time() - t0, 1)}
+
+def start_background_reindex(vc: VectorClient, kb_jsonl: str, **kwargs) -> threading.Thread:
+    """Run blue_green_reindex in a daemon thread (e.g. from a serving process); the result or
+    error is stored on the thread as `.result` / `.error`."""
+    def run():
+        try:
+            t.result = blue_green_reindex(vc, kb_jsonl, **kwargs)
+        except Exception as e:
+            t.error = e
+    t = threading.Thread(target=run, name="blue-green-reindex", daemon=True)
+    t.result, t.error = None, None
+    t.start()
+    return t
+
 def main():
     ap = argparse.ArgumentParser(description="Index JSONL KB chunks into Chroma.")
     ap.add_argument("--kb_jsonl", default="data/kb/bm25.jsonl")
     ap.add_argument("--persist_dir", default="data/chroma")
-    ap.add_argument("--collection", default="osha")
+    ap.add_argument("--collection", default="osha", help="Collection or alias name")
     ap.add_argument("--batch_size", type=int, default=512)
-    ap.add_argument("--reset", action="store_true", help="Clear the collection before indexing")
+    ap.add_argument("--reset", action="store_true",
+                    help="Rebuild from scratch as a new version (blue/green) and switch the alias when it is ready")
+    ap.add_argument("--keep_versions", type=int, default=2, help="With --reset: versions kept after the switch")
+    ap.add_argument("--smoke_query", default="safety", help="With --reset: probe query the new version must answer")
     args = ap.parse_args()
 
     vc = VectorClient(persist_dir=args.persist_dir, collection=args.collection)
     if args.reset:
-        vc.reset_collection()
+        res = blue_green_reindex(vc, args.kb_jsonl, batch_size=args.batch_size,
+                                 keep_versions=args.keep_versions, smoke_query=args.smoke_query)
+        print(f"✅ Indexed {res['indexed']} chunks into {res['collection']} in {res['seconds']}s; "
+              f"alias '{args.collection}' switched from {res['previous']}"
+              + (f"; removed {', '.join(res['removed'])}" if res["removed"] else ""))
+        return
 
     n = vc.index_from_jsonl(args.kb_jsonl, batch_size=args.batch_size)
-    print(f"✅ Indexed {n} chunks into Chroma → {args.persist_dir} (collection='{args.collection}')")
+    print(f"✅ Indexed {n} chunks into Chroma → {args.persist_dir} (collection='{vc.col.name}')")
 
 if __name__ == "__main__":
     main()
-
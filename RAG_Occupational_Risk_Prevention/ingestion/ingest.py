@@ -3,15 +3,22 @@
 # PDFs with text layer or automatic OCR
 #python -m ingestion.ingest --raw_dir docs --kb_out data/kb/bm25.jsonl
 
+# Streaming pipeline (parse/chunk/embed/write run concurrently) + Chroma indexing in one pass
+#python -m ingestion.ingest --raw_dir docs --kb_out data/kb/bm25.jsonl --stream --persist_dir data/chroma --collection osha
+
 # Force OCR (if you know they are scanned)
 #python -m ingestion.ingest --raw_dir docs --kb_out data/kb/bm25.jsonl --force_ocr
 #python -m ingestion.index_vectors --kb_jsonl data/kb/bm25.jsonl --persist_dir data/chroma --collection osha
 
+# Append new/edited files to the served segmented BM25 index (no rebuild; the API/UI reload it)
+#python -m ingestion.ingest --raw_dir data/new --append_bm25_index data/kb/bm25_segments
+
 from __future__ import annotations
 import argparse
 import json
 import os
 import re
+import time
 from pathlib import Path
 from typing import List, Iterable, Dict, Optional
 
@@ -47,15 +54,15 @@ def infer_year(filename: str) -> Optional[int]:
 
 # ---------- File parsing (text/HTML/PDF with OCR fallback) ----------
 
-def parse_pdf_textlayer(path: Path) -> str:
-    """Extract text from PDFs with text layer (pypdf). If it fails, return ''. """
+def parse_pdf_textlayer(path: Path, backend: Optional[str] = None) -> str:
+    """
+    Extract text from PDFs with text layer (see ingestion.pdf_backends: pypdf / PyMuPDF / pdfminer,
+    'auto' by default or env PDF_BACKEND). If it fails or the text layer is too poor, return ''.
+    """
     try:
-        from pypdf import PdfReader
-        txt_parts: List[str] = []
-        reader = PdfReader(str(path))
-        for page in reader.pages:
-            txt_parts.append(page.extract_text() or "")
-        return clean_text(" ".join(txt_parts))
+        from ingestion.pdf_backends import extract_pdf_text
+        txt, _ = extract_pdf_text(path, backend=backend)
+        return clean_text(txt)
     except Exception:
         return ""
 
@@ -78,11 +85,23 @@ def parse_pdf_ocr(path: Path, dpi: int = 200, lang: str = "eng") -> str:
 def parse_pdf(path: Path, force_ocr: bool = False) -> str:
     if force_ocr:
         return parse_pdf_ocr(path)
-    txt = parse_pdf_textlayer(path)
-    if txt.strip():
+    try:
+        from ingestion.pdf_backends import extract_best
+        txt, _, passed = extract_best(path)
+        txt = clean_text(txt)
+    except Exception:
+        txt, passed = "", False
+    if passed and txt.strip():
+        return txt
+    # No text layer, or too poor to pass the quality guard: fallback to OCR
+    try:
+        ocr = parse_pdf_ocr(path)
+    except RuntimeError as e:
+        if not txt.strip():
+            raise
+        print(f"[WARN] {e}; indexing its sparse text layer instead")
         return txt
-    # If no text, fallback to OCR
-    return parse_pdf_ocr(path)
+    return ocr if ocr.strip() else txt
 
 def parse_html(path: Path) -> str:
     from bs4 import BeautifulSoup
@@ -143,6 +162,21 @@ def iter_raw_files(raw_dir: Path) -> Iterable[Path]:
         if p.is_file() and p.suffix.lower() in {".pdf", ".html", ".htm", ".txt"}:
             yield p
 
+def chunk_records(path: Path, text: str, max_tokens: int = 220, overlap: int = 40) -> List[Dict]:
+    """Chunk one parsed document into KB records (the JSONL schema consumed by BM25/Chroma)."""
+    chunks = chunk_text_tokens(text, max_tokens=max_tokens, overlap=overlap)
+    fam = infer_family(path.name)
+    yr = infer_year(path.name)
+    return [
+        {
+            "text": ch,
+            "tokens": tokenize_words(ch),
+            "source": f"{path.name}#chunk{j}",
+            "meta": {"file": path.name, "family": fam, "year": yr},
+        }
+        for j, ch in enumerate(chunks)
+    ]
+
 def build_kb(
     raw_dir: str | Path = "data/raw",
     kb_out: str | Path = "data/kb/bm25.jsonl",
@@ -150,41 +184,124 @@ def build_kb(
     overlap: int = 40,
     force_ocr: bool = False,
     verbose: bool = True,
+    dedup: bool = False,
+    dedup_threshold: float = 0.85,
+    bm25_index_dir: Optional[str | Path] = None,
+    bm25_workers: Optional[int] = None,
 ) -> int:
     """
     Read files from raw_dir, create chunks and write JSONL for BM25:
     {"text": str, "tokens": List[str], "source": str, "meta": dict}
+    dedup: drop near-duplicate chunks (MinHash LSH, see ingestion/dedup.py). The kept chunk lists
+    the sources of its duplicates in meta["duplicates"], so citations can still point to them.
+    bm25_index_dir: also build the segmented BM25 index there, in parallel (retrieval/bm25_builder.py).
     Returns number of chunks written.
     """
     raw_dir = Path(raw_dir)
     kb_out = Path(kb_out)
     kb_out.parent.mkdir(parents=True, exist_ok=True)
 
+    deduper = None
+    dedup_s = 0.0
+    if dedup:
+        from ingestion.dedup import MinHashDeduper
+        deduper = MinHashDeduper(threshold=dedup_threshold)
+    # with dedup, canonical chunks go to a temp file first; back-references are added at the end
+    out_path = kb_out.with_name(kb_out.name + ".tmp") if deduper else kb_out
+
     count = 0
-    with kb_out.open("w", encoding="utf-8") as f:
+    with out_path.open("w", encoding="utf-8") as f:
         for path in iter_raw_files(raw_dir):
             try:
                 text = parse_file(path, force_ocr=force_ocr)
                 if verbose:
                     print(f"[INFO] {path.name}: {len(text)} chars")
-                chunks = chunk_text_tokens(text, max_tokens=max_tokens, overlap=overlap)
+                records = chunk_records(path, text, max_tokens=max_tokens, overlap=overlap)
                 if verbose:
-                    print(f"[INFO] {path.name}: {len(chunks)} chunks")
-                fam = infer_family(path.name)
-                yr = infer_year(path.name)
-                for j, ch in enumerate(chunks):
-                    obj = {
-                        "text": ch,
-                        "tokens": tokenize_words(ch),
-                        "source": f"{path.name}#chunk{j}",
-                        "meta": {"file": path.name, "family": fam, "year": yr},
-                    }
+                    print(f"[INFO] {path.name}: {len(records)} chunks")
+                for obj in records:
+                    if deduper is not None:
+                        t0 = time.perf_counter()
+                        dup_of = deduper.add(obj["source"], obj["tokens"])
+                        dedup_s += time.perf_counter() - t0
+                        if dup_of is not None:
+                            continue
                     f.write(json.dumps(obj, ensure_ascii=False) + "\n")
                     count += 1
             except Exception as e:
                 print(f"[WARN] {path}: {e}")
+
+    if deduper is not None:
+        _attach_duplicates(out_path, kb_out, deduper.duplicates)
+        if verbose:
+            rate = deduper.seen / dedup_s if dedup_s > 0 else 0.0
+            print(f"[INFO] dedup: {deduper.seen} → {deduper.kept} chunks "
+                  f"({deduper.reduction_ratio() * 100:.1f}% removed, {rate:.0f} chunks/s)")
+    if bm25_index_dir and count:
+        from retrieval.bm25_builder import build_index
+        build_index(kb_out, bm25_index_dir, workers=bm25_workers, verbose=verbose)
     return count
 
+def append_bm25_index(
+    raw_dir: str | Path,
+    index_dir: str | Path = "data/kb/bm25_segments",
+    max_tokens: int = 220,
+    overlap: int = 40,
+    force_ocr: bool = False,
+    verbose: bool = True,
+    delete_files: Iterable[str] = (),
+) -> Dict:
+    """
+    Incremental ingestion into the served segmented BM25 index: each file in raw_dir replaces
+    the chunks it had (an edited file's stale chunks are deleted), `delete_files` (file names)
+    are removed, then segments are merged and the index is checkpointed. Serving processes
+    pick the new manifest up on their next query. Takes the index's writer lock for the whole
+    run, so it fails (IndexLocked) while a build or another append owns the directory.
+    """
+    from retrieval.segmented_bm25 import SegmentedBM25
+    added = removed = 0
+    with SegmentedBM25.open(index_dir, writer=True) as idx:
+        by_file: Dict[str, List[str]] = {}
+        for source in idx.sources():
+            by_file.setdefault(source.split("#", 1)[0], []).append(source)
+
+        for name in delete_files:
+            for source in by_file.pop(name, []):
+                removed += idx.delete(source)
+        for path in iter_raw_files(Path(raw_dir)):
+            try:
+                text = parse_file(path, force_ocr=force_ocr)
+                records = chunk_records(path, text, max_tokens=max_tokens, overlap=overlap)
+            except Exception as e:
+                print(f"[WARN] {path}: {e}")
+                continue
+            fresh = {r["source"] for r in records}
+            for source in by_file.pop(path.name, []):
+                if source not in fresh:
+                    removed += idx.delete(source)
+            added += idx.add_many(records)
+            if verbose:
+                print(f"[INFO] {path.name}: {len(records)} chunks")
+
+        while idx.merge():
+            pass
+        idx.checkpoint()
+        stats = idx.stats()
+    stats.update(added=added, removed=removed)
+    if verbose:
+        print(f"[INFO] BM25 append: +{added} / -{removed} chunks → {stats['live_docs']} live in {stats['segments']} segments")
+    return stats
+
+def _attach_duplicates(src: Path, dst: Path, duplicates: Dict[str, List[str]]) -> None:
+    with src.open("r", encoding="utf-8") as fi, dst.open("w", encoding="utf-8") as fo:
+        for line in fi:
+            obj = json.loads(line)
+            dups = duplicates.get(obj["source"])
+            if dups:
+                obj["meta"]["duplicates"] = dups
+            fo.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    src.unlink()
+
 # ---------- CLI ----------
 
 def main():
@@ -195,8 +312,52 @@ def main():
     ap.add_argument("--overlap", type=int, default=40)
     ap.add_argument("--force_ocr", action="store_true", help="Force OCR for PDFs (ignore text layer)")
     ap.add_argument("--quiet", action="store_true", help="Less logging")
+    ap.add_argument("--dedup", action="store_true", help="Drop near-duplicate chunks (MinHash LSH)")
+    ap.add_argument("--dedup_threshold", type=float, default=0.85, help="Estimated Jaccard similarity to treat as duplicate")
+    ap.add_argument("--bm25_index_dir", default=None, help="Also build the segmented BM25 index here (parallel build)")
+    ap.add_argument("--bm25_workers", type=int, default=None, help="Processes for the BM25 index build (default: all cores)")
+    ap.add_argument("--append_bm25_index", default=None,
+                    help="Add/replace raw_dir's files in this served segmented BM25 index instead of rebuilding the KB")
+    ap.add_argument("--delete_files", nargs="*", default=[], help="With --append_bm25_index: file names to remove")
+    ap.add_argument("--stream", action="store_true", help="Use the concurrent streaming pipeline (ingestion.pipeline)")
+    ap.add_argument("--persist_dir", default=None, help="With --stream: also embed + index chunks into this Chroma dir")
+    ap.add_argument("--collection", default="osha")
+    ap.add_argument("--parse_workers", type=int, default=2)
     args = ap.parse_args()
 
+    if args.append_bm25_index:
+        stats = append_bm25_index(
+            raw_dir=args.raw_dir,
+            index_dir=args.append_bm25_index,
+            max_tokens=args.max_tokens,
+            overlap=args.overlap,
+            force_ocr=args.force_ocr,
+            verbose=not args.quiet,
+            delete_files=args.delete_files,
+        )
+        print(f"✅ BM25 index updated (+{stats['added']} / -{stats['removed']} chunks) → {args.append_bm25_index}")
+        return
+
+    if args.stream and args.dedup:
+        print("[WARN] --dedup is only applied by the non-streaming build; ignoring it with --stream")
+    if args.stream:
+        from functools import partial
+        from ingestion.pipeline import run_pipeline, print_stage_report
+        res = run_pipeline(
+            raw_dir=args.raw_dir,
+            kb_out=args.kb_out,
+            persist_dir=args.persist_dir,
+            collection=args.collection,
+            parse_fn=partial(parse_file, force_ocr=args.force_ocr),
+            chunk_fn=partial(chunk_records, max_tokens=args.max_tokens, overlap=args.overlap),
+            parse_workers=args.parse_workers,
+            processes=True,
+            verbose=not args.quiet,
+        )
+        print_stage_report(res["stages"])
+        print(f"✅ KB created with {res['chunks']} chunks → {args.kb_out}")
+        return
+
     n = build_kb(
         raw_dir=args.raw_dir,
         kb_out=args.kb_out,
@@ -204,6 +365,10 @@ def main():
         overlap=args.overlap,
         force_ocr=args.force_ocr,
         verbose=not args.quiet,
+        dedup=args.dedup,
+        dedup_threshold=args.dedup_threshold,
+        bm25_index_dir=args.bm25_index_dir,
+        bm25_workers=args.bm25_workers,
     )
     print(f"✅ KB created with {n} chunks → {args.kb_out}")
 
@@ -0,0 +1,126 @@
+# ingestion/pdf_backends.py
+"""
+Text-layer PDF extraction backends (pypdf, PyMuPDF, pdfminer.six) behind one registry.
+
+    pages = extract_pages(path, backend="pymupdf")      # one string per page
+    text, used = extract_pdf_text(path)                 # backend="auto"
+    text, used, passed = extract_best(path)             # same, keeps a poor text layer
+
+"auto" tries the available backends fastest first and keeps the first result that passes
+the quality guard (enough characters per page, mostly readable characters); otherwise it
+falls back to the next backend. When none passes, extract_pdf_text returns '' and
+extract_best the richest text with passed=False, so the caller can OCR and fall back to it.
+PDF_BACKEND overrides the choice ("auto" by default).
+"""
+from __future__ import annotations
+import importlib.util
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+# name -> (module to probe, extractor returning one text per page)
+_BACKENDS: Dict[str, Tuple[str, Callable[[Path], List[str]]]] = {}
+
+# Order used by "auto", fastest first (scripts/bench_pdf_backends.py: PyMuPDF >> pypdf > pdfminer)
+AUTO_ORDER = ["pymupdf", "pypdf", "pdfminer"]
+
+def register_backend(name: str, module: str):
+    """Decorator: register an extractor `fn(path) -> List[str]` available when `module` is importable."""
+    def deco(fn: Callable[[Path], List[str]]):
+        _BACKENDS[name] = (module, fn)
+        return fn
+    return deco
+
+@register_backend("pypdf", "pypdf")
+def _extract_pypdf(path: Path) -> List[str]:
+    from pypdf import PdfReader
+    reader = PdfReader(str(path))
+    return [page.extract_text() or "" for page in reader.pages]
+
+@register_backend("pymupdf", "pymupdf")
+def _extract_pymupdf(path: Path) -> List[str]:
+    import pymupdf
+    with pymupdf.open(str(path)) as doc:
+        return [page.get_text("text") or "" for page in doc]
+
+@register_backend("pdfminer", "pdfminer")
+def _extract_pdfminer(path: Path) -> List[str]:
+    from pdfminer.high_level import extract_text
+    # pdfminer separates pages with form feeds; the last element is the trailing remainder
+    pages = (extract_text(str(path)) or "").split("\f")
+    if len(pages) > 1 and not pages[-1].strip():
+        pages = pages[:-1]
+    return pages
+
+def available_backends() -> List[str]:
+    return [name for name, (mod, _) in _BACKENDS.items() if importlib.util.find_spec(mod) is not None]
+
+def extract_pages(path: str | Path, backend: str) -> List[str]:
+    if backend not in _BACKENDS:
+        raise ValueError(f"Unknown PDF backend: {backend} (known: {', '.join(_BACKENDS)})")
+    return _BACKENDS[backend][1](Path(path))
+
+# ---------- Quality guard ----------
+
+def text_quality(pages: List[str]) -> Dict[str, float]:
+    """chars per page and share of readable characters (letters, digits, whitespace, punctuation)."""
+    text = "".join(pages)
+    n = len(text)
+    readable = len(re.findall(r"[\w\s.,;:()\-'\"%/§]", text, flags=re.UNICODE))
+    return {
+        "chars": float(n),
+        "chars_per_page": n / max(1, len(pages)),
+        "readable_ratio": (readable / n) if n else 0.0,
+    }
+
+def passes_quality(pages: List[str], min_chars_per_page: float = 200.0, min_readable: float = 0.85) -> bool:
+    q = text_quality(pages)
+    return q["chars_per_page"] >= min_chars_per_page and q["readable_ratio"] >= min_readable
+
+# ---------- Auto selection ----------
+
+def extract_best(
+    path: str | Path,
+    backend: Optional[str] = None,
+    min_chars_per_page: float = 200.0,
+) -> Tuple[str, str, bool]:
+    """
+    Returns (text, backend_used, passed). Pages are joined with a blank line.
+    backend: a registered name or "auto" (default: env PDF_BACKEND, else "auto"); an explicit
+    backend is taken as is (passed=True).
+    With "auto", the first extraction that passes the quality guard; if none does, the richest
+    one with passed=False (possibly ''), so the caller can OCR and still keep it as a fallback.
+    """
+    backend = (backend or os.getenv("PDF_BACKEND") or "auto").lower()
+    if backend != "auto":
+        return "\n\n".join(extract_pages(path, backend)), backend, True
+
+    avail = available_backends()
+    candidates = [b for b in AUTO_ORDER if b in avail] + [b for b in avail if b not in AUTO_ORDER]
+    best: Tuple[str, str, bool] = ("", "", False)
+    best_score = -1.0
+    for name in candidates:
+        try:
+            pages = extract_pages(path, name)
+        except Exception:
+            continue  # broken/encrypted for this parser: try the next one
+        if passes_quality(pages, min_chars_per_page=min_chars_per_page):
+            return "\n\n".join(pages), name, True
+        q = text_quality(pages)
+        score = q["chars"] * q["readable_ratio"]
+        if score > best_score:
+            best, best_score = ("\n\n".join(pages), name, False), score
+    return best
+
+def extract_pdf_text(
+    path: str | Path,
+    backend: Optional[str] = None,
+    min_chars_per_page: float = 200.0,
+) -> Tuple[str, str]:
+    """
+    Returns (text, backend_used); see extract_best. With "auto", if no backend passes the
+    quality guard ('', '') is returned (callers that OCR use extract_best to keep a fallback).
+    """
+    text, used, passed = extract_best(path, backend, min_chars_per_page)
+    return (text, used) if passed else ("", "")
@@ -0,0 +1,333 @@
+# Execution:
+
+# Streaming ingestion (BM25 KB only)
+#python -m ingestion.pipeline --raw_dir data/raw --kb_out data/kb/bm25.jsonl
+
+# Streaming ingestion + Chroma indexing, parsing in 4 processes
+#python -m ingestion.pipeline --raw_dir data/raw --kb_out data/kb/bm25.jsonl --persist_dir data/chroma --collection osha --parse_workers 4 --processes
+
+from __future__ import annotations
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from ingestion.ingest import chunk_records, iter_raw_files, parse_file
+
+# Sentinel that travels down the queues once a stage has no more input
+_DONE = object()
+
+# ---------- Per-stage statistics ----------
+
+class StageStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_s = 0.0
+        self.t_start: Optional[float] = None
+        self.t_end: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record(self, n_out: int, busy_s: float) -> None:
+        with self._lock:
+            self.items_in += 1
+            self.items_out += n_out
+            self.busy_s += busy_s
+
+    @property
+    def wall_s(self) -> float:
+        if self.t_start is None:
+            return 0.0
+        return (self.t_end or time.perf_counter()) - self.t_start
+
+    def as_dict(self) -> Dict:
+        wall = self.wall_s
+        return {
+            "stage": self.name,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "busy_s": round(self.busy_s, 3),
+            "wall_s": round(wall, 3),
+            "items_per_s": round(self.items_in / wall, 2) if wall > 0 else 0.0,
+        }
+
+# ---------- Stages ----------
+
+class Stage:
+    """
+    One pipeline stage: `workers` threads pull items from `q_in`, call fn(item) -> iterable of
+    outputs and push them to `q_out` (bounded, so a slow consumer throttles its producers).
+    `finish` (single-worker stages only) is called once input is exhausted, e.g. to flush a batch.
+    """
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[object], Iterable],
+        workers: int = 1,
+        finish: Optional[Callable[[], Iterable]] = None,
+    ) -> None:
+        assert workers >= 1
+        assert finish is None or workers == 1, "finish() needs a single worker"
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.finish = finish
+        self.stats = StageStats(name)
+        self.error: Optional[BaseException] = None
+        self._alive = workers
+        self._lock = threading.Lock()
+        self._threads: List[threading.Thread] = []
+
+    def start(self, q_in: queue.Queue, q_out: Optional[queue.Queue], abort: threading.Event) -> None:
+        self.stats.t_start = time.perf_counter()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._loop, args=(q_in, q_out, abort), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def join(self) -> None:
+        for t in self._threads:
+            t.join()
+
+    def _emit(self, outs: Iterable, q_out: Optional[queue.Queue]) -> int:
+        n = 0
+        for o in outs or ():
+            if q_out is not None:
+                q_out.put(o)
+            n += 1
+        return n
+
+    def _fail(self, e: BaseException, abort: threading.Event) -> None:
+        # keep the first failure and stop the whole pipeline
+        if self.error is None:
+            self.error = e
+        abort.set()
+
+    def _loop(self, q_in: queue.Queue, q_out: Optional[queue.Queue], abort: threading.Event) -> None:
+        while True:
+            item = q_in.get()
+            if item is _DONE:
+                q_in.put(_DONE)  # let sibling workers see it too
+                break
+            if abort.is_set():
+                continue  # keep draining so upstream never blocks on a full queue
+            try:
+                t0 = time.perf_counter()
+                outs = list(self.fn(item) or ())
+                busy = time.perf_counter() - t0
+                self._emit(outs, q_out)
+                self.stats.record(len(outs), busy)
+            except Exception as e:
+                self._fail(e, abort)
+        with self._lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if not last:
+            return
+        if self.finish is not None and not abort.is_set():
+            try:
+                t0 = time.perf_counter()
+                outs = list(self.finish() or ())
+                self.stats.busy_s += time.perf_counter() - t0
+                self.stats.items_out += self._emit(outs, q_out)
+            except Exception as e:
+                self._fail(e, abort)
+        self.stats.t_end = time.perf_counter()
+        if q_out is not None:
+            q_out.put(_DONE)
+
+
+def run_stages(source: Iterable, stages: List[Stage], queue_size: int = 64) -> List[Dict]:
+    """
+    Wire `stages` with bounded queues, feed them from `source` and wait until everything drains.
+    Returns the per-stage statistics. Raises the first exception raised by any stage.
+    """
+    abort = threading.Event()
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    for i, st in enumerate(stages):
+        q_out = queues[i + 1] if i + 1 < len(stages) else None
+        st.start(queues[i], q_out, abort)
+
+    feed = StageStats("source")
+    feed.t_start = time.perf_counter()
+    try:
+        for item in source:
+            if abort.is_set():
+                break
+            queues[0].put(item)
+            feed.record(1, 0.0)
+    finally:
+        feed.t_end = time.perf_counter()
+        queues[0].put(_DONE)
+        for st in stages:
+            st.join()
+
+    for st in stages:
+        if st.error is not None:
+            raise RuntimeError(f"Stage '{st.name}' failed: {st.error}") from st.error
+    return [feed.as_dict()] + [st.stats.as_dict() for st in stages]
+
+# ---------- Ingestion pipeline ----------
+
+def _parse_one(path: Path, parse_fn: Callable[[Path], str], pool: Optional[Executor], verbose: bool) -> List:
+    try:
+        text = pool.submit(parse_fn, path).result() if pool is not None else parse_fn(path)
+    except Exception as e:
+        print(f"[WARN] {path}: {e}")
+        return []
+    if verbose:
+        print(f"[INFO] {path.name}: {len(text)} chars")
+    return [(path, text)]
+
+
+class _Embedder:
+    """Groups records into batches and embeds them (one forward pass per batch)."""
+    def __init__(self, vc, batch_size: int) -> None:
+        self.vc = vc
+        self.batch_size = batch_size
+        self.batch: List[Dict] = []
+
+    def add(self, rec: Dict) -> List:
+        self.batch.append(rec)
+        if len(self.batch) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self) -> List:
+        if not self.batch:
+            return []
+        from retrieval.vector_client import kb_record_to_chroma
+        batch, self.batch = self.batch, []
+        rows = [kb_record_to_chroma(r, fallback_id=r.get("source", "?")) for r in batch]
+        keep = [(r, row) for r, row in zip(batch, rows) if row is not None]
+        embs = self.vc.embed_passages([row[1] for _, row in keep]) if keep else []
+        return [(batch, keep, embs)]
+
+
+class _Writer:
+    """Appends records to the KB JSONL and, when embeddings are attached, writes them to Chroma."""
+    def __init__(self, fh, vc=None) -> None:
+        self.fh = fh
+        self.vc = vc
+        self.count = 0
+
+    def write_record(self, rec: Dict) -> List:
+        self.fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.count += 1
+        return [rec]
+
+    def write_batch(self, item) -> List:
+        batch, keep, embs = item
+        for rec in batch:
+            self.fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        if keep:
+            self.vc.add_batch(
+                [row[0] for _, row in keep],
+                [row[1] for _, row in keep],
+                [row[2] for _, row in keep],
+                embeddings=embs,
+            )
+        self.count += len(batch)
+        return batch
+
+
+def run_pipeline(
+    raw_dir: str | Path = "data/raw",
+    kb_out: str | Path = "data/kb/bm25.jsonl",
+    persist_dir: Optional[str] = None,
+    collection: str = "osha",
+    parse_fn: Optional[Callable[[Path], str]] = None,
+    chunk_fn: Optional[Callable[[Path, str], List[Dict]]] = None,
+    parse_workers: int = 2,
+    processes: bool = False,
+    queue_size: int = 64,
+    batch_size: int = 64,
+    verbose: bool = True,
+) -> Dict:
+    """
+    Streaming ingestion: list files -> parse -> chunk -> [embed] -> write.
+    Stages run concurrently and are connected by bounded queues, so parsing overlaps with
+    embedding and I/O while memory stays bounded by queue_size items per stage.
+    - parse_fn/chunk_fn default to ingestion.ingest.parse_file / chunk_records.
+    - processes: parse in a process pool (pypdf/OCR are CPU-bound and hold the GIL).
+    - persist_dir: if set, chunks are also embedded and written to that Chroma collection.
+    Returns {"chunks": int, "stages": [per-stage stats]}.
+    """
+    parse_fn = parse_fn or parse_file
+    chunk_fn = chunk_fn or chunk_records
+    kb_out = Path(kb_out)
+    kb_out.parent.mkdir(parents=True, exist_ok=True)
+
+    vc = None
+    if persist_dir:
+        from retrieval.vector_client import VectorClient
+        vc = VectorClient(persist_dir=persist_dir, collection=collection)
+
+    pool = ProcessPoolExecutor(max_workers=parse_workers) if processes else None
+    try:
+        with kb_out.open("w", encoding="utf-8") as fh:
+            writer = _Writer(fh, vc)
+            stages = [
+                Stage("parse", partial(_parse_one, parse_fn=parse_fn, pool=pool, verbose=verbose), workers=parse_workers),
+                Stage("chunk", lambda item: chunk_fn(item[0], item[1])),
+            ]
+            if vc is not None:
+                emb = _Embedder(vc, batch_size)
+                stages.append(Stage("embed", emb.add, finish=emb.flush))
+                stages.append(Stage("write", writer.write_batch))
+            else:
+                stages.append(Stage("write", writer.write_record))
+            stats = run_stages(iter_raw_files(Path(raw_dir)), stages, queue_size=queue_size)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return {"chunks": writer.count, "stages": stats}
+
+
+def print_stage_report(stats: List[Dict]) -> None:
+    print(f"{'stage':<8} {'in':>7} {'out':>7} {'busy_s':>8} {'wall_s':>8} {'items/s':>9}")
+    for s in stats:
+        print(f"{s['stage']:<8} {s['items_in']:>7} {s['items_out']:>7} {s['busy_s']:>8.2f} {s['wall_s']:>8.2f} {s['items_per_s']:>9.2f}")
+
+# ---------- CLI ----------
+
+def main():
+    ap = argparse.ArgumentParser(description="Streaming ingestion pipeline: parse -> chunk -> embed -> write, with bounded queues")
+    ap.add_argument("--raw_dir", default="data/raw", help="Directory with PDFs/HTML/TXT")
+    ap.add_argument("--kb_out", default="data/kb/bm25.jsonl", help="Output JSONL for BM25")
+    ap.add_argument("--persist_dir", default=None, help="Chroma dir; if set, chunks are embedded and indexed too")
+    ap.add_argument("--collection", default="osha")
+    ap.add_argument("--max_tokens", type=int, default=220)
+    ap.add_argument("--overlap", type=int, default=40)
+    ap.add_argument("--force_ocr", action="store_true", help="Force OCR for PDFs (ignore text layer)")
+    ap.add_argument("--parse_workers", type=int, default=2)
+    ap.add_argument("--processes", action="store_true", help="Parse in a process pool instead of threads")
+    ap.add_argument("--queue_size", type=int, default=64, help="Max items buffered between two stages")
+    ap.add_argument("--batch_size", type=int, default=64, help="Chunks per embedding batch")
+    ap.add_argument("--quiet", action="store_true", help="Less logging")
+    args = ap.parse_args()
+
+    res = run_pipeline(
+        raw_dir=args.raw_dir,
+        kb_out=args.kb_out,
+        persist_dir=args.persist_dir,
+        collection=args.collection,
+        parse_fn=partial(parse_file, force_ocr=args.force_ocr),
+        chunk_fn=partial(chunk_records, max_tokens=args.max_tokens, overlap=args.overlap),
+        parse_workers=args.parse_workers,
+        processes=args.processes,
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        verbose=not args.quiet,
+    )
+    print_stage_report(res["stages"])
+    print(f"✅ KB created with {res['chunks']} chunks → {args.kb_out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# monitoring/hits.py
+"""
+Per-hit retrieval telemetry: one interaction_hits row per passage returned for an interaction
+(rank, chunk id, file, final and per-engine scores), written by the telemetry writer in the
+same transaction as the interaction (monitoring/logger.py).
+
+The `sources` TEXT column of interactions is kept for compatibility; chunk-level questions
+run on this table through its indexes instead of splitting that string:
+
+  v_chunk_stats      per chunk: retrievals, top-1 count, mean rank, likes / dislikes of the answers
+  v_file_stats       per file: retrievals, interactions that used it, hit rate, likes / dislikes
+  v_disliked_chunks  chunks retrieved for disliked answers, most frequent first
+  v_engine_overlap   per chunk: how often BM25 only, dense only or both engines found it
+
+  sqlite3 data/monitoring/telemetry.db "SELECT * FROM v_chunk_stats ORDER BY retrievals DESC LIMIT 10"
+"""
+from __future__ import annotations
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+HIT_COLS = ["interaction_id", "rank", "chunk_id", "doc", "score",
+            "bm25_score", "dense_score", "bm25_rank", "dense_rank"]
+_INSERT_SQL = f"INSERT OR REPLACE INTO interaction_hits ({', '.join(HIT_COLS)}) VALUES ({','.join(['?'] * len(HIT_COLS))})"
+
+_VIEWS = {
+    "v_chunk_stats": """
+        SELECT h.chunk_id, h.doc,
+               COUNT(*) AS retrievals,
+               SUM(h.rank = 0) AS top1,
+               AVG(h.rank) AS mean_rank,
+               SUM(i.feedback = 1) AS likes,
+               SUM(i.feedback = -1) AS dislikes,
+               1.0 * SUM(i.feedback = -1) / NULLIF(SUM(i.feedback != 0), 0) AS dislike_ratio
+        FROM interaction_hits h JOIN interactions i ON i.id = h.interaction_id
+        GROUP BY h.chunk_id""",
+    "v_file_stats": """
+        SELECT h.doc,
+               COUNT(*) AS retrievals,
+               COUNT(DISTINCT h.interaction_id) AS interactions,
+               1.0 * COUNT(DISTINCT h.interaction_id) / (SELECT COUNT(*) FROM interactions) AS hit_rate,
+               SUM(i.feedback = 1) AS likes,
+               SUM(i.feedback = -1) AS dislikes
+        FROM interaction_hits h JOIN interactions i ON i.id = h.interaction_id
+        GROUP BY h.doc""",
+    "v_disliked_chunks": """
+        SELECT h.chunk_id, h.doc, COUNT(*) AS disliked_retrievals, AVG(h.rank) AS mean_rank
+        FROM interactions i JOIN interaction_hits h ON h.interaction_id = i.id
+        WHERE i.feedback = -1
+        GROUP BY h.chunk_id
+        ORDER BY disliked_retrievals DESC""",
+    "v_engine_overlap": """
+        SELECT chunk_id,
+               SUM(bm25_rank IS NOT NULL AND dense_rank IS NULL) AS bm25_only,
+               SUM(dense_rank IS NOT NULL AND bm25_rank IS NULL) AS dense_only,
+               SUM(bm25_rank IS NOT NULL AND dense_rank IS NOT NULL) AS both_engines
+        FROM interaction_hits
+        GROUP BY chunk_id""",
+}
+
+def init_schema(conn: sqlite3.Connection) -> bool:
+    """Create the table, indexes and views; returns True when the table is new (needs backfill)."""
+    new = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='interaction_hits'").fetchone() is None
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS interaction_hits (
+      interaction_id INTEGER NOT NULL,
+      rank INTEGER NOT NULL,
+      chunk_id TEXT NOT NULL,
+      doc TEXT,
+      score REAL,
+      bm25_score REAL,
+      dense_score REAL,
+      bm25_rank INTEGER,
+      dense_rank INTEGER,
+      PRIMARY KEY (interaction_id, rank)
+    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_hits_chunk ON interaction_hits(chunk_id, interaction_id, rank)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_hits_doc ON interaction_hits(doc, interaction_id)")
+    for name, sql in _VIEWS.items():
+        conn.execute(f"DROP VIEW IF EXISTS {name}")  # keep the definitions current
+        conn.execute(f"CREATE VIEW {name} AS {sql}")
+    return new
+
+def _doc(chunk_id: str) -> str:
+    return chunk_id.split("#", 1)[0]
+
+def _num(v) -> Optional[float]:
+    try:
+        return float(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def hit_rows(hits: Optional[Iterable[Dict]], sources: Sequence[str], retriever: str = "") -> List[Tuple]:
+    """
+    Rows for one interaction, without the id (prepended at insert time). `hits` are the
+    passages as returned by the retrievers (score, bm25_* / dense_* from the RRF fusion);
+    without them only rank and chunk id are known, from `sources`.
+    """
+    rows: List[Tuple] = []
+    if hits is None:
+        for rank, src in enumerate(sources or []):
+            rows.append((rank, str(src), _doc(str(src)), None, None, None, None, None))
+        return rows
+    for rank, h in enumerate(hits):
+        src = str(h.get("source") or "?")
+        bm25_score, bm25_rank = h.get("bm25_score"), h.get("bm25_rank")
+        if retriever == "bm25" and bm25_rank is None:
+            bm25_score, bm25_rank = h.get("score"), rank  # BM25-only retrieval: the score is BM25's
+        rows.append((rank, src, _doc(src), _num(h.get("score")), _num(bm25_score), _num(h.get("dense_score")),
+                     bm25_rank, h.get("dense_rank")))
+    return rows
+
+def insert_hits(conn: sqlite3.Connection, items: Iterable[Tuple[int, List[Tuple]]]) -> None:
+    """items: (interaction_id, hit_rows(...)) pairs."""
+    conn.executemany(_INSERT_SQL, [(iid, *row) for iid, rows in items for row in rows])
+
+def backfill(conn: sqlite3.Connection) -> int:
+    """Split the `sources` column of existing interactions into interaction_hits (once, on creation)."""
+    n = 0
+    cur = conn.execute("SELECT id, sources FROM interactions WHERE sources IS NOT NULL AND sources != ''")
+    while True:
+        chunk = cur.fetchmany(5000)
+        if not chunk:
+            return n
+        items = [(iid, hit_rows(None, [s.strip() for s in src.split(" | ") if s.strip()])) for iid, src in chunk]
+        insert_hits(conn, items)
+        n += sum(len(rows) for _, rows in items)
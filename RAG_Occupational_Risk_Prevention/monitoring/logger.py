@@ -1,10 +1,18 @@
 from __future__ import annotations
-import sqlite3, time, pathlib
-from typing import List, Dict, Optional
+import atexit, os, queue, sqlite3, threading, time, pathlib
+from concurrent.futures import Future
+from typing import List, Dict, Optional, Tuple, Union
+from monitoring import hits as hits_store, rollups
 
 DB_PATH = pathlib.Path("data/monitoring/telemetry.db")
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# --- escritura asíncrona por lotes (ver _TelemetryWriter) ---
+TELEMETRY_ASYNC = os.getenv("TELEMETRY_ASYNC", "1").strip().lower() not in {"0", "false", "no", "off"}
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", "64"))
+TELEMETRY_FLUSH_MS = float(os.getenv("TELEMETRY_FLUSH_MS", "200"))
+TELEMETRY_QUEUE_MAX = int(os.getenv("TELEMETRY_QUEUE_MAX", "10000"))
+
 # --- columnas esperadas en la versión actual ---
 EXPECTED_COLUMNS = {
     "id", "ts_utc", "query", "retriever", "topk", "fanout",
@@ -12,14 +20,24 @@ EXPECTED_COLUMNS = {
     "sources", "ctx_len", "feedback", "feedback_text",
     # opcionales que puede que uses en métricas
     "latency_ms_retrieval", "latency_ms_llm",
+    "ttft_ms", "tokens_per_s",
+    "prompt_tokens", "completion_tokens", "prefill_ms", "decode_ms",
+    "queue_wait_ms",
 }
 
 def _table_columns(conn: sqlite3.Connection) -> set[str]:
     cur = conn.execute("PRAGMA table_info(interactions)")
     return {row[1] for row in cur.fetchall()}
 
-def _init_and_migrate() -> None:
-    with sqlite3.connect(str(DB_PATH)) as conn:
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(str(DB_PATH), timeout=30)
+    conn.execute("PRAGMA synchronous=NORMAL")  # suficiente con WAL: no hace fsync en cada commit
+    return conn
+
+def _init_and_migrate() -> set[str]:
+    with sqlite3.connect(str(DB_PATH), timeout=30) as conn:
+        # WAL: los lectores (páginas de métricas) no bloquean al escritor ni al revés (persistente en el fichero)
+        conn.execute("PRAGMA journal_mode=WAL")
         # crea si no existe (esquema completo actual)
         conn.execute("""
         CREATE TABLE IF NOT EXISTS interactions (
@@ -38,7 +56,14 @@ def _init_and_migrate() -> None:
           feedback INTEGER DEFAULT 0,
           feedback_text TEXT,
           latency_ms_retrieval REAL,
-          latency_ms_llm REAL
+          latency_ms_llm REAL,
+          ttft_ms REAL,
+          tokens_per_s REAL,
+          prompt_tokens INTEGER,
+          completion_tokens INTEGER,
+          prefill_ms REAL,
+          decode_ms REAL,
+          queue_wait_ms REAL
         )
         """)
         conn.commit()
@@ -58,10 +83,132 @@ def _init_and_migrate() -> None:
         # opcionales para métricas
         add_col("latency_ms_retrieval", "REAL", "NULL")
         add_col("latency_ms_llm", "REAL", "NULL")
+        # streaming: time to first token y velocidad de decodificación
+        add_col("ttft_ms", "REAL", "NULL")
+        add_col("tokens_per_s", "REAL", "NULL")
+        # tokens y desglose prefill / decode de cada generación
+        add_col("prompt_tokens", "INTEGER", "NULL")
+        add_col("completion_tokens", "INTEGER", "NULL")
+        add_col("prefill_ms", "REAL", "NULL")
+        add_col("decode_ms", "REAL", "NULL")
+        # espera en la cola del scheduler antes de llamar al LLM
+        add_col("queue_wait_ms", "REAL", "NULL")
+
+        conn.commit()
 
+        # agregados por minuto/hora para las páginas (monitoring/rollups.py); pone al día el histórico
+        rollups.init_schema(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        rollups.refresh_rollups(conn)
+        # una fila por pasaje recuperado (monitoring/hits.py); la primera vez desde `sources`
+        if hits_store.init_schema(conn):
+            hits_store.backfill(conn)
         conn.commit()
+        return _table_columns(conn)
+
+# esquema cacheado tras la migración: el INSERT se construye una sola vez
+_COLUMNS = _init_and_migrate()
+_FIELDS = [
+    "ts_utc", "query", "retriever", "topk", "fanout", "latency_ms", "provider", "model", "answer",
+    "sources", "ctx_len", "feedback", "feedback_text",
+    "latency_ms_retrieval", "latency_ms_llm", "ttft_ms", "tokens_per_s",
+    "prompt_tokens", "completion_tokens", "prefill_ms", "decode_ms", "queue_wait_ms",
+]
+# (por si vienes de un esquema antiguo que no se pudo migrar: solo columnas existentes)
+_INSERT_COLS = [c for c in _FIELDS if c in _COLUMNS]
+_INSERT_SQL = f"INSERT INTO interactions ({', '.join(_INSERT_COLS)}) VALUES ({','.join(['?'] * len(_INSERT_COLS))})"
+
+
+class _TelemetryWriter:
+    """
+    Hilo de fondo que escribe las interacciones por lotes: log_interaction solo encola la fila.
+    Un lote se escribe con executemany en una transacción cuando hay TELEMETRY_BATCH_SIZE filas,
+    cuando pasan TELEMETRY_FLUSH_MS desde la primera pendiente, en flush() o al salir.
+    Cada fila recibe su id: con el lock de escritura tomado (BEGIN IMMEDIATE), AUTOINCREMENT
+    asigna ids consecutivos que terminan en last_insert_rowid(). Los rollups se actualizan
+    en la misma transacción.
+    """
 
-_init_and_migrate()
+    def __init__(self) -> None:
+        self._q: "queue.Queue[Union[Tuple[tuple, list, Future], threading.Event]]" = queue.Queue(maxsize=TELEMETRY_QUEUE_MAX)
+        self.written = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._loop, name="telemetry-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row: tuple, hit_rows: list) -> Future:
+        fut: Future = Future()
+        try:
+            self._q.put_nowait((row, hit_rows, fut))
+        except queue.Full:
+            # nunca bloquear la petición por la telemetría
+            self.dropped += 1
+            fut.set_exception(RuntimeError("telemetry queue full: interaction dropped"))
+        return fut
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        done = threading.Event()
+        self._q.put(done)
+        return done.wait(timeout)
+
+    def _loop(self) -> None:
+        conn = _connect()
+        while True:
+            batch: List[Tuple[tuple, list, Future]] = []
+            markers: List[threading.Event] = []
+            item = self._q.get()
+            deadline = time.monotonic() + TELEMETRY_FLUSH_MS / 1000
+            while True:
+                if isinstance(item, threading.Event):
+                    markers.append(item)
+                    break  # flush(): escribir ya lo pendiente
+                batch.append(item)
+                if len(batch) >= TELEMETRY_BATCH_SIZE:
+                    break
+                left = deadline - time.monotonic()
+                try:
+                    item = self._q.get(timeout=left) if left > 0 else self._q.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(conn, batch)
+            for m in markers:
+                m.set()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Tuple[tuple, list, Future]]) -> None:
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(_INSERT_SQL, [row for row, _, _ in batch])
+            last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first = last - len(batch) + 1
+            hits_store.insert_hits(conn, [(first + i, hit_rows) for i, (_, hit_rows, _) in enumerate(batch)])
+            rollups.refresh_rollups(conn)  # en la misma transacción: filas y agregados siempre coherentes
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[WARN] telemetry: {len(batch)} interactions not written: {e}")
+            for _, _, fut in batch:
+                fut.set_exception(e)
+            return
+        self.written += len(batch)
+        for i, (_, _, fut) in enumerate(batch):
+            fut.set_result(first + i)
+
+
+_writer: Optional[_TelemetryWriter] = None
+_writer_lock = threading.Lock()
+
+def _get_writer() -> _TelemetryWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _TelemetryWriter()
+            atexit.register(_writer.flush, 10.0)  # no perder las filas pendientes al salir
+        return _writer
+
+def flush_telemetry(timeout: Optional[float] = 10.0) -> bool:
+    """Espera a que las interacciones encoladas estén escritas (tests, scripts, apagado)."""
+    return _writer.flush(timeout) if _writer is not None else True
 
 def log_interaction(
     query: str,
@@ -76,48 +223,57 @@ def log_interaction(
     ctx_len: int,
     latency_ms_retrieval: Optional[float] = None,
     latency_ms_llm: Optional[float] = None,
-) -> int:
-    ts = time.time()
-    # guardamos sources como texto simple separado por ' | '
-    src = " | ".join(sources or [])
-    with sqlite3.connect(str(DB_PATH)) as conn:
-        cols = _table_columns(conn)
+    ttft_ms: Optional[float] = None,
+    tokens_per_s: Optional[float] = None,
+    prompt_tokens: Optional[int] = None,
+    completion_tokens: Optional[int] = None,
+    prefill_ms: Optional[float] = None,
+    decode_ms: Optional[float] = None,
+    queue_wait_ms: Optional[float] = None,
+    hits: Optional[List[Dict]] = None,
+) -> Future:
+    """
+    Encola la interacción y vuelve enseguida; devuelve un Future con el id de la fila
+    (update_feedback acepta el Future directamente). TELEMETRY_ASYNC=0 escribe en el acto.
+    `hits`: los pasajes tal como los devuelve el retriever (score, bm25_* / dense_*), que se
+    guardan uno por fila en interaction_hits; sin ellos solo se conocen rango y chunk (sources).
+    """
+    values = {
+        "ts_utc": time.time(), "query": query, "retriever": retriever, "topk": topk, "fanout": fanout,
+        "latency_ms": latency_ms, "provider": provider, "model": model, "answer": answer,
+        # guardamos sources como texto simple separado por ' | '
+        "sources": " | ".join(sources or []), "ctx_len": ctx_len, "feedback": 0, "feedback_text": None,
+        "latency_ms_retrieval": latency_ms_retrieval, "latency_ms_llm": latency_ms_llm,
+        "ttft_ms": ttft_ms, "tokens_per_s": tokens_per_s,
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+        "prefill_ms": prefill_ms, "decode_ms": decode_ms, "queue_wait_ms": queue_wait_ms,
+    }
+    row = tuple(values[c] for c in _INSERT_COLS)
+    hit_rows = hits_store.hit_rows(hits, sources, retriever)
+    if TELEMETRY_ASYNC:
+        return _get_writer().submit(row, hit_rows)
+    fut: Future = Future()
+    with sqlite3.connect(str(DB_PATH), timeout=30) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        fut.set_result(conn.execute(_INSERT_SQL, row).lastrowid)
+        hits_store.insert_hits(conn, [(fut.result(), hit_rows)])
+        rollups.refresh_rollups(conn)
+    return fut
 
-        # construimos el INSERT según columnas disponibles (por si vienes de un esquema antiguo)
-        base_cols = ["ts_utc","query","retriever","topk","fanout","latency_ms","provider","model","answer"]
-        base_vals = [ts, query, retriever, topk, fanout, latency_ms, provider, model, answer]
-
-        if "sources" in cols:
-            base_cols += ["sources"]
-            base_vals += [src]
-        if "ctx_len" in cols:
-            base_cols += ["ctx_len"]
-            base_vals += [ctx_len]
-        if "feedback" in cols:
-            base_cols += ["feedback"]
-            base_vals += [0]
-        if "feedback_text" in cols:
-            base_cols += ["feedback_text"]
-            base_vals += [None]
-        if "latency_ms_retrieval" in cols:
-            base_cols += ["latency_ms_retrieval"]
-            base_vals += [latency_ms_retrieval]
-        if "latency_ms_llm" in cols:
-            base_cols += ["latency_ms_llm"]
-            base_vals += [latency_ms_llm]
-
-        placeholders = ",".join(["?"] * len(base_cols))
-        sql = f"INSERT INTO interactions ({', '.join(base_cols)}) VALUES ({placeholders})"
-        cur = conn.execute(sql, base_vals)
-        conn.commit()
-        return cur.lastrowid
+def _resolve_id(interaction_id: Union[int, Future]) -> int:
+    if isinstance(interaction_id, Future):
+        return int(interaction_id.result(timeout=30))
+    return int(interaction_id)
 
-def update_feedback(interaction_id: int, value: int, comment: str = "") -> int:
+def update_feedback(interaction_id: Union[int, Future], value: int, comment: str = "") -> int:
     value = 1 if value > 0 else (-1 if value < 0 else 0)
-    with sqlite3.connect(str(DB_PATH)) as conn:
+    interaction_id = _resolve_id(interaction_id)
+    with sqlite3.connect(str(DB_PATH), timeout=30) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rollups.apply_feedback(conn, interaction_id, value)  # likes/dislikes de los agregados
         cur = conn.execute(
             "UPDATE interactions SET feedback=?, feedback_text=? WHERE id=?",
-            (value, comment or None, int(interaction_id)),
+            (value, comment or None, interaction_id),
         )
         conn.commit()
         return cur.rowcount  # 1 si se actualizó, 0 si no encontró la fila
@@ -145,3 +301,50 @@ def recent(limit: int = 100) -> List[Dict]:
             LIMIT ?
         """, (int(limit),)).fetchall()
     return [dict(r) for r in rows]
+
+def _feedback_sql(feedback: Optional[int]) -> Tuple[str, list]:
+    if feedback is None:
+        return "", []
+    return " AND COALESCE(feedback, 0) = ?", [int(feedback)]
+
+def search_interactions(text: str = "", feedback: Optional[int] = None, limit: int = 300) -> List[Dict]:
+    """Últimas interacciones que cumplen los filtros (filtrado en SQL, no en Python)."""
+    cond, params = _feedback_sql(feedback)
+    if text:
+        cond += " AND query LIKE ?"
+        params.append(f"%{text}%")
+    with sqlite3.connect(str(DB_PATH)) as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f"""
+            SELECT id, ts_utc, query, retriever, topk, fanout,
+                   latency_ms, provider, model,
+                   COALESCE(ctx_len, 0) AS ctx_len,
+                   COALESCE(feedback, 0) AS feedback,
+                   feedback_text
+            FROM interactions
+            WHERE 1=1 {cond}
+            ORDER BY id DESC
+            LIMIT ?
+        """, (*params, int(limit))).fetchall()
+    return [dict(r) for r in rows]
+
+def count_interactions(text: str = "", feedback: Optional[int] = None) -> Dict[str, int]:
+    """
+    Totales (interactions, likes, dislikes) con los mismos filtros. Sin texto salen de los
+    agregados (monitoring/rollups.py), sin recorrer la tabla; con texto, LIKE en SQL.
+    """
+    with sqlite3.connect(str(DB_PATH)) as conn:
+        if not text:
+            cells = [r["cell"] for r in rollups.load_rollups(conn, "hour")]
+            n = sum(c.n for c in cells)
+            likes = sum(c.likes for c in cells)
+            dislikes = sum(c.dislikes for c in cells)
+            by_fb = {None: n, 1: likes, -1: dislikes, 0: n - likes - dislikes}
+            return {"interactions": by_fb[feedback],
+                    "likes": likes if feedback in (None, 1) else 0,
+                    "dislikes": dislikes if feedback in (None, -1) else 0}
+        cond, params = _feedback_sql(feedback)
+        n, likes, dislikes = conn.execute(
+            f"SELECT COUNT(*), SUM(feedback = 1), SUM(feedback = -1) FROM interactions WHERE query LIKE ? {cond}",
+            (f"%{text}%", *params)).fetchone()
+    return {"interactions": n or 0, "likes": likes or 0, "dislikes": dislikes or 0}
@@ -0,0 +1,231 @@
+# monitoring/metrics.py
+"""
+In-process metrics in the Prometheus text format (stdlib only).
+
+Every thread records into its own shard (threading.local): observe()/inc() touch only that
+shard, with no lock and no shared counter, so instrumenting a stage costs a dict lookup and a
+few additions. render() sums the shards of all threads when /metrics is scraped. Shards of
+finished threads are kept, so counters never go backwards.
+
+Exposed by the API at GET /metrics; the Streamlit app serves the same registry on
+METRICS_PORT (start_http_server) when that variable is set.
+
+  rag_stage_seconds{stage}            histogram: bm25, dense, fusion, rerank, retrieval,
+                                      prompt_build, queue_wait, prefill, decode, llm, total
+  rag_answer_cache_total{result}      hit / miss
+  rag_degradations_total{kind}        deadline degradations (retrieval/deadline.py)
+  rag_errors_total{stage}             failed requests by stage
+  rag_requests_total{endpoint,status}
+  rag_llm_slots{state,priority}       scheduler running / queued (gauge)
+"""
+from __future__ import annotations
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds; from sub-millisecond stages (fusion, prompt build) to slow generations
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Dict] = []
+        self._shards_lock = threading.Lock()  # taken once per thread, on its first record
+
+    def _shard(self) -> Dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _snapshot(self) -> List[Dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [dict(s) for s in shards]
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        total: Dict[Tuple[str, ...], float] = {}
+        for shard in self._snapshot():
+            for key, v in shard.items():
+                total[key] = total.get(key, 0.0) + v
+        return total
+
+    def collect(self) -> List[str]:
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}"
+                                for k, v in sorted(self.values().items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        shard = self._shard()
+        key = self._key(labels)
+        cell = shard.get(key)
+        if cell is None:
+            cell = shard[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per-bucket counts, sum, count
+        cell[0][bisect.bisect_left(self.buckets, value)] += 1
+        cell[1] += value
+        cell[2] += 1
+
+    def values(self) -> Dict[Tuple[str, ...], Tuple[List[int], float, int]]:
+        total: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        for shard in self._snapshot():
+            for key, (counts, s, n) in shard.items():
+                prev = total.get(key)
+                if prev is None:
+                    total[key] = (list(counts), s, n)
+                else:
+                    total[key] = ([a + b for a, b in zip(prev[0], counts)], prev[1] + s, prev[2] + n)
+        return total
+
+    def collect(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, s, n) in sorted(self.values().items()):
+            cum = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                cum += c
+                le_label = 'le="%s"' % _fmt(le)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le_label)} {cum}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(s)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Read at scrape time from `fn`, which returns {label values tuple: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str],
+                 fn: Callable[[], Dict[Tuple[str, ...], float]]) -> None:
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def collect(self) -> List[str]:
+        try:
+            values = self.fn()
+        except Exception:
+            return []
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}"
+                                for k, v in sorted(values.items())]
+
+
+# ---------- Registry ----------
+_registry: List[_Metric] = []
+
+def register(metric: _Metric) -> _Metric:
+    _registry.append(metric)
+    return metric
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+# ---------- Pipeline metrics ----------
+STAGE_SECONDS: Histogram = register(Histogram(
+    "rag_stage_seconds", "Latency of each pipeline stage in seconds.", ["stage"]))
+ANSWER_CACHE: Counter = register(Counter(
+    "rag_answer_cache_total", "Answer cache lookups by result (hit/miss).", ["result"]))
+DEGRADATIONS: Counter = register(Counter(
+    "rag_degradations_total", "Deadline degradations by kind.", ["kind"]))
+ERRORS: Counter = register(Counter(
+    "rag_errors_total", "Failed requests by pipeline stage.", ["stage"]))
+REQUESTS: Counter = register(Counter(
+    "rag_requests_total", "Handled requests by endpoint and status.", ["endpoint", "status"]))
+
+def _llm_slots() -> Dict[Tuple[str, ...], float]:
+    from app.llm.scheduler import get_scheduler  # lazy: monitoring must not import the LLM stack
+    snap = get_scheduler().snapshot()
+    return {(state, p): v for state in ("running", "queued") for p, v in snap[state].items()}
+
+register(Gauge("rag_llm_slots", "LLM scheduler slots by state (running/queued) and priority.",
+               ["state", "priority"], _llm_slots))
+
+def observe_ms(stage: str, ms: Optional[float]) -> None:
+    """Record a stage latency measured in milliseconds (None is ignored)."""
+    if ms is not None:
+        STAGE_SECONDS.observe(ms / 1000, stage=stage)
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
+
+# ---------- Standalone endpoint ----------
+_server: Optional[ThreadingHTTPServer] = None
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve GET /metrics from a daemon thread (for processes without an HTTP API, e.g. Streamlit)."""
+    global _server
+    if _server is not None:
+        return _server
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = render().encode("utf-8") if self.path.split("?")[0] == "/metrics" else b""
+            self.send_response(200 if body else 404)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    _server = server
+    return server
@@ -0,0 +1,300 @@
+# monitoring/rollups.py
+"""
+Pre-aggregated telemetry for the Metrics and Dashboard pages.
+
+telemetry_rollup holds one row per (grain, bucket, provider, model), with grain "minute"
+(kept ROLLUP_MINUTE_RETENTION_H hours, default 48) or "hour" (kept forever):
+  n, likes, dislikes   counts
+  sketches             JSON {metric: LogSketch}: latency_ms, latency_ms_retrieval, latency_ms_llm,
+                       ttft_ms, prefill_ms, decode_ms, tokens_per_s, prompt_tokens, queue_wait_ms,
+                       plus latency_ms@ctx<n> (by number of passages) and prefill_ms@pbin<n> /
+                       decode_ms@pbin<n> (by 256-token prompt bin)
+
+telemetry_meta.rollup_last_id is the last interaction folded in. refresh_rollups() folds the
+newer ones in the same transaction as their INSERT (monitoring/logger.py), so readers see
+rollups and rows consistently; update_feedback() applies the like/dislike delta with
+apply_feedback(). load_rollups() returns the rollups of a time range plus the rows after
+rollup_last_id aggregated on the fly, so the pages cost the same whatever the history size.
+"""
+from __future__ import annotations
+import json
+import math
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+GRAINS = {"minute": 60, "hour": 3600}
+MINUTE_RETENTION_S = float(os.getenv("ROLLUP_MINUTE_RETENTION_H", "48")) * 3600
+PROMPT_BIN = 256
+
+SKETCH_METRICS = ["latency_ms", "latency_ms_retrieval", "latency_ms_llm", "ttft_ms",
+                  "prefill_ms", "decode_ms", "tokens_per_s", "prompt_tokens", "queue_wait_ms"]
+_ROW_COLS = ["id", "ts_utc", "provider", "model", "feedback", "ctx_len"] + SKETCH_METRICS
+
+# =========================
+# Mergeable quantile sketch
+# =========================
+class LogSketch:
+    """
+    DDSketch-style quantile sketch: values are counted in logarithmic buckets, so any quantile
+    is within ALPHA relative error and two sketches merge by adding bucket counts.
+    Values <= MIN_VALUE (e.g. a queue wait of 0) are counted apart.
+    """
+    ALPHA = 0.02
+    MIN_VALUE = 1e-3
+    _GAMMA = (1 + ALPHA) / (1 - ALPHA)
+    _LOG_GAMMA = math.log(_GAMMA)
+
+    __slots__ = ("bins", "zero", "n", "total")
+
+    def __init__(self, bins: Optional[Dict[int, int]] = None, zero: int = 0, n: int = 0, total: float = 0.0) -> None:
+        self.bins: Dict[int, int] = bins or {}
+        self.zero = zero
+        self.n = n
+        self.total = total
+
+    def add(self, v: float, count: int = 1) -> None:
+        if v <= self.MIN_VALUE:
+            self.zero += count
+        else:
+            i = math.ceil(math.log(v) / self._LOG_GAMMA)
+            self.bins[i] = self.bins.get(i, 0) + count
+        self.n += count
+        self.total += v * count
+
+    def merge(self, other: "LogSketch") -> "LogSketch":
+        for i, c in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + c
+        self.zero += other.zero
+        self.n += other.n
+        self.total += other.total
+        return self
+
+    def _value(self, i: int) -> float:
+        return 2 * self._GAMMA ** i / (self._GAMMA + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.n:
+            return None
+        rank = q * (self.n - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if rank < seen:
+                return self._value(i)
+        return self._value(max(self.bins))
+
+    def fraction_above(self, v: float) -> float:
+        """Share of values greater than v (within the bucket resolution)."""
+        if not self.n:
+            return 0.0
+        above = sum(c for i, c in self.bins.items() if self._value(i) > v)
+        return above / self.n
+
+    def histogram(self, n_bars: int = 30) -> List[Tuple[float, int]]:
+        """(lower bound, count) pairs over at most n_bars log-spaced bars, for bar charts."""
+        if not self.bins:
+            return [(0.0, self.zero)] if self.zero else []
+        lo, hi = min(self.bins), max(self.bins)
+        width = max(1, math.ceil((hi - lo + 1) / n_bars))
+        bars: Dict[int, int] = {}
+        for i, c in self.bins.items():
+            b = lo + (i - lo) // width * width
+            bars[b] = bars.get(b, 0) + c
+        out = [(0.0, self.zero)] if self.zero else []
+        return out + [(round(self._GAMMA ** (b - 1), 1), bars[b]) for b in sorted(bars)]
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self.total / self.n if self.n else None
+
+    def to_dict(self) -> Dict:
+        return {"b": {str(i): c for i, c in self.bins.items()}, "z": self.zero, "n": self.n, "s": self.total}
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> "LogSketch":
+        return cls({int(i): c for i, c in d.get("b", {}).items()}, d.get("z", 0), d.get("n", 0), d.get("s", 0.0))
+
+
+def merge_all(sketches: Iterable[Optional[LogSketch]]) -> LogSketch:
+    out = LogSketch()
+    for s in sketches:
+        if s is not None:
+            out.merge(s)
+    return out
+
+# =========================
+# Rollup cells
+# =========================
+class Cell:
+    """Aggregate of the interactions of one (grain, bucket, provider, model)."""
+    __slots__ = ("n", "likes", "dislikes", "sketches")
+
+    def __init__(self, n: int = 0, likes: int = 0, dislikes: int = 0,
+                 sketches: Optional[Dict[str, LogSketch]] = None) -> None:
+        self.n = n
+        self.likes = likes
+        self.dislikes = dislikes
+        self.sketches: Dict[str, LogSketch] = sketches or {}
+
+    def observe(self, metric: str, v) -> None:
+        if v is None:
+            return
+        try:
+            v = float(v)
+        except (TypeError, ValueError):
+            return
+        if math.isnan(v):
+            return
+        self.sketches.setdefault(metric, LogSketch()).add(v)
+
+    def add_row(self, r: Dict) -> None:
+        self.n += 1
+        fb = int(r.get("feedback") or 0)
+        self.likes += fb > 0
+        self.dislikes += fb < 0
+        for m in SKETCH_METRICS:
+            self.observe(m, r.get(m))
+        if r.get("ctx_len") is not None:
+            self.observe(f"latency_ms@ctx{int(r['ctx_len'])}", r.get("latency_ms"))
+        if r.get("prompt_tokens") is not None:
+            pbin = int(r["prompt_tokens"]) // PROMPT_BIN * PROMPT_BIN
+            self.observe(f"prefill_ms@pbin{pbin}", r.get("prefill_ms"))
+            self.observe(f"decode_ms@pbin{pbin}", r.get("decode_ms"))
+
+    def merge(self, other: "Cell") -> "Cell":
+        self.n += other.n
+        self.likes += other.likes
+        self.dislikes += other.dislikes
+        for m, s in other.sketches.items():
+            if m in self.sketches:
+                self.sketches[m].merge(s)
+            else:
+                self.sketches[m] = LogSketch().merge(s)
+        return self
+
+    def sketches_json(self) -> str:
+        return json.dumps({m: s.to_dict() for m, s in self.sketches.items()}, separators=(",", ":"))
+
+    @classmethod
+    def from_db(cls, n: int, likes: int, dislikes: int, sketches: Optional[str]) -> "Cell":
+        parsed = {m: LogSketch.from_dict(d) for m, d in json.loads(sketches or "{}").items()}
+        return cls(n, likes, dislikes, parsed)
+
+
+Key = Tuple[str, int, str, str]
+
+def _bucket(ts: float, grain: str) -> int:
+    size = GRAINS[grain]
+    return int(ts // size * size)
+
+def accumulate(rows: Iterable[Dict], grains: Sequence[str] = tuple(GRAINS)) -> Dict[Key, Cell]:
+    cells: Dict[Key, Cell] = {}
+    for r in rows:
+        for grain in grains:
+            key = (grain, _bucket(r["ts_utc"], grain), r.get("provider") or "", r.get("model") or "")
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = Cell()
+            cell.add_row(r)
+    return cells
+
+# =========================
+# Schema and maintenance (called by monitoring/logger.py inside its transactions)
+# =========================
+def init_schema(conn: sqlite3.Connection) -> None:
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS telemetry_rollup (
+      grain TEXT NOT NULL,
+      bucket INTEGER NOT NULL,
+      provider TEXT NOT NULL,
+      model TEXT NOT NULL,
+      n INTEGER NOT NULL,
+      likes INTEGER NOT NULL,
+      dislikes INTEGER NOT NULL,
+      sketches TEXT,
+      PRIMARY KEY (grain, bucket, provider, model)
+    )""")
+    conn.execute("CREATE TABLE IF NOT EXISTS telemetry_meta (key TEXT PRIMARY KEY, value)")
+    # top queries by feedback read only the rows that have feedback
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_interactions_feedback_ts ON interactions(feedback, ts_utc)")
+
+def last_rolled_id(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM telemetry_meta WHERE key='rollup_last_id'").fetchone()
+    return int(row[0]) if row else 0
+
+def _rows_after(conn: sqlite3.Connection, last_id: int, filters: str = "", params: Sequence = ()) -> List[Dict]:
+    cur = conn.execute(f"SELECT {', '.join(_ROW_COLS)} FROM interactions WHERE id > ? {filters} ORDER BY id",
+                       (last_id, *params))
+    return [dict(zip(_ROW_COLS, r)) for r in cur.fetchall()]
+
+def refresh_rollups(conn: sqlite3.Connection, now: Optional[float] = None) -> int:
+    """Fold the interactions after rollup_last_id into the rollups. Call inside a write transaction."""
+    rows = _rows_after(conn, last_rolled_id(conn))
+    if rows:
+        for key, cell in accumulate(rows).items():
+            old = conn.execute("SELECT n, likes, dislikes, sketches FROM telemetry_rollup "
+                               "WHERE grain=? AND bucket=? AND provider=? AND model=?", key).fetchone()
+            if old is not None:
+                cell = Cell.from_db(*old).merge(cell)
+            conn.execute("INSERT OR REPLACE INTO telemetry_rollup VALUES (?,?,?,?,?,?,?,?)",
+                         (*key, cell.n, cell.likes, cell.dislikes, cell.sketches_json()))
+        conn.execute("INSERT OR REPLACE INTO telemetry_meta (key, value) VALUES ('rollup_last_id', ?)", (rows[-1]["id"],))
+    cutoff = _bucket((now or time.time()) - MINUTE_RETENTION_S, "minute")
+    conn.execute("DELETE FROM telemetry_rollup WHERE grain='minute' AND bucket < ?", (cutoff,))
+    return len(rows)
+
+def apply_feedback(conn: sqlite3.Connection, interaction_id: int, new_value: int) -> None:
+    """Move an already rolled-up interaction between likes/dislikes. Call before updating the row."""
+    row = conn.execute("SELECT ts_utc, provider, model, feedback FROM interactions WHERE id=?",
+                       (interaction_id,)).fetchone()
+    if row is None or interaction_id > last_rolled_id(conn):
+        return  # not folded in yet: refresh_rollups will read the new value
+    ts, provider, model, old = row
+    old = int(old or 0)
+    d_likes = (new_value > 0) - (old > 0)
+    d_dislikes = (new_value < 0) - (old < 0)
+    if not (d_likes or d_dislikes):
+        return
+    for grain in GRAINS:
+        conn.execute("UPDATE telemetry_rollup SET likes = likes + ?, dislikes = dislikes + ? "
+                     "WHERE grain=? AND bucket=? AND provider=? AND model=?",
+                     (d_likes, d_dislikes, grain, _bucket(ts, grain), provider or "", model or ""))
+
+# =========================
+# Readers (Metrics / Dashboard pages)
+# =========================
+def load_rollups(
+    conn: sqlite3.Connection,
+    grain: str = "hour",
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+) -> List[Dict]:
+    """
+    Rollup rows of `grain` with since <= bucket < until, as dicts with a `cell` (Cell).
+    Interactions not folded in yet are aggregated here, so the result is always current.
+    """
+    where, params = ["grain = ?"], [grain]
+    if since is not None:
+        where.append("bucket >= ?")
+        params.append(_bucket(since, grain))
+    if until is not None:
+        where.append("bucket < ?")
+        params.append(until)
+    cells: Dict[Key, Cell] = {}
+    for g, bucket, provider, model, n, likes, dislikes, sk in conn.execute(
+            f"SELECT grain, bucket, provider, model, n, likes, dislikes, sketches FROM telemetry_rollup "
+            f"WHERE {' AND '.join(where)}", params):
+        cells[(g, bucket, provider, model)] = Cell.from_db(n, likes, dislikes, sk)
+    tail_filter, tail_params = "", []
+    if since is not None:
+        tail_filter, tail_params = "AND ts_utc >= ?", [_bucket(since, grain)]
+    for key, cell in accumulate(_rows_after(conn, last_rolled_id(conn), tail_filter, tail_params), [grain]).items():
+        if until is not None and key[1] >= until:
+            continue
+        cells[key] = cells[key].merge(cell) if key in cells else cell
+    return [{"grain": k[0], "bucket": k[1], "provider": k[2], "model": k[3], "cell": c}
+            for k, c in sorted(cells.items())]
@@ -0,0 +1,146 @@
+# Running:
+# python -m retrieval.bm25_builder --kb_jsonl data/kb/bm25.jsonl --index_dir data/kb/bm25_segments --workers 8
+"""
+Parallel BM25 index build (map-reduce over the KB JSONL).
+
+map:    each worker process reads one byte-range shard of the JSONL (aligned to lines), builds
+        that shard's postings, term frequencies and lengths, and writes them as one frozen
+        segment of a SegmentedBM25 directory. Only the shard's document frequencies go back
+        to the parent.
+reduce: the document frequencies are summed (vocabulary size) and the manifest lists the
+        segments in file order, so doc order matches a sequential build. SegmentedBM25 scores
+        every segment with global statistics, so results match a single index; nothing is
+        merged or re-serialized in the parent.
+HybridRetriever(bm25_index_dir=...) loads the directory instead of tokenizing and building at
+startup; its background merger compacts the segments if there are more than max_segments.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from retrieval.bm25_client import _simple_tokenize
+from retrieval.segmented_bm25 import MANIFEST, DirLock, Segment
+
+def shard_offsets(path: str | Path, shards: int) -> List[Tuple[int, int]]:
+    """Split the file into `shards` byte ranges whose boundaries fall on line starts."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, shards):
+            f.seek(max(bounds[-1], size * i // shards))
+            f.readline()  # move to the start of the next line
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+def _map_shard(path: str, start: int, end: int, seg_id: int, index_dir: str) -> Dict:
+    """Build and save the segment for one shard; returns its file name, doc count and df."""
+    seg = Segment(seg_id)
+    df: Counter = Counter()
+    with open(path, "rb") as f:
+        f.seek(start)
+        for raw in f.read(end - start).splitlines():
+            if not raw.strip():
+                continue
+            obj = json.loads(raw)
+            text = obj.get("text", "")
+            seg.add(text, obj.get("tokens") or _simple_tokenize(text), obj.get("source", "?"), obj.get("meta", {}))
+            df.update(seg.doc_tfs[-1].keys())
+    if seg.texts:
+        seg.save(Path(index_dir))
+    return {"file": seg.file_name, "docs": len(seg.texts), "df": df}
+
+def _reduce(parts: List[Dict]) -> Tuple[List[str], int, Counter]:
+    df: Counter = Counter()
+    for part in parts:
+        df.update(part["df"])
+    files = [part["file"] for part in parts if part["docs"]]
+    return files, sum(part["docs"] for part in parts), df
+
+def build_index(
+    kb_jsonl: str | Path = "data/kb/bm25.jsonl",
+    index_dir: str | Path = "data/kb/bm25_segments",
+    workers: Optional[int] = None,
+    shards: Optional[int] = None,
+    verbose: bool = True,
+) -> Dict:
+    """
+    Build a SegmentedBM25 directory from the KB JSONL using `workers` processes
+    (default: all cores) over `shards` byte ranges (default: one per worker), one segment each.
+    Any previous index in index_dir is replaced. Raises IndexLocked while another process
+    (e.g. an ingestion writer) holds the directory's writer lock, so its checkpoints
+    cannot overwrite the new manifest. Returns build statistics.
+    """
+    index_dir = Path(index_dir)
+    with DirLock(index_dir):
+        return _build_locked(str(kb_jsonl), index_dir, workers, shards, verbose)
+
+def _build_locked(kb_jsonl: str, index_dir: Path, workers: Optional[int], shards: Optional[int], verbose: bool) -> Dict:
+    workers = workers or os.cpu_count() or 1
+    ranges = shard_offsets(kb_jsonl, shards or workers)
+    # new segment ids follow the previous manifest: its files stay valid until the new one replaces it
+    manifest_path = index_dir / MANIFEST
+    first_id = json.loads(manifest_path.read_text(encoding="utf-8")).get("next_id", 1) if manifest_path.exists() else 1
+    args = [(kb_jsonl, a, b, first_id + i, str(index_dir)) for i, (a, b) in enumerate(ranges)]
+
+    t0 = time.perf_counter()
+    if workers > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_map_shard, *zip(*args)))
+    else:
+        parts = [_map_shard(*a) for a in args]
+    t_map = time.perf_counter() - t0
+
+    files, docs, df = _reduce(parts)
+    if not docs:
+        raise ValueError(f"KB is empty: {kb_jsonl}")
+    tmp = index_dir / (MANIFEST + ".tmp")
+    tmp.write_text(json.dumps({"segments": files, "tombstones": {}, "next_id": first_id + len(ranges)}), encoding="utf-8")
+    os.replace(tmp, manifest_path)
+    for old in index_dir.glob("seg-*.pkl"):
+        if old.name not in files:
+            old.unlink()
+    t_reduce = time.perf_counter() - t0 - t_map
+
+    stats = {
+        "docs": docs,
+        "terms": sum(1 for v in df.values() if v > 0),
+        "segments": len(files),
+        "shards": len(ranges),
+        "workers": workers,
+        "map_s": round(t_map, 3),
+        "reduce_s": round(t_reduce, 3),
+        "total_s": round(time.perf_counter() - t0, 3),
+    }
+    if verbose:
+        print(f"[INFO] BM25 build: {stats['docs']} docs, {stats['terms']} terms, {stats['segments']} segments × "
+              f"{workers} workers — map {stats['map_s']}s, reduce {stats['reduce_s']}s, total {stats['total_s']}s")
+    return stats
+
+# ---------- CLI ----------
+
+def main():
+    ap = argparse.ArgumentParser(description="Parallel BM25 index build (map-reduce) into a segmented index directory.")
+    ap.add_argument("--kb_jsonl", default="data/kb/bm25.jsonl")
+    ap.add_argument("--index_dir", default="data/kb/bm25_segments")
+    ap.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    ap.add_argument("--shards", type=int, default=None, help="byte-range shards = segments (default: one per worker)")
+    args = ap.parse_args()
+
+    stats = build_index(args.kb_jsonl, args.index_dir, workers=args.workers, shards=args.shards)
+    print(f"✅ BM25 index with {stats['docs']} chunks → {args.index_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# retrieval/deadline.py
+"""
+Per-request latency budget shared by the pipeline stages.
+
+A Deadline is created from the request's `deadline_ms` and passed down (API -> HybridRetriever
+-> generation). Each stage asks how much time is left and degrades instead of running late;
+the degradations that fired are collected on the deadline and reported in the response:
+
+  dense_skipped / dense_timeout   BM25-only results (no time for, or no answer from, dense search)
+  rerank_skipped                  fused order kept
+  llm_skipped / llm_timeout       passages returned without an answer
+  answer_truncated                stream stopped at the deadline
+"""
+from __future__ import annotations
+import math
+import time
+from typing import List, Optional
+
+class Deadline:
+    def __init__(self, budget_ms: Optional[float] = None) -> None:
+        self.budget_ms = budget_ms
+        self._t0 = time.monotonic()
+        self._t_end = self._t0 + budget_ms / 1000 if budget_ms is not None else None
+        self.degradations: List[str] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self._t_end is not None
+
+    def remaining_ms(self) -> float:
+        if self._t_end is None:
+            return math.inf
+        return max(0.0, (self._t_end - time.monotonic()) * 1000)
+
+    def remaining_s(self) -> Optional[float]:
+        """Seconds left (None without a deadline), for timeout= arguments."""
+        return None if self._t_end is None else self.remaining_ms() / 1000
+
+    def expired(self) -> bool:
+        return self.remaining_ms() <= 0
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self._t0) * 1000
+
+    def degrade(self, what: str) -> None:
+        if what not in self.degradations:
+            self.degradations.append(what)
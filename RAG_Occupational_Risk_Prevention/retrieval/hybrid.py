@@ -1,6 +1,11 @@
 from __future__ import annotations
-from typing import List, Dict, Tuple
-from retrieval.bm25_client import BM25Client
+import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import List, Dict, Optional, Tuple
+from monitoring.metrics import timed
+from retrieval.deadline import Deadline
+from retrieval.segmented_bm25 import open_bm25
+from retrieval.singleflight import SingleFlight, query_key, singleflight_enabled
 from retrieval.vector_client import VectorClient
 
 def reciprocal_rank_fusion(
@@ -13,6 +18,8 @@ def reciprocal_rank_fusion(
     RRF: score(doc) = sum( 1 / (rrf_k + rank_i) ) over lists (bm25, dense).
     - bm25_hits/dense_hits: lists of dicts with at least 'text'
     - k: final size of the fused list
+    Fused hits keep each engine's score and 0-based rank (bm25_score / bm25_rank,
+    dense_score / dense_rank; None when the engine did not return the passage) for telemetry.
     """
     # Build ranking (by position) for each list
     ranks_maps = []
@@ -40,10 +47,15 @@ def reciprocal_rank_fusion(
     scored.sort(key=lambda x: x[0], reverse=True)
     top = scored[:k]
 
+    engine_scores = [{h["text"]: h.get("score") for h in hits} for hits in (bm25_hits, dense_hits)]
+
     out: List[Dict] = []
     for s, t in top:
         base = all_docs[t].copy()
         base["score"] = float(s)
+        for engine, rank_map, scores in zip(("bm25", "dense"), ranks_maps, engine_scores):
+            base[f"{engine}_rank"] = rank_map.get(t)
+            base[f"{engine}_score"] = scores.get(t)
         out.append(base)
     return out
 
@@ -52,21 +64,89 @@ class HybridRetriever:
     """
     Hybrid retriever: BM25 + vector (Chroma) + RRF fusion.
     - Uses the KB JSONL for BM25 and the persisted Chroma collection for dense search.
+    - bm25_index_dir (default: $BM25_INDEX_DIR): serve a persistent SegmentedBM25 index instead,
+      read-only; appends/deletes come from ingestion (ingest --append_bm25_index) and are
+      picked up on the next query after its checkpoint.
     """
     def __init__(
         self,
         bm25_kb_path: str = "data/kb/bm25.jsonl",
         chroma_dir: str = "data/chroma",
         chroma_collection: str = "osha",
+        bm25_index_dir: Optional[str] = None,
     ) -> None:
-        self.bm25 = BM25Client(bm25_kb_path)
+        self.bm25 = open_bm25(bm25_kb_path, bm25_index_dir)
         self.vec = VectorClient(persist_dir=chroma_dir, collection=chroma_collection)
+        self._flight = SingleFlight()
+        self._dense_pool: Optional[ThreadPoolExecutor] = None
 
-    def search(self, query: str, k: int = 6, fanout: int = 20) -> List[Dict]:
+    def search(
+        self,
+        query: str,
+        k: int = 6,
+        fanout: int = 20,
+        deadline: Optional[Deadline] = None,
+        reserve_ms: float = 0.0,
+    ) -> List[Dict]:
         """
         fanout: number of initial candidates per engine before fusion.
+        Concurrent identical searches (same normalized query, k, fanout) share one run.
+        deadline: dense search runs next to BM25 and gets the time left minus `reserve_ms`
+        (kept for later stages); without an answer by then the BM25 hits are returned alone
+        and deadline.degradations records dense_skipped / dense_timeout.
         """
-        bm25_hits = self.bm25.search(query, k=fanout)
-        dense_hits = self.vec.search(query, k=fanout)
-        fused = reciprocal_rank_fusion(bm25_hits, dense_hits, k=k, rrf_k=60.0)
+        if deadline is not None and deadline.enabled:
+            return self._search_by_deadline(query, k, fanout, deadline, reserve_ms)
+        if not singleflight_enabled():
+            return self._search(query, k, fanout)
+        hits, _ = self._flight.do(query_key(query, k, fanout), lambda: self._search(query, k, fanout))
+        return [dict(h) for h in hits]  # callers may annotate their hits
+
+    def _search(self, query: str, k: int, fanout: int) -> List[Dict]:
+        bm25_hits = self._bm25(query, fanout)
+        dense_hits = self._vec(query, fanout)
+        with timed("fusion"):
+            fused = reciprocal_rank_fusion(bm25_hits, dense_hits, k=k, rrf_k=60.0)
         return fused
+
+    # per-engine timings for /metrics (monitoring/metrics.py)
+    def _bm25(self, query: str, fanout: int) -> List[Dict]:
+        with timed("bm25"):
+            return self.bm25.search(query, k=fanout)
+
+    def _vec(self, query: str, fanout: int) -> List[Dict]:
+        with timed("dense"):
+            return self.vec.search(query, k=fanout)
+
+    def _dense(self, query: str, fanout: int) -> List[Dict]:
+        if not singleflight_enabled():
+            return self._vec(query, fanout)
+        hits, _ = self._flight.do(query_key(query, fanout, "dense"), lambda: self._vec(query, fanout))
+        return hits
+
+    def _search_by_deadline(self, query: str, k: int, fanout: int, deadline: Deadline, reserve_ms: float) -> List[Dict]:
+        if self._dense_pool is None:
+            self._dense_pool = ThreadPoolExecutor(max_workers=int(os.getenv("DENSE_WORKERS", "4")),
+                                                  thread_name_prefix="dense")
+        fut = None
+        if deadline.remaining_ms() > reserve_ms:
+            fut = self._dense_pool.submit(self._dense, query, fanout)
+        bm25_hits = self._bm25(query, fanout)  # meanwhile, in this thread
+        dense_hits: List[Dict] = []
+        if fut is None:
+            deadline.degrade("dense_skipped")
+        else:
+            try:
+                dense_hits = fut.result(timeout=max(0.0, deadline.remaining_ms() - reserve_ms) / 1000)
+            except FutureTimeout:
+                deadline.degrade("dense_timeout")  # the late result is dropped (and still coalesced)
+        with timed("fusion"):
+            return [dict(h) for h in reciprocal_rank_fusion(bm25_hits, dense_hits, k=k, rrf_k=60.0)]
+
+    def search_many(self, queries: List[str], k: int = 6, fanout: int = 20) -> List[List[Dict]]:
+        """Batched search: one dense call (batched query embeddings) for all queries."""
+        dense = self.vec.search_many(queries, k=fanout)
+        return [
+            reciprocal_rank_fusion(self.bm25.search(q, k=fanout), d, k=k, rrf_k=60.0)
+            for q, d in zip(queries, dense)
+        ]
@@ -0,0 +1,81 @@
+# retrieval/microbatch.py
+"""
+Dynamic micro-batching for a batched function (e.g. the query encoder).
+
+Concurrent callers submit single items; a worker thread collects them until `max_batch`
+items are pending or `max_wait_ms` passed since the first one, runs ONE call of `fn` on the
+whole batch and resolves each caller's future with its own result. Under load the encoder
+runs one forward pass per batch instead of one per request; an idle caller pays at most
+`max_wait_ms` extra.
+"""
+from __future__ import annotations
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Generic, List, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+class MicroBatcher(Generic[T, R]):
+    def __init__(
+        self,
+        fn: Callable[[List[T]], Sequence[R]],
+        max_batch: int = 32,
+        max_wait_ms: float = 5.0,
+        name: str = "microbatch",
+    ) -> None:
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000
+        self._q: "queue.Queue[Tuple[T, Future]]" = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self._worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item: T) -> Future:
+        fut: Future = Future()
+        self._q.put((item, fut))
+        return fut
+
+    def __call__(self, item: T) -> R:
+        return self.submit(item).result()
+
+    def map(self, items: List[T]) -> List[R]:
+        """Submit several items at once (they may share a batch with other callers)."""
+        return [f.result() for f in [self.submit(x) for x in items]]
+
+    def _loop(self) -> None:
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                left = deadline - time.monotonic()
+                try:
+                    batch.append(self._q.get(timeout=left) if left > 0 else self._q.get_nowait())
+                except queue.Empty:
+                    break
+            self._run(batch)
+
+    def _run(self, batch: List[Tuple[T, Future]]) -> None:
+        batch = [(x, f) for x, f in batch if f.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self.fn([x for x, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"batched fn returned {len(results)} results for {len(batch)} items")
+        except BaseException as e:
+            for _, f in batch:
+                f.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for (_, f), r in zip(batch, results):
+            f.set_result(r)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "items": self.items,
+                "mean_batch": round(self.items / self.batches, 2) if self.batches else 0.0}
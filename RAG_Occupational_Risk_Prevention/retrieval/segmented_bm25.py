@@ -0,0 +1,578 @@
+# retrieval/segmented_bm25.py
+"""
+LSM-style segmented BM25 index that absorbs appends and deletes without a full rebuild.
+
+- New chunks land in an in-memory segment (memtable); when it reaches `memtable_limit` docs it
+  is frozen into an immutable segment (written to disk when `segment_dir` is set).
+- Deletes are tombstones on the segment holding the doc; re-adding a source replaces it.
+- Queries score every segment with the *global* statistics (live N, avgdl, df), so scores
+  match a single BM25Okapi built over the live documents.
+- A background merger compacts small segments and drops tombstoned docs.
+- A persistent index has a single writer (`open(dir, writer=True)` takes an exclusive lock on
+  dir/writer.lock); serving processes open it read-only and reload when the manifest changes.
+
+search() returns the same hit dicts as BM25Client: {"text", "score", "source", "meta"}.
+"""
+from __future__ import annotations
+import copy
+import heapq
+import json
+import math
+import os
+import pickle
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from retrieval.bm25_client import BM25Client, _simple_tokenize
+
+MANIFEST = "manifest.json"
+LOCK_FILE = "writer.lock"
+
+
+class IndexLocked(RuntimeError):
+    """Another process holds the writer lock of a segment directory."""
+
+
+class DirLock:
+    """Exclusive, non-blocking lock on dir/writer.lock (the OS drops it if the process dies)."""
+    def __init__(self, directory: str | Path) -> None:
+        self.path = Path(directory) / LOCK_FILE
+        self._f = None
+
+    def acquire(self) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        f = self.path.open("a+")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._f = f
+        return True
+
+    def release(self) -> None:
+        if self._f is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        self._f.close()
+        self._f = None
+
+    def __enter__(self) -> "DirLock":
+        if not self.acquire():
+            raise IndexLocked(f"{self.path.parent} is being written by another process ({self.path} is locked)")
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class Segment:
+    """Docs + postings (term -> [(local_doc, tf)]). Only the memtable grows; frozen segments only gain tombstones."""
+    def __init__(self, seg_id: int) -> None:
+        self.seg_id = seg_id
+        self.texts: List[str] = []
+        self.sources: List[str] = []
+        self.metas: List[Dict] = []
+        self.doc_len: List[int] = []
+        self.doc_tfs: List[Dict[str, int]] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.deleted: set = set()
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def live(self) -> int:
+        return len(self.texts) - len(self.deleted)
+
+    @property
+    def file_name(self) -> str:
+        return f"seg-{self.seg_id:06d}.pkl"
+
+    def add(self, text: str, tokens: List[str], source: str, meta: Dict) -> int:
+        i = len(self.texts)
+        tfs = dict(Counter(tokens))
+        for term, tf in tfs.items():
+            self.postings.setdefault(term, []).append((i, tf))
+        self.doc_tfs.append(tfs)
+        self.doc_len.append(len(tokens))
+        self.texts.append(text)
+        self.sources.append(source)
+        self.metas.append(meta)
+        return i
+
+    def add_stats(self, text: str, tfs: Dict[str, int], doc_len: int, source: str, meta: Dict) -> int:
+        """Same as add() from precomputed term frequencies (merges, parallel builds)."""
+        i = len(self.texts)
+        for term, tf in tfs.items():
+            self.postings.setdefault(term, []).append((i, tf))
+        self.doc_tfs.append(tfs)
+        self.doc_len.append(doc_len)
+        self.texts.append(text)
+        self.sources.append(source)
+        self.metas.append(meta)
+        return i
+
+    def save(self, directory: Path) -> None:
+        tmp = directory / (self.file_name + ".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, directory / self.file_name)
+
+    @classmethod
+    def load(cls, path: Path) -> "Segment":
+        seg = cls.__new__(cls)
+        with path.open("rb") as f:
+            seg.__dict__.update(pickle.load(f))
+        return seg
+
+
+class SegmentedBM25:
+    def __init__(
+        self,
+        segment_dir: Optional[str | Path] = None,
+        memtable_limit: int = 1000,
+        max_segments: int = 8,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        writer: bool = True,
+    ) -> None:
+        self.segment_dir = Path(segment_dir) if segment_dir else None
+        self.memtable_limit = memtable_limit
+        self.max_segments = max_segments
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+
+        self._lock = threading.RLock()
+        self._segments: List[Segment] = []          # frozen, oldest first
+        self._next_id = 1
+        self._mem = self._new_segment()
+        self._loc: Dict[str, Tuple[Segment, int]] = {}
+        self._df: Counter = Counter()
+        self._n = 0
+        self._total_len = 0
+        self._avg_idf: Optional[float] = None
+        self._avg_idf_n = -1
+        self._merge_lock = threading.Lock()
+        self._merger: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._manifest_mtime: Optional[int] = None
+        self._refresh_lock = threading.Lock()
+        self._writer_lock: Optional[DirLock] = None
+        if self.segment_dir and writer:
+            lock = DirLock(self.segment_dir)
+            lock.__enter__()
+            self._writer_lock = lock
+
+    # ---------- Construction ----------
+    @classmethod
+    def from_jsonl(cls, kb_path: str | Path = "data/kb/bm25.jsonl", **kwargs) -> "SegmentedBM25":
+        """Build an index over the KB JSONL (the whole KB becomes the first frozen segment)."""
+        idx = cls(**kwargs)
+        with Path(kb_path).open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    obj = json.loads(line)
+                    idx._add_locked(obj.get("text", ""), obj.get("source", "?"), obj.get("meta", {}), obj.get("tokens"))
+        idx.freeze()
+        return idx
+
+    @classmethod
+    def open(cls, segment_dir: str | Path, writer: bool = False, **kwargs) -> "SegmentedBM25":
+        """
+        Load the segments and tombstones listed in segment_dir/manifest.json.
+        Read-only by default: search() follows the writer's manifest. writer=True takes the
+        directory's writer lock (IndexLocked if another process has it) and allows add/delete/merge;
+        a writer may open a directory that has no manifest yet.
+        """
+        idx = cls(segment_dir=segment_dir, writer=writer, **kwargs)
+        try:
+            idx._load_manifest()
+        except BaseException:
+            idx.close()
+            raise
+        return idx
+
+    def _manifest_stat(self) -> Optional[int]:
+        try:
+            return (self.segment_dir / MANIFEST).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load_manifest(self, reuse: Optional[Dict[str, Segment]] = None, retries: int = 3) -> None:
+        # segment files are immutable, so a reload reuses the ones already in memory; a writer
+        # merge can unlink a listed file before we read it: re-read the manifest and retry
+        self._manifest_mtime = self._manifest_stat()
+        if self._manifest_mtime is None:
+            if self._writer_lock is not None:
+                return
+            raise FileNotFoundError(f"No BM25 index manifest in {self.segment_dir}")
+        manifest = json.loads((self.segment_dir / MANIFEST).read_text(encoding="utf-8"))
+        tombstones = manifest.get("tombstones", {})
+        segs = []
+        try:
+            for name in manifest["segments"]:
+                old = (reuse or {}).get(name)
+                # a reused segment is shallow-copied: the state being replaced keeps its tombstones
+                seg = copy.copy(old) if old is not None else Segment.load(self.segment_dir / name)
+                segs.append((seg, seg.deleted | set(tombstones.get(name, []))))
+        except FileNotFoundError:
+            if retries <= 0:
+                raise
+            return self._load_manifest(reuse, retries - 1)
+        for seg, deleted in segs:
+            seg.deleted = deleted
+            self._attach(seg)
+        self._next_id = max(manifest.get("next_id", 1), self._next_id)
+        self._mem = self._new_segment()
+
+    def refresh(self) -> bool:
+        """
+        Read-only index: reload if the writer replaced the manifest since the last load
+        (one stat() per call). The new state is built aside and swapped in under the lock,
+        so concurrent searches keep using the old one. Returns True when it reloaded.
+        """
+        if self.segment_dir is None or self._writer_lock is not None:
+            return False
+        if self._manifest_stat() in (None, self._manifest_mtime):
+            return False
+        with self._refresh_lock:
+            if self._manifest_stat() in (None, self._manifest_mtime):
+                return False
+            fresh = SegmentedBM25(memtable_limit=self.memtable_limit, max_segments=self.max_segments,
+                                  k1=self.k1, b=self.b, epsilon=self.epsilon)
+            fresh.segment_dir = self.segment_dir
+            fresh._load_manifest(reuse={s.file_name: s for s in self._segments})
+            with self._lock:
+                for attr in ("_segments", "_next_id", "_mem", "_loc", "_df", "_n", "_total_len", "_manifest_mtime"):
+                    setattr(self, attr, getattr(fresh, attr))
+                self._avg_idf, self._avg_idf_n = None, -1
+        return True
+
+    def sources(self) -> List[str]:
+        """Live chunk sources (ingestion uses it to replace a re-ingested file's chunks)."""
+        with self._lock:
+            return list(self._loc)
+
+    def close(self) -> None:
+        """Stop the merger and release the writer lock (does not checkpoint)."""
+        self.stop_merger()
+        if self._writer_lock is not None:
+            self._writer_lock.release()
+            self._writer_lock = None
+
+    def __enter__(self) -> "SegmentedBM25":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _check_writable(self) -> None:
+        if self.segment_dir is not None and self._writer_lock is None:
+            raise RuntimeError(f"BM25 index {self.segment_dir} is open read-only: use SegmentedBM25.open(dir, writer=True)")
+
+    def _new_segment(self) -> Segment:
+        seg = Segment(self._next_id)
+        self._next_id += 1
+        return seg
+
+    def _attach(self, seg: Segment) -> None:
+        # register a loaded/built frozen segment in the global statistics
+        for i, source in enumerate(seg.sources):
+            if i in seg.deleted:
+                continue
+            if source in self._loc:
+                self._delete_locked(source)
+            self._loc[source] = (seg, i)
+            self._df.update(seg.doc_tfs[i].keys())
+            self._n += 1
+            self._total_len += seg.doc_len[i]
+        self._segments.append(seg)
+        self._next_id = max(self._next_id, seg.seg_id + 1)
+
+    def install_segment(self, seg: Segment) -> None:
+        """Add a prebuilt frozen segment (e.g. from retrieval.bm25_builder) and persist it."""
+        self._check_writable()
+        with self._lock:
+            seg.seg_id = self._next_id
+            self._next_id += 1
+            self._attach(seg)
+            if self.segment_dir:
+                self.segment_dir.mkdir(parents=True, exist_ok=True)
+                seg.save(self.segment_dir)
+                self._write_manifest()
+
+    # ---------- Mutations ----------
+    def add(self, text: str, source: str, meta: Optional[Dict] = None, tokens: Optional[List[str]] = None) -> None:
+        """Add (or replace, if `source` exists) one chunk."""
+        self._check_writable()
+        with self._lock:
+            self._add_locked(text, source, meta or {}, tokens)
+            if len(self._mem) >= self.memtable_limit:
+                self.freeze()
+
+    def add_many(self, records: Iterable[Dict]) -> int:
+        n = 0
+        for obj in records:
+            self.add(obj.get("text", ""), obj.get("source", "?"), obj.get("meta", {}), obj.get("tokens"))
+            n += 1
+        return n
+
+    def delete(self, source: str) -> bool:
+        self._check_writable()
+        with self._lock:
+            return self._delete_locked(source)
+
+    def _add_locked(self, text: str, source: str, meta: Dict, tokens: Optional[List[str]]) -> None:
+        if source in self._loc:
+            self._delete_locked(source)
+        tokens = tokens or _simple_tokenize(text)
+        i = self._mem.add(text, tokens, source, meta)
+        self._loc[source] = (self._mem, i)
+        self._df.update(self._mem.doc_tfs[i].keys())
+        self._n += 1
+        self._total_len += len(tokens)
+
+    def _delete_locked(self, source: str) -> bool:
+        loc = self._loc.pop(source, None)
+        if loc is None:
+            return False
+        seg, i = loc
+        seg.deleted.add(i)
+        self._df.subtract(seg.doc_tfs[i].keys())
+        self._n -= 1
+        self._total_len -= seg.doc_len[i]
+        return True
+
+    def freeze(self) -> None:
+        """Turn the memtable into an immutable segment (persisted when segment_dir is set)."""
+        self._check_writable()
+        with self._lock:
+            if len(self._mem) == 0:
+                return
+            seg = self._mem
+            self._segments.append(seg)
+            self._mem = self._new_segment()
+            if self.segment_dir:
+                self.segment_dir.mkdir(parents=True, exist_ok=True)
+                seg.save(self.segment_dir)
+                self._write_manifest()
+
+    def checkpoint(self) -> None:
+        """Persist the memtable and the current tombstones (no-op without segment_dir)."""
+        self._check_writable()
+        with self._lock:
+            self.freeze()
+            if self.segment_dir:
+                self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        manifest = {
+            "segments": [s.file_name for s in self._segments],
+            "tombstones": {s.file_name: sorted(s.deleted) for s in self._segments if s.deleted},
+            "next_id": self._next_id,
+        }
+        tmp = self.segment_dir / (MANIFEST + ".tmp")
+        tmp.write_text(json.dumps(manifest), encoding="utf-8")
+        os.replace(tmp, self.segment_dir / MANIFEST)
+
+    # ---------- Compaction ----------
+    def merge(self, force: bool = False) -> bool:
+        """
+        Merge the smallest frozen segments into one, dropping tombstoned docs.
+        Runs when there are more than max_segments segments (or any mergeable work if force).
+        The merge itself happens outside the lock; queries and writes continue meanwhile.
+        """
+        self._check_writable()
+        if not self._merge_lock.acquire(blocking=False):
+            return False  # another merge is running
+        try:
+            return self._merge(force)
+        finally:
+            self._merge_lock.release()
+
+    def _merge(self, force: bool) -> bool:
+        with self._lock:
+            segs = list(self._segments)
+            if len(segs) < 2 or (not force and len(segs) <= self.max_segments):
+                return False
+            victims = segs if force else sorted(segs, key=lambda s: s.live)[: len(segs) - self.max_segments + 1]
+            if len(victims) < 2:
+                return False
+            snapshot = [(s, set(s.deleted)) for s in victims]
+            merged = Segment(self._next_id)
+            self._next_id += 1
+
+        origin: List[Tuple[Segment, int]] = []
+        for seg, deleted in sorted(snapshot, key=lambda x: x[0].seg_id):
+            for i in range(len(seg)):
+                if i in deleted:
+                    continue
+                merged.add_stats(seg.texts[i], seg.doc_tfs[i], seg.doc_len[i], seg.sources[i], seg.metas[i])
+                origin.append((seg, i))
+
+        with self._lock:
+            # docs deleted or replaced while merging become tombstones of the merged segment
+            for j, (seg, i) in enumerate(origin):
+                if self._loc.get(merged.sources[j]) == (seg, i):
+                    self._loc[merged.sources[j]] = (merged, j)
+                else:
+                    merged.deleted.add(j)
+            victim_ids = {s.seg_id for s in victims}
+            keep = [s for s in self._segments if s.seg_id not in victim_ids]
+            # the merged segment takes the position of the oldest victim
+            pos = min(i for i, s in enumerate(self._segments) if s.seg_id in victim_ids)
+            keep.insert(pos, merged)
+            self._segments = keep
+            if self.segment_dir:
+                merged.save(self.segment_dir)
+                self._write_manifest()
+                for s in victims:
+                    try:
+                        (self.segment_dir / s.file_name).unlink()
+                    except FileNotFoundError:
+                        pass
+        return True
+
+    def start_merger(self, interval_s: float = 5.0, checkpoint: bool = True) -> None:
+        """Background thread that compacts segments (and checkpoints, if persistent) every interval_s."""
+        self._check_writable()
+        if self._merger is not None:
+            return
+        def loop():
+            while not self._stop.wait(interval_s):
+                try:
+                    while self.merge():
+                        pass
+                    if checkpoint and self.segment_dir:
+                        self.checkpoint()
+                except Exception as e:
+                    print(f"[WARN] segment merge failed: {e}")
+        self._stop.clear()
+        self._merger = threading.Thread(target=loop, name="bm25-merger", daemon=True)
+        self._merger.start()
+
+    def stop_merger(self) -> None:
+        if self._merger is not None:
+            self._stop.set()
+            self._merger.join()
+            self._merger = None
+
+    # ---------- Search ----------
+    def __len__(self) -> int:
+        return self._n
+
+    def _idf(self, term: str) -> float:
+        # BM25Okapi idf; negative idf (very frequent terms) is floored at epsilon * average idf
+        n = self._n
+        df = self._df.get(term, 0)
+        idf = math.log(n - df + 0.5) - math.log(df + 0.5)
+        if idf >= 0:
+            return idf
+        return self.epsilon * self._average_idf()
+
+    def _average_idf(self) -> float:
+        # O(vocabulary): refreshed only when the live doc count moved by more than 1%
+        if self._avg_idf is None or abs(self._n - self._avg_idf_n) > 0.01 * max(1, self._avg_idf_n):
+            n = self._n
+            terms = [df for df in self._df.values() if df > 0]
+            total = sum(math.log(n - df + 0.5) - math.log(df + 0.5) for df in terms)
+            self._avg_idf = total / len(terms) if terms else 0.0
+            self._avg_idf_n = n
+        return self._avg_idf
+
+    def search(self, query: str, k: int = 5) -> List[Dict]:
+        self.refresh()
+        with self._lock:
+            # the memtable keeps growing after the lock is released: capture each segment's doc
+            # count and tombstones so the scan below only sees docs that were complete here
+            views = [(seg, len(seg.texts), frozenset(seg.deleted)) for seg in self._segments + [self._mem]]
+            n = self._n
+            avgdl = (self._total_len / n) if n else 0.0
+            q_tokens = _simple_tokenize(query)
+            idfs = [(t, self._idf(t)) for t in q_tokens] if n else []
+
+        scores: Dict[Tuple[int, int], float] = {}
+        seg_by_id = {seg.seg_id: seg for seg, _, _ in views}
+        k1, b = self.k1, self.b
+        for term, idf in idfs:
+            for seg, bound, deleted in views:
+                posting = seg.postings.get(term)
+                if not posting:
+                    continue
+                dl = seg.doc_len
+                for i, tf in posting:
+                    if i >= bound or i in deleted:
+                        continue
+                    denom = tf + k1 * (1 - b + b * dl[i] / avgdl)
+                    key = (seg.seg_id, i)
+                    scores[key] = scores.get(key, 0.0) + idf * tf * (k1 + 1) / denom
+
+        top = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+        hits = [self._hit(seg_by_id[sid], i, s) for (sid, i), s in top]
+        if len(hits) < k:
+            # like BM25Client, pad with zero-score docs when few docs match
+            seen = {key for key, _ in top}
+            for seg, bound, deleted in views:
+                for i in range(bound):
+                    if len(hits) >= k:
+                        break
+                    if i not in deleted and (seg.seg_id, i) not in seen:
+                        hits.append(self._hit(seg, i, 0.0))
+        return hits
+
+    def _hit(self, seg: Segment, i: int, score: float) -> Dict:
+        return {"text": seg.texts[i], "score": float(score), "source": seg.sources[i], "meta": seg.metas[i]}
+
+    def stats(self) -> Dict:
+        self.refresh()
+        with self._lock:
+            return {
+                "live_docs": self._n,
+                "segments": len(self._segments),
+                "memtable_docs": len(self._mem),
+                "tombstones": sum(len(s.deleted) for s in self._segments) + len(self._mem.deleted),
+                "vocabulary": sum(1 for v in self._df.values() if v > 0),
+            }
+
+
+def open_bm25(kb_path: str | Path = "data/kb/bm25.jsonl", index_dir: Optional[str | Path] = None):
+    """
+    Lexical engine for serving: the segmented index in index_dir (default: $BM25_INDEX_DIR),
+    opened read-only so it follows the writer's checkpoints, else BM25Client over the KB JSONL.
+    """
+    index_dir = index_dir if index_dir is not None else os.getenv("BM25_INDEX_DIR", "")
+    if index_dir:
+        if (Path(index_dir) / MANIFEST).exists():
+            return SegmentedBM25.open(index_dir)
+        print(f"[WARN] {index_dir} has no {MANIFEST} (build it with `python -m retrieval.segmented_bm25`); using {kb_path}")
+    return BM25Client(str(kb_path))
+
+
+# ---------- CLI ----------
+
+def main():
+    import argparse
+    from retrieval.bm25_builder import build_index
+    ap = argparse.ArgumentParser(description="Create a persistent segmented BM25 index from the KB JSONL.")
+    ap.add_argument("--kb_jsonl", default="data/kb/bm25.jsonl")
+    ap.add_argument("--index_dir", default="data/kb/bm25_segments")
+    ap.add_argument("--workers", type=int, default=None, help="build processes (default: all cores)")
+    args = ap.parse_args()
+
+    stats = build_index(args.kb_jsonl, args.index_dir, workers=args.workers)
+    print(f"✅ Segmented BM25 index with {stats['docs']} chunks → {args.index_dir}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# retrieval/singleflight.py
+"""
+Request coalescing ("singleflight"): concurrent calls with the same key share ONE in-flight
+computation and all receive its result (or its exception). Nothing is kept once the flight
+lands, so this collapses bursts of identical requests without being a cache.
+
+- SingleFlight.do(key, fn)          threads (retrieval pool, Streamlit, scripts)
+- SingleFlight.ado(key, coro_fn)    asyncio (API event loop)
+- StreamFlight.stream(key, factory) shares one token stream: late joiners replay the pieces
+                                    generated so far, then follow live. Whichever subscriber
+                                    needs the next piece pulls it, so any of them may leave
+                                    early; the source is closed when the last one leaves.
+
+Env vars:
+  - SINGLEFLIGHT   "0" disables coalescing (default "1")
+"""
+from __future__ import annotations
+import asyncio
+import os
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+def singleflight_enabled() -> bool:
+    return os.getenv("SINGLEFLIGHT", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+
+def query_key(query: str, *params: Hashable) -> Tuple:
+    """Flight key: case/whitespace-normalized query plus the parameters that change the result."""
+    return (re.sub(r"\s+", " ", (query or "").strip().lower()),) + params
+
+
+class _Call:
+    __slots__ = ("event", "result", "exc")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.exc: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Run fn() once per key at a time. Returns (result, shared); shared=True for followers."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.exc is not None:
+                raise call.exc
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.exc = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def ado(self, key: Hashable, coro_fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Async counterpart of do(). The shared task survives a cancelled caller while others wait."""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(coro_fn())
+            task.add_done_callback(lambda t, k=key: self._tasks.pop(k, None) if self._tasks.get(k) is t else None)
+        return await asyncio.shield(task), shared
+
+
+class _Broadcast:
+    def __init__(self, source: Iterator[str]) -> None:
+        self.source = source
+        self.pieces: List[str] = []
+        self.done = False
+        self.exc: Optional[BaseException] = None
+        self.pulling = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+
+class StreamFlight:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Broadcast] = {}
+        self.coalesced = 0
+
+    def stream(self, key: Hashable, factory: Callable[[], Iterator[str]]) -> Tuple[Iterator[str], bool]:
+        """Returns (pieces, shared). factory() is only called by the first subscriber of a flight."""
+        with self._lock:
+            b = self._flights.get(key)
+            shared = b is not None
+            if shared:
+                self.coalesced += 1
+            else:
+                b = self._flights[key] = _Broadcast(factory())
+            with b.cond:
+                b.subscribers += 1
+        return self._follow(key, b), shared
+
+    def _land(self, key: Hashable, b: _Broadcast) -> None:
+        with self._lock:
+            if self._flights.get(key) is b:
+                del self._flights[key]
+
+    def _follow(self, key: Hashable, b: _Broadcast) -> Iterator[str]:
+        i = 0
+        try:
+            while True:
+                with b.cond:
+                    while i >= len(b.pieces) and not b.done and b.pulling:
+                        b.cond.wait()
+                    if i < len(b.pieces):
+                        piece = b.pieces[i]
+                        i += 1
+                    elif b.done:
+                        if b.exc is not None:
+                            raise b.exc
+                        return
+                    else:
+                        b.pulling = True
+                        piece = None
+                if piece is not None:
+                    yield piece
+                    continue
+                # this subscriber pulls the next piece from the source (outside the lock)
+                finished, exc = False, None
+                try:
+                    nxt = next(b.source)
+                except StopIteration:
+                    finished = True
+                except BaseException as e:
+                    finished, exc = True, e
+                if finished:
+                    self._land(key, b)
+                with b.cond:
+                    b.pulling = False
+                    if finished:
+                        b.done, b.exc = True, exc
+                    else:
+                        b.pieces.append(nxt)
+                    b.cond.notify_all()
+        finally:
+            with b.cond:
+                b.subscribers -= 1
+                abandoned = b.subscribers == 0 and not b.done
+                if abandoned:
+                    b.done = True
+            if abandoned:
+                self._land(key, b)
+                b.source.close()  # nobody is listening: stop the generation
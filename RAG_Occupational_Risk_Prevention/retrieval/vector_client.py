@@ -1,11 +1,16 @@
 from __future__ import annotations
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import json
+import os
+import re
+import time
 from pathlib import Path
 
 import chromadb
 from chromadb.utils import embedding_functions
 
+from retrieval.microbatch import MicroBatcher
+
 
 def _to_similarity(distance: float) -> float:
     # Chroma returns distance (lower = better). Convert to approximate similarity 0..1
@@ -30,39 +35,168 @@ def _sanitize_meta(meta: Optional[dict]) -> dict:
     return out
 
 
+def kb_record_to_chroma(obj: dict, fallback_id: str) -> Optional[Tuple[str, str, Dict]]:
+    """
+    Map one KB JSONL record to (id, document, metadata) for Chroma.
+    Returns None for empty chunks.
+    """
+    text   = obj.get("text", "") or ""
+    source = obj.get("source", fallback_id)
+    meta   = dict(obj.get("meta", {}) or {})
+    if not text.strip():
+        return None
+
+    # ensure 'year' is int if possible, and always add 'source'
+    year = meta.get("year")
+    if year is not None:
+        try:
+            meta["year"] = int(year)
+        except Exception:
+            meta["year"] = str(year)
+    sanitized = _sanitize_meta(meta)
+    sanitized["source"] = str(source)
+
+    # unique id per chunk; E5: 'passage:' prefix
+    return str(source), f"passage: {text}", sanitized
+
+
+# ------- Collection aliases (blue/green reindexing) -------
+# A logical name ("osha") points to a physical versioned collection. Chroma only accepts
+# [a-zA-Z0-9._-] in names, so version 12 of "osha" is stored as "osha.v12" (shown as osha@v12).
+ALIASES_FILE = "aliases.json"
+
+def versioned_name(alias: str, version: int) -> str:
+    return f"{alias}.v{int(version)}"
+
+def parse_version(alias: str, name: str) -> Optional[int]:
+    m = re.fullmatch(re.escape(alias) + r"\.v(\d+)", name)
+    return int(m.group(1)) if m else None
+
+def load_aliases(persist_dir: str | Path) -> Dict[str, Dict]:
+    path = Path(persist_dir) / ALIASES_FILE
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_alias(persist_dir: str | Path, alias: str, collection: str) -> None:
+    """Point `alias` to `collection`. Atomic: readers see either the old or the new file."""
+    path = Path(persist_dir) / ALIASES_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    aliases = load_aliases(persist_dir)
+    prev = aliases.get(alias) or {}
+    # collections that have been served, so gc_versions can tell them from builds that never went live
+    history = prev.get("history") or ([prev["collection"]] if prev.get("collection") else [])
+    history = [c for c in history if c != collection][-49:] + [collection]
+    aliases[alias] = {"collection": collection, "updated_utc": time.time(), "history": history}
+    tmp = path.with_suffix(f".tmp{os.getpid()}")
+    tmp.write_text(json.dumps(aliases, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _env_flag(name: str, default: str = "1") -> bool:
+    return os.getenv(name, default).strip().lower() not in {"0", "false", "no", "off"}
+
+
 class VectorClient:
+    """
+    Chroma + Sentence-Transformers client. `collection` may be an alias (see ALIASES_FILE):
+    it is resolved on every search, so a blue/green swap done by another process
+    (python -m ingestion.index_vectors --reset) is picked up without restarting the app.
+
+    Query embeddings of concurrent searches (API threads) are micro-batched into one encoder
+    forward pass (retrieval/microbatch.py). Env vars:
+      - EMBED_MICROBATCH     "0" disables it (default "1")
+      - EMBED_BATCH_MAX      max queries per forward pass (default 32)
+      - EMBED_BATCH_WAIT_MS  max wait for more queries after the first one (default 5)
+    """
     def __init__(self, persist_dir: str = "data/chroma", collection: str = "osha", model_name: Optional[str] = None):
-        self.client = chromadb.PersistentClient(path=persist_dir)
+        self.persist_dir = str(persist_dir)
+        self.alias = collection
+        self.client = chromadb.PersistentClient(path=self.persist_dir)
         self.model_name = model_name or "intfloat/multilingual-e5-small"
         self.embedder = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=self.model_name)
-        self.col = self.client.get_or_create_collection(name=collection, embedding_function=self.embedder)
+        self._aliases_path = Path(self.persist_dir) / ALIASES_FILE
+        self._aliases_mtime: Optional[float] = None
+        self.col = self.client.get_or_create_collection(name=self.resolve(), embedding_function=self.embedder)
+        self._query_batcher: Optional[MicroBatcher] = None
+        if _env_flag("EMBED_MICROBATCH"):
+            self._query_batcher = MicroBatcher(
+                self._encode,
+                max_batch=int(os.getenv("EMBED_BATCH_MAX", "32")),
+                max_wait_ms=float(os.getenv("EMBED_BATCH_WAIT_MS", "5")),
+                name="query-encoder",
+            )
+
+    # ------- Alias resolution -------
+    def resolve(self) -> str:
+        """Physical collection name currently served for this client's alias."""
+        try:
+            self._aliases_mtime = self._aliases_path.stat().st_mtime
+        except FileNotFoundError:
+            self._aliases_mtime = None
+        entry = load_aliases(self.persist_dir).get(self.alias)
+        return entry["collection"] if entry else self.alias
+
+    def _refresh_alias(self) -> None:
+        # one stat() per call; the alias file is only re-read when it changed
+        try:
+            mtime = self._aliases_path.stat().st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._aliases_mtime:
+            return
+        name = self.resolve()
+        if name != self.col.name:
+            self.col = self.client.get_collection(name=name, embedding_function=self.embedder)
 
     # ------- Search (E5 requires prefixes 'query:' / 'passage:') -------
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        return [list(map(float, e)) for e in self.embedder(texts)]
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Query embeddings; with micro-batching they share a forward pass with concurrent searches."""
+        texts = [f"query: {q}" for q in queries]
+        if self._query_batcher is None:
+            return self._encode(texts)
+        return self._query_batcher.map(texts)
+
     def search(self, query: str, k: int = 5) -> List[Dict]:
+        return self.search_many([query], k=k)[0]
+
+    def search_many(self, queries: List[str], k: int = 5) -> List[List[Dict]]:
+        """Several queries in one Chroma call (the query embeddings are computed as one batch)."""
+        if not queries:
+            return []
+        self._refresh_alias()
         res = self.col.query(
-            query_texts=[f"query: {query}"],
+            query_embeddings=self.embed_queries(queries),
             n_results=k,
             include=["documents", "metadatas", "distances"],
         )
-        docs  = (res.get("documents")  or [[]])[0]
-        metas = (res.get("metadatas")  or [[]])[0]
-        dists = (res.get("distances")  or [[]])[0]
-        out: List[Dict] = []
-        for t, m, d in zip(docs, metas, dists):
-            out.append({
-                "text": t,  # may come prefixed with 'passage:' (that’s fine)
-                "score": _to_similarity(d),
-                "source": (m or {}).get("source", "?"),
-                "meta": m or {}
-            })
-        return out
+        all_docs  = res.get("documents")  or [[] for _ in queries]
+        all_metas = res.get("metadatas")  or [[] for _ in queries]
+        all_dists = res.get("distances")  or [[] for _ in queries]
+        results: List[List[Dict]] = []
+        for docs, metas, dists in zip(all_docs, all_metas, all_dists):
+            out: List[Dict] = []
+            for t, m, d in zip(docs, metas, dists):
+                out.append({
+                    "text": t,  # may come prefixed with 'passage:' (that’s fine)
+                    "score": _to_similarity(d),
+                    "source": (m or {}).get("source", "?"),
+                    "meta": m or {}
+                })
+            results.append(out)
+        return results
 
     # ------- Indexing from JSONL (BM25 KB) -------
-    def index_from_jsonl(self, kb_jsonl: str | Path, batch_size: int = 512) -> int:
+    def index_from_jsonl(self, kb_jsonl: str | Path, batch_size: int = 512, col=None) -> int:
         """
         Reads JSONL lines with fields: text, source, meta{file,family,year}, and uploads them to Chroma.
         - Adds 'passage:' prefix to the text (recommended for E5).
         - Copies metadata and 'source' into Chroma metadata (no None values).
+        - col: target collection (default: the one currently served).
         """
         kb_jsonl = Path(kb_jsonl)
         if not kb_jsonl.exists():
@@ -75,7 +209,7 @@ class VectorClient:
 
         def flush():
             if ids:
-                self.col.add(ids=ids, documents=docs, metadatas=metas)
+                self.add_batch(ids, docs, metas, col=col)
                 ids.clear(); docs.clear(); metas.clear()
 
         with kb_jsonl.open("r", encoding="utf-8") as f:
@@ -83,29 +217,11 @@ class VectorClient:
                 line = line.strip()
                 if not line:
                     continue
-                obj = json.loads(line)
-                text   = obj.get("text", "") or ""
-                source = obj.get("source", f"{kb_jsonl.name}#{i}")
-                meta   = obj.get("meta", {}) or {}
-
-                if not text.strip():
+                rec = kb_record_to_chroma(json.loads(line), fallback_id=f"{kb_jsonl.name}#{i}")
+                if rec is None:
                     # skip empty chunks
                     continue
-
-                # prepare sanitized metadata
-                # ensure 'year' is int if possible, and always add 'source'
-                year = meta.get("year")
-                if year is not None:
-                    try:
-                        meta["year"] = int(year)
-                    except Exception:
-                        meta["year"] = str(year)
-                sanitized = _sanitize_meta(meta)
-                sanitized["source"] = str(source)
-
-                ids.append(str(source))                 # unique id per chunk
-                docs.append(f"passage: {text}")         # E5: 'passage:' prefix
-                metas.append(sanitized)
+                ids.append(rec[0]); docs.append(rec[1]); metas.append(rec[2])
                 n += 1
 
                 # batch flush
@@ -116,9 +232,102 @@ class VectorClient:
         flush()
         return n
 
+    def embed_passages(self, docs: List[str]) -> List[List[float]]:
+        """Embed already-prefixed passages (see kb_record_to_chroma) without writing them."""
+        return self._encode(docs)
+
+    def add_batch(
+        self,
+        ids: List[str],
+        docs: List[str],
+        metas: List[Dict],
+        embeddings: Optional[List[List[float]]] = None,
+        col=None,
+    ) -> None:
+        """Write one batch to the collection. If embeddings are given Chroma skips its own embedding pass."""
+        if not ids:
+            return
+        col = col if col is not None else self.col
+        if embeddings is not None:
+            col.add(ids=ids, documents=docs, metadatas=metas, embeddings=embeddings)
+        else:
+            col.add(ids=ids, documents=docs, metadatas=metas)
+
     def reset_collection(self):
-        """Clear the current collection (⚠️ deletes everything)."""
+        """Clear the current collection (⚠️ deletes everything; serving clients see an empty index until reindexed).
+        Prefer build_version + swap_alias for zero-downtime rebuilds."""
         name = self.col.name
         self.client.delete_collection(name)
         # recreate
         self.col = self.client.get_or_create_collection(name=name, embedding_function=self.embedder)
+
+    # ------- Blue/green versions -------
+    def _collection_names(self) -> List[str]:
+        # chromadb<0.6 returns Collection objects, newer versions return names
+        return [getattr(c, "name", c) for c in self.client.list_collections()]
+
+    def list_versions(self) -> List[int]:
+        vs = [parse_version(self.alias, n) for n in self._collection_names()]
+        return sorted(v for v in vs if v is not None)
+
+    def build_version(self, kb_jsonl: str | Path, batch_size: int = 512) -> Tuple[str, int]:
+        """
+        Index kb_jsonl into a new versioned collection (alias.vN+1) next to the live one.
+        Serving keeps using the current alias target. Returns (collection_name, n_indexed).
+        If indexing fails the new collection is deleted.
+        """
+        versions = self.list_versions()
+        name = versioned_name(self.alias, (versions[-1] + 1) if versions else 1)
+        col = self.client.create_collection(name=name, embedding_function=self.embedder)
+        try:
+            n = self.index_from_jsonl(kb_jsonl, batch_size=batch_size, col=col)
+        except BaseException:  # embedder error, bad line, Ctrl-C: never leave a half-filled version
+            self.client.delete_collection(name)
+            raise
+        return name, n
+
+    def smoke_test(self, name: str, expected: int, probe_query: str = "safety") -> None:
+        """Raise if the collection `name` is not ready to serve (wrong count or no hits)."""
+        col = self.client.get_collection(name=name, embedding_function=self.embedder)
+        got = col.count()
+        if got != expected:
+            raise RuntimeError(f"Smoke test failed for {name}: {got} chunks, expected {expected}")
+        if expected:
+            res = col.query(query_texts=[f"query: {probe_query}"], n_results=1, include=["documents"])
+            if not (res.get("documents") or [[]])[0]:
+                raise RuntimeError(f"Smoke test failed for {name}: probe query returned no hits")
+
+    def swap_alias(self, name: str) -> None:
+        """Atomically point the alias to `name`; this client and all others switch on their next search."""
+        save_alias(self.persist_dir, self.alias, name)
+        self.col = self.client.get_collection(name=name, embedding_function=self.embedder)
+        self._aliases_mtime = self._aliases_path.stat().st_mtime
+
+    def gc_versions(self, keep: int = 2) -> List[str]:
+        """
+        Drop old versions, keeping the `keep` newest that have been served (the live one always
+        survives, and keeping the previous one lets in-flight queries on it finish). The legacy
+        unversioned collection named like the alias counts as version 0. Versions that never went
+        live (a crashed build) do not count as rollback targets: older than the live one they are
+        dropped, newer ones are left alone (another process may still be building them).
+        Returns deleted names.
+        """
+        live = self.resolve()
+        live_v = parse_version(self.alias, live)
+        entry = load_aliases(self.persist_dir).get(self.alias) or {}
+        history = set(entry["history"]) if "history" in entry else None  # None: written before history was kept
+        served: List[str] = []
+        stale: List[str] = []
+        for v in self.list_versions():
+            name = versioned_name(self.alias, v)
+            if history is None or name in history or name == live:
+                served.append(name)
+            elif live_v is not None and v < live_v:
+                stale.append(name)
+        if live != self.alias and self.alias in self._collection_names():
+            served.insert(0, self.alias)
+        keep_names = set(served[-max(1, keep):]) | {live}
+        doomed = [n for n in served if n not in keep_names] + stale
+        for name in doomed:
+            self.client.delete_collection(name)
+        return doomed
@@ -1,5 +1,7 @@
 from __future__ import annotations
 import argparse, csv, json, time, pathlib, sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Set, Tuple
 
 # --- local imports (from repo root) ---
 ROOT = pathlib.Path(__file__).resolve().parents[1]
@@ -7,16 +9,32 @@ sys.path.append(str(ROOT))
 
 from retrieval.retrieval import HybridRetriever  # make sure it is implemented
 from app.llm.generate import generate_answer     # uses Ollama by default if active
-
-def load_questions(path: pathlib.Path) -> list[str]:
+from app.llm.answer_cache import cache_enabled, get_cache
+
+# Running:
+# python -m scripts.batch_qa --questions evaluation/datasets/ad_hoc_questions.jsonl --concurrency 4
+# Split across machines (each shard writes its own *.shard<i>of<n> outputs; re-running resumes):
+# python -m scripts.batch_qa --shard 0/2    and    python -m scripts.batch_qa --shard 1/2
+
+HEADERS = [
+    "id","query","retriever","topk","fanout","ctx_len",
+    "latency_ms_retrieval","latency_ms_llm",
+    "answer",
+    "sources",          # separated by ' | '
+    "sources_count",
+    "used_text_preview" # first ~200 chars of the first passage
+]
+
+def load_questions(path: pathlib.Path) -> list[Tuple[int, str]]:
+    """(id, question) pairs; the id is the 1-based position in the file unless a JSONL line has 'id'."""
     if not path.exists():
         raise FileNotFoundError(f"Questions file not found: {path}")
-    qs: list[str] = []
+    qs: list[Tuple[int, str]] = []
     if path.suffix.lower() in {".txt"}:
         for line in path.read_text(encoding="utf-8").splitlines():
             line = line.strip()
             if line:
-                qs.append(line)
+                qs.append((len(qs) + 1, line))
     elif path.suffix.lower() in {".jsonl"}:
         for line in path.read_text(encoding="utf-8").splitlines():
             if not line.strip():
@@ -24,11 +42,64 @@ def load_questions(path: pathlib.Path) -> list[str]:
             obj = json.loads(line)
             q = obj.get("query") or obj.get("question")
             if q:
-                qs.append(str(q))
+                qs.append((obj.get("id", len(qs) + 1), str(q)))
     else:
         raise ValueError("Unsupported format; use .txt (one question per line) or .jsonl ({'query': ...}).")
     return qs
 
+def parse_shard(spec: Optional[str]) -> Tuple[int, int]:
+    """'i/n' with 0 <= i < n → (i, n)."""
+    if not spec:
+        return 0, 1
+    i, n = (int(x) for x in spec.split("/"))
+    if n < 1 or not 0 <= i < n:
+        raise ValueError(f"Invalid --shard {spec!r}; expected i/n with 0 <= i < n")
+    return i, n
+
+def shard_path(path: pathlib.Path, i: int, n: int) -> pathlib.Path:
+    return path if n == 1 else path.with_name(f"{path.stem}.shard{i}of{n}{path.suffix}")
+
+def done_ids(out_jsonl: pathlib.Path) -> Set:
+    """Ids already answered in a previous (possibly interrupted) run."""
+    ids: Set = set()
+    if not out_jsonl.exists():
+        return ids
+    data = out_jsonl.read_bytes()
+    if data and not data.endswith(b"\n"):
+        # drop a record cut by a crash so the appended ones start on a fresh line
+        out_jsonl.write_bytes(data[:data.rfind(b"\n") + 1])
+    with out_jsonl.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                ids.add(json.loads(line)["id"])
+            except (json.JSONDecodeError, KeyError):
+                continue  # a line cut by a crash; that question is simply redone
+    return ids
+
+def prune_csv(out_csv: pathlib.Path, keep_ids: Set) -> None:
+    """Keep only CSV rows whose id is in the JSONL checkpoint (rows of unfinished questions are redone)."""
+    if not out_csv.exists():
+        return
+    keep = {str(i) for i in keep_ids}
+    with out_csv.open("r", encoding="utf-8", newline="") as f:
+        rows = [r for r in csv.DictReader(f) if r.get("id") in keep]
+    with out_csv.open("w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=HEADERS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def answer_one(q: str, ctx: List[Dict], use_cache: bool, refresh: bool) -> Tuple[str, int, bool]:
+    """(answer, llm_ms, ok); a failed generation returns ok=False and an '[ERROR LLM] ...' answer."""
+    t0 = time.time()
+    ok = True
+    try:
+        # batch priority: interactive users of this process go first (app/llm/scheduler.py)
+        ans = (generate_answer(q, ctx, use_cache=use_cache, refresh=refresh, priority="batch")
+               if ctx else "Not enough context to generate an answer.")
+    except Exception as e:
+        ans, ok = f"[ERROR LLM] {e}", False
+    return ans, int((time.time() - t0) * 1000), ok
+
 def main():
     ap = argparse.ArgumentParser(description="Batch QA: run questions, perform RAG, and save results.")
     ap.add_argument("--questions", default="evaluation/datasets/ad_hoc_questions.txt", help="TXT (1/line) or JSONL with field 'query'")
@@ -40,90 +111,126 @@ def main():
     ap.add_argument("--max_ctx", type=int, default=6, help="number of passages used for generation")
     ap.add_argument("--out_csv", default=str(ROOT / "reports" / "batch_qa.csv"))
     ap.add_argument("--out_jsonl", default=str(ROOT / "reports" / "batch_qa.jsonl"))
+    ap.add_argument("--no_cache", action="store_true", help="bypass the answer cache (always call the LLM)")
+    ap.add_argument("--refresh_cache", action="store_true", help="regenerate every answer and overwrite the cache")
+    ap.add_argument("--concurrency", type=int, default=4, help="LLM requests in flight (match OLLAMA_NUM_PARALLEL)")
+    ap.add_argument("--retrieval_batch", type=int, default=16, help="questions per batched retrieval call")
+    ap.add_argument("--shard", default=None, help="i/n: only run questions whose position %% n == i")
+    ap.add_argument("--no_resume", action="store_true", help="start from scratch instead of skipping ids already in out_jsonl")
     args = ap.parse_args()
 
+    shard_i, shard_n = parse_shard(args.shard)
     questions_path = pathlib.Path(args.questions)
-    out_csv = pathlib.Path(args.out_csv)
-    out_jsonl = pathlib.Path(args.out_jsonl)
+    out_csv = shard_path(pathlib.Path(args.out_csv), shard_i, shard_n)
+    out_jsonl = shard_path(pathlib.Path(args.out_jsonl), shard_i, shard_n)
     out_csv.parent.mkdir(parents=True, exist_ok=True)
     out_jsonl.parent.mkdir(parents=True, exist_ok=True)
 
-    # Load questions
-    questions = load_questions(questions_path)
-    if not questions:
+    # Load questions (this shard only) and skip the ones already answered
+    questions = [qa for pos, qa in enumerate(load_questions(questions_path)) if pos % shard_n == shard_i]
+    if args.no_resume:
+        for p in (out_csv, out_jsonl):
+            p.unlink(missing_ok=True)
+    skip = done_ids(out_jsonl)
+    prune_csv(out_csv, skip)
+    todo = [(qid, q) for qid, q in questions if qid not in skip]
+    if skip:
+        print(f"[INFO] Resuming: {len(questions) - len(todo)} questions already in {out_jsonl}")
+    if not todo:
         print("⚠️ No questions to run.")
         return
 
     # Load hybrid retriever
     retr = HybridRetriever(bm25_kb_path=args.kb_bm25, chroma_dir=args.chroma_dir, chroma_collection=args.collection)
 
-    # CSV headers
-    headers = [
-        "id","query","retriever","topk","fanout","ctx_len",
-        "latency_ms_retrieval","latency_ms_llm",
-        "answer",
-        "sources",          # separated by ' | '
-        "sources_count",
-        "used_text_preview" # first ~200 chars of the first passage
-    ]
-
-    rows = []
-    with out_jsonl.open("w", encoding="utf-8") as fj:
-        with out_csv.open("w", encoding="utf-8", newline="") as fc:
-            writer = csv.DictWriter(fc, fieldnames=headers)
+    use_cache, refresh = not args.no_cache, args.refresh_cache
+    new_csv = not out_csv.exists() or out_csv.stat().st_size == 0
+    t_start = time.time()
+    llm_ms_total = 0
+    n_done = 0
+    n_failed = 0
+
+    # Append + flush per record: a crash loses at most the requests in flight
+    with out_jsonl.open("a", encoding="utf-8") as fj, \
+         out_csv.open("a", encoding="utf-8", newline="") as fc, \
+         ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        writer = csv.DictWriter(fc, fieldnames=HEADERS)
+        if new_csv:
             writer.writeheader()
 
-            for i, q in enumerate(questions, start=1):
-                # --- Retrieval ---
-                t0 = time.time()
-                hits = retr.search(q, k=args.topk, fanout=args.fanout)  # assumes internal RRF
-                t1 = time.time()
-                retrieval_ms = int((t1 - t0) * 1000)
-
-                # Context for LLM
-                ctx = [{"text": h["text"], "source": h["source"]} for h in (hits[:args.max_ctx] if hits else [])]
-
-                # --- LLM ---
-                t2 = time.time()
-                try:
-                    ans = generate_answer(q, ctx) if ctx else "Not enough context to generate an answer."
-                except Exception as e:
-                    ans = f"[ERROR LLM] {e}"
-                t3 = time.time()
-                llm_ms = int((t3 - t2) * 1000)
-
-                sources = [c["source"] for c in ctx]
-                used_preview = (ctx[0]["text"][:200] + "…") if ctx else ""
-
-                rec = {
-                    "id": i,
-                    "query": q,
-                    "retriever": "hybrid",
-                    "topk": args.topk,
-                    "fanout": args.fanout,
-                    "ctx_len": len(ctx),
-                    "latency_ms_retrieval": retrieval_ms,
-                    "latency_ms_llm": llm_ms,
-                    "answer": ans,
-                    "sources": " | ".join(sources),
-                    "sources_count": len(sources),
-                    "used_text_preview": used_preview,
-                }
-                writer.writerow(rec)
-                rows.append(rec)
-
-                # Detailed JSONL (useful for auditing/post-mortem)
-                fj.write(json.dumps({
-                    "id": i,
-                    "query": q,
-                    "hits": hits,      # includes text and metadata
-                    "ctx": ctx,
-                    "answer": ans,
-                    "latency_ms": {"retrieval": retrieval_ms, "llm": llm_ms}
-                }, ensure_ascii=False) + "\n")
-
-                print(f"✓ [{i}/{len(questions)}] '{q}'  (retrieval {retrieval_ms}ms, llm {llm_ms}ms)")
-
+        pending: Dict[Future, Tuple] = {}
+
+        def drain(block_until: int) -> None:
+            """Write finished answers until at most `block_until` requests are in flight."""
+            nonlocal llm_ms_total, n_done, n_failed
+            while len(pending) > block_until:
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    qid, q, hits, ctx, retrieval_ms = pending.pop(fut)
+                    ans, llm_ms, ok = fut.result()
+                    llm_ms_total += llm_ms
+                    n_done += 1
+
+                    sources = [c["source"] for c in ctx]
+                    rec = {
+                        "id": qid,
+                        "query": q,
+                        "retriever": "hybrid",
+                        "topk": args.topk,
+                        "fanout": args.fanout,
+                        "ctx_len": len(ctx),
+                        "latency_ms_retrieval": retrieval_ms,
+                        "latency_ms_llm": llm_ms,
+                        "answer": ans,
+                        "sources": " | ".join(sources),
+                        "sources_count": len(sources),
+                        "used_text_preview": (ctx[0]["text"][:200] + "…") if ctx else "",
+                    }
+                    writer.writerow(rec)
+                    fc.flush()
+
+                    if not ok:
+                        # not checkpointed: the next run prunes this CSV row and asks again
+                        n_failed += 1
+                        print(f"✗ [{n_done}/{len(todo)}] #{qid} '{q}'  {ans}")
+                        continue
+
+                    # Detailed JSONL (useful for auditing/post-mortem)
+                    fj.write(json.dumps({
+                        "id": qid,
+                        "query": q,
+                        "hits": hits,      # includes text and metadata
+                        "ctx": ctx,
+                        "answer": ans,
+                        "latency_ms": {"retrieval": retrieval_ms, "llm": llm_ms}
+                    }, ensure_ascii=False) + "\n")
+                    fj.flush()
+
+                    print(f"✓ [{n_done}/{len(todo)}] #{qid} '{q}'  (retrieval {retrieval_ms}ms, llm {llm_ms}ms)")
+
+        for b in range(0, len(todo), args.retrieval_batch):
+            batch = todo[b:b + args.retrieval_batch]
+            # --- Retrieval (batched: one dense call for the whole batch) ---
+            t0 = time.time()
+            batch_hits = retr.search_many([q for _, q in batch], k=args.topk, fanout=args.fanout)
+            retrieval_ms = int((time.time() - t0) * 1000 / len(batch))  # amortized per question
+
+            # --- LLM (at most `concurrency` running, a few more queued) ---
+            for (qid, q), hits in zip(batch, batch_hits):
+                ctx = [{"text": h["text"], "source": h["source"], "score": h.get("score")} for h in (hits[:args.max_ctx] if hits else [])]
+                fut = pool.submit(answer_one, q, ctx, use_cache, refresh)
+                pending[fut] = (qid, q, hits, ctx, retrieval_ms)
+                drain(block_until=2 * args.concurrency)
+        drain(block_until=0)
+
+    wall_s = time.time() - t_start
+    print(f"\n[INFO] {n_done} questions in {wall_s:.1f}s wall; LLM time {llm_ms_total / 1000:.1f}s "
+          f"(effective concurrency {llm_ms_total / 1000 / wall_s if wall_s else 0:.1f}x)")
+    if n_failed:
+        print(f"[WARN] {n_failed} generations failed and were not checkpointed; re-run to retry them")
+    if cache_enabled() and use_cache:
+        cs = get_cache().stats()
+        print(f"[INFO] Answer cache: {cs['hits']} hits / {cs['misses']} misses ({cs['entries']} entries)")
     print(f"\n✅ Saved: {out_csv}")
     print(f"✅ Saved: {out_jsonl}")
     print("Done.")
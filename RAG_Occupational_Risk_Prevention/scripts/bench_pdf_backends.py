@@ -0,0 +1,69 @@
+# Running:
+# python -m scripts.bench_pdf_backends --pdf data/raw/OSHA2001.pdf --repeat 3
+from __future__ import annotations
+import argparse, csv, pathlib, sys, time
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from ingestion.pdf_backends import available_backends, extract_pages, extract_pdf_text, passes_quality, text_quality
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark PDF text extraction backends (pages/sec, chars extracted).")
+    ap.add_argument("--pdf", default=str(ROOT / "data" / "raw" / "OSHA2001.pdf"))
+    ap.add_argument("--repeat", type=int, default=3, help="runs per backend (best time is reported)")
+    ap.add_argument("--out_csv", default=None, help="optional CSV with the results")
+    args = ap.parse_args()
+
+    pdf = pathlib.Path(args.pdf)
+    if not pdf.exists():
+        raise SystemExit(f"PDF not found: {pdf}")
+
+    rows = []
+    for name in available_backends():
+        best = float("inf")
+        pages = []
+        try:
+            for _ in range(max(1, args.repeat)):
+                t0 = time.perf_counter()
+                pages = extract_pages(pdf, name)
+                best = min(best, time.perf_counter() - t0)
+        except Exception as e:
+            print(f"[WARN] {name}: {e}")
+            continue
+        q = text_quality(pages)
+        rows.append({
+            "backend": name,
+            "pages": len(pages),
+            "seconds": round(best, 3),
+            "pages_per_s": round(len(pages) / best, 1) if best > 0 else 0.0,
+            "chars": int(q["chars"]),
+            "chars_per_page": round(q["chars_per_page"], 1),
+            "readable_ratio": round(q["readable_ratio"], 3),
+            "quality_ok": passes_quality(pages),
+        })
+
+    if not rows:
+        raise SystemExit("No PDF backend available (install pymupdf, pdfminer.six or pypdf).")
+
+    print(f"=== {pdf.name} ===")
+    print(f"{'backend':<10} {'pages':>6} {'sec':>8} {'pages/s':>9} {'chars':>9} {'chars/pg':>9} {'readable':>9} {'ok':>4}")
+    for r in rows:
+        print(f"{r['backend']:<10} {r['pages']:>6} {r['seconds']:>8.3f} {r['pages_per_s']:>9.1f} {r['chars']:>9} "
+              f"{r['chars_per_page']:>9.1f} {r['readable_ratio']:>9.3f} {'yes' if r['quality_ok'] else 'no':>4}")
+
+    t0 = time.perf_counter()
+    _, used = extract_pdf_text(pdf, backend="auto")
+    print(f"\nauto → {used or 'none (OCR needed)'} ({time.perf_counter() - t0:.3f}s)")
+
+    if args.out_csv:
+        out = pathlib.Path(args.out_csv)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        with out.open("w", encoding="utf-8", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            w.writeheader()
+            w.writerows(rows)
+        print(f"✅ Saved: {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+# Running:
+# python -m scripts.bench_prompt_cache --questions evaluation/datasets/ad_hoc_questions.jsonl,evaluation/datasets/osha_gold.jsonl
+"""
+Prefill / cold-start benchmark of the prompt layout against the Ollama stub (scripts/ollama_stub.py).
+
+Three configurations run the same workload on a fresh stub each:
+  legacy              the prompts as they were before the prefix-stable layout (question before
+                      the passages, style-dependent wording), no keep_alive, no preload
+  prefix-stable       app.llm.generate layout (constant prefix, variable tail), no keep_alive, no preload
+  prefix+keep_alive   the same layout with keep_alive + preload, as served
+All of them select and pack the passages with app.llm.context_packer, so the difference
+between the first two is the layout alone and between the last two the keep_alive/preload.
+
+Workload: every question is asked once over its BM25 top-k passages, in the --style style
+("alternate" switches style from one question to the next). A final "sparse" phase asks
+further questions, waiting longer than the server's default keep_alive between them.
+Reported per configuration: prompt tokens actually prefilled, prefill ms, load ms and
+client wall ms.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import pathlib
+import sys
+import time
+from typing import Callable, Dict, List
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+from app.llm import generate as gen
+from app.llm.ollama_client import OllamaClient
+from retrieval.bm25_client import BM25Client
+from scripts.ollama_stub import StubConfig, serve
+
+def legacy_prompt(query: str, contexts: List[Dict], style: str) -> str:
+    """_build_prompt_strict / _build_prompt_structured as they were before SYSTEM_PREFIX (same packing)."""
+    lines = []
+    if style == "structured":
+        lines.append("You are an OSHA legal assistant. Answer IN ENGLISH using ONLY the given passages.")
+        lines.append("Structure the answer as: Summary (2-3 lines), Key Points (bullets), Sources.")
+        lines.append("Cite each claim with [n], refer to the passages below. If missing, say it.")
+        lines.append("")
+        lines.append(f"Question: {query}")
+        lines.append("")
+        lines.append("Passages:")
+        lines.extend(gen._passage_lines(contexts))
+        lines.append("")
+        lines.append("Write the answer now, structured, concise, with citations [n].")
+    else:
+        lines.append("You are a careful assistant. Answer IN ENGLISH using ONLY the given passages.")
+        lines.append('If the answer is not fully supported, say: "Not found in the indexed sources."')
+        lines.append("Cite sources with [n] mapping to the passages list.")
+        lines.append("")
+        lines.append(f"User question: {query}")
+        lines.append("")
+        lines.append("Context passages:")
+        lines.extend(gen._passage_lines(contexts))
+        lines.append("")
+        lines.append("Now write a concise, accurate answer in English with citations [n].")
+    return "\n".join(lines)
+
+def run_config(
+    name: str,
+    port: int,
+    cfg: StubConfig,
+    workload: List[Dict],
+    build: Callable[[str, List[Dict], str], str],
+    keep_alive,
+    preload: bool,
+    sparse: int,
+    gap_s: float,
+) -> Dict:
+    server = serve(port=port, cfg=cfg, background=True)
+    client = OllamaClient(base_url=f"http://127.0.0.1:{port}")
+    model = os.getenv("OLLAMA_MODEL", "llama3.1")
+    rows: List[Dict] = []
+
+    def ask(item: Dict, phase: str) -> None:
+        payload = {"model": model, "prompt": build(item["query"], item["contexts"], item["style"]),
+                   "options": {"num_predict": cfg.num_predict}}
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        t0 = time.perf_counter()
+        r = client.generate(payload)
+        rows.append({
+            "phase": phase,
+            "wall_ms": (time.perf_counter() - t0) * 1000,
+            "load_ms": r.get("load_duration", 0) / 1e6,
+            "prefill_tokens": r.get("prompt_eval_count", 0),
+            "prefill_ms": r.get("prompt_eval_duration", 0) / 1e6,
+            "prompt_tokens": len(payload["prompt"].split()),
+        })
+
+    try:
+        if preload:
+            # what start_preload() does at service start, before any user request
+            client.generate({"model": model, "prompt": gen.SYSTEM_PREFIX, "keep_alive": keep_alive,
+                             "options": {"num_predict": 1}})
+        for item in workload[:len(workload) - sparse]:
+            ask(item, "dense")
+        for item in workload[len(workload) - sparse:]:
+            time.sleep(gap_s)
+            ask(item, "sparse")
+    finally:
+        server.shutdown()
+        client.close()
+
+    def agg(phase: str) -> Dict:
+        rs = [r for r in rows if r["phase"] == phase]
+        if not rs:
+            return {}
+        return {
+            "requests": len(rs),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in rs),
+            "prefill_tokens": sum(r["prefill_tokens"] for r in rs),
+            "prefill_ms": round(sum(r["prefill_ms"] for r in rs), 1),
+            "load_ms": round(sum(r["load_ms"] for r in rs), 1),
+            "mean_wall_ms": round(sum(r["wall_ms"] for r in rs) / len(rs), 1),
+        }
+    return {"config": name, "dense": agg("dense"), "sparse": agg("sparse")}
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark prompt prefix reuse and keep-alive against the Ollama stub.")
+    ap.add_argument("--questions", default="evaluation/datasets/ad_hoc_questions.jsonl,evaluation/datasets/osha_gold.jsonl",
+                    help="comma-separated JSONL files with a query/question field")
+    ap.add_argument("--kb_bm25", default=str(ROOT / "data" / "kb" / "bm25.jsonl"))
+    ap.add_argument("--topk", type=int, default=6)
+    ap.add_argument("--limit", type=int, default=None, help="number of questions (default: all)")
+    ap.add_argument("--style", choices=["strict", "structured", "alternate"], default="strict")
+    ap.add_argument("--port", type=int, default=11491)
+    ap.add_argument("--load_ms", type=float, default=1500.0)
+    ap.add_argument("--prefill_ms_per_token", type=float, default=0.4)
+    ap.add_argument("--decode_ms_per_token", type=float, default=2.0)
+    ap.add_argument("--num_predict", type=int, default=20)
+    ap.add_argument("--server_keep_alive_s", type=float, default=1.0, help="stub default keep_alive (real Ollama: 5m)")
+    ap.add_argument("--sparse", type=int, default=3, help="of the questions, how many form the sparse phase")
+    ap.add_argument("--gap_s", type=float, default=1.5, help="pause between sparse requests")
+    ap.add_argument("--out_json", default=None)
+    args = ap.parse_args()
+
+    qs = []
+    for path in filter(None, (x.strip() for x in args.questions.split(","))):
+        for line in pathlib.Path(path).read_text(encoding="utf-8").splitlines():
+            if line.strip():
+                obj = json.loads(line)
+                q = obj.get("query") or obj.get("question")
+                if q and q not in qs:
+                    qs.append(q)
+    qs = qs[:args.limit] if args.limit else qs
+    styles = ["strict", "structured"] if args.style == "alternate" else [args.style]
+    bm25 = BM25Client(args.kb_bm25)
+    workload = [{"query": q, "contexts": bm25.search(q, k=args.topk), "style": styles[i % len(styles)]}
+                for i, q in enumerate(qs)]
+    sparse = min(args.sparse, max(0, len(workload) - 1))
+
+    cfg = StubConfig(load_ms=args.load_ms, prefill_ms_per_token=args.prefill_ms_per_token,
+                     decode_ms_per_token=args.decode_ms_per_token, num_predict=args.num_predict,
+                     default_keep_alive_s=args.server_keep_alive_s)
+    results = [
+        run_config("legacy", args.port, cfg, workload, legacy_prompt,
+                   keep_alive=None, preload=False, sparse=sparse, gap_s=args.gap_s),
+        run_config("prefix-stable", args.port + 1, cfg, workload, gen._build_prompt_layout,
+                   keep_alive=None, preload=False, sparse=sparse, gap_s=args.gap_s),
+        run_config("prefix+keep_alive", args.port + 2, cfg, workload, gen._build_prompt_layout,
+                   keep_alive=gen._keep_alive(), preload=True, sparse=sparse, gap_s=args.gap_s),
+    ]
+
+    for res in results:
+        for phase in ("dense", "sparse"):
+            a = res[phase]
+            if a:
+                print(f"{res['config']:>17} {phase:>6}: {a['requests']} req, prefilled {a['prefill_tokens']}/"
+                      f"{a['prompt_tokens']} prompt tokens, prefill {a['prefill_ms']} ms, load {a['load_ms']} ms, "
+                      f"mean wall {a['mean_wall_ms']} ms")
+    if args.out_json:
+        pathlib.Path(args.out_json).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(args.out_json).write_text(json.dumps(results, indent=2), encoding="utf-8")
+        print(f"✅ Saved: {args.out_json}")
+
+if __name__ == "__main__":
+    main()
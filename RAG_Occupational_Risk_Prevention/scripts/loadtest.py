@@ -0,0 +1,272 @@
+# Running:
+# python -m scripts.loadtest --spawn --mode closed --concurrency 8 --duration_s 30
+# python -m scripts.loadtest --url http://localhost:8000 --mode open --rps 5 --duration_s 60 --from_db
+"""
+Load generator for the RAG API (POST /query).
+
+Modes:
+  closed  --concurrency workers, each sends its next request when the previous one returns
+  open    Poisson arrivals at --rps regardless of response times (at most --max_inflight open)
+
+Queries are replayed round-robin from --questions (JSONL/TXT; globs allowed) or, with
+--from_db, from the telemetry DB. With --spawn the harness starts the Ollama stub
+(scripts/ollama_stub.py, --prefill_ms_per_token / --decode_ms_per_token / --num_predict)
+and the API (uvicorn subprocess pointed at the stub), so runs are comparable without a GPU.
+
+Reported per stage (client total, retrieval, queue wait, llm, prefill, decode): p50/p95/p99,
+plus throughput and status/degradation counts. --out_json writes the summary, --out_csv one
+row per request.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import csv
+import glob
+import json
+import os
+import pathlib
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+
+STAGES = ["total_ms", "retrieval_ms", "queue_wait_ms", "llm_ms", "prefill_ms", "decode_ms"]
+CSV_HEADERS = ["t_start", "query", "status", *STAGES, "completion_tokens", "degradations", "error"]
+
+# ---------- Workload ----------
+
+def load_queries(patterns: List[str], from_db: bool, db_path: str, limit: Optional[int]) -> List[str]:
+    qs: List[str] = []
+    if from_db:
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("SELECT query FROM interactions WHERE query IS NOT NULL ORDER BY id DESC").fetchall()
+        qs = [r[0] for r in rows if r[0] and r[0].strip()]
+    else:
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)):
+                p = pathlib.Path(path)
+                for line in p.read_text(encoding="utf-8").splitlines():
+                    if not line.strip():
+                        continue
+                    if p.suffix.lower() == ".jsonl":
+                        obj = json.loads(line)
+                        q = obj.get("query") or obj.get("question")
+                    else:
+                        q = line.strip()
+                    if q:
+                        qs.append(str(q))
+    if not qs:
+        raise SystemExit("No queries found (check --questions or --from_db).")
+    return qs[:limit] if limit else qs
+
+def percentiles(values: List[float]) -> Dict:
+    vs = sorted(v for v in values if v is not None)
+    if not vs:
+        return {"n": 0}
+    def q(p: float) -> float:
+        return round(vs[min(len(vs) - 1, int(p * len(vs)))], 1)
+    return {"n": len(vs), "p50": q(0.50), "p95": q(0.95), "p99": q(0.99), "max": round(vs[-1], 1)}
+
+# ---------- Load generation ----------
+
+async def one_request(client: httpx.AsyncClient, url: str, query: str, body_extra: Dict, t_origin: float) -> Dict:
+    rec: Dict = {"t_start": round(time.perf_counter() - t_origin, 3), "query": query}
+    t0 = time.perf_counter()
+    try:
+        r = await client.post(f"{url}/query", json={"query": query, **body_extra})
+        rec["status"] = r.status_code
+        if r.status_code == 200:
+            j = r.json()
+            for k in STAGES[1:] + ["completion_tokens"]:
+                rec[k] = j.get(k)
+            rec["degradations"] = "|".join(j.get("degradations") or [])
+        else:
+            rec["error"] = r.text[:200]
+    except Exception as e:
+        rec["status"] = 0
+        rec["error"] = f"{type(e).__name__}: {e}"[:200]
+    rec["total_ms"] = (time.perf_counter() - t0) * 1000
+    return rec
+
+async def run_closed(url: str, queries: List[str], concurrency: int, duration_s: float, body_extra: Dict,
+                     timeout_s: float) -> List[Dict]:
+    results: List[Dict] = []
+    t_origin = time.perf_counter()
+    t_end = t_origin + duration_s
+    counter = iter(range(10 ** 9))
+    async with httpx.AsyncClient(timeout=timeout_s, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker() -> None:
+            while time.perf_counter() < t_end:
+                q = queries[next(counter) % len(queries)]
+                results.append(await one_request(client, url, q, body_extra, t_origin))
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return results
+
+async def run_open(url: str, queries: List[str], rps: float, duration_s: float, max_inflight: int,
+                   body_extra: Dict, timeout_s: float, seed: int) -> List[Dict]:
+    results: List[Dict] = []
+    rng = random.Random(seed)
+    t_origin = time.perf_counter()
+    t_end = t_origin + duration_s
+    inflight = asyncio.Semaphore(max_inflight)
+    tasks = []
+    dropped = 0
+    async with httpx.AsyncClient(timeout=timeout_s, limits=httpx.Limits(max_connections=max_inflight)) as client:
+        async def fire(q: str) -> None:
+            try:
+                results.append(await one_request(client, url, q, body_extra, t_origin))
+            finally:
+                inflight.release()
+
+        i = 0
+        next_t = t_origin
+        while next_t < t_end:
+            await asyncio.sleep(max(0.0, next_t - time.perf_counter()))
+            if inflight.locked():
+                dropped += 1  # the client-side cap is reached: count it instead of queueing (keeps the schedule open-loop)
+                results.append({"t_start": round(next_t - t_origin, 3), "query": queries[i % len(queries)],
+                                "status": -1, "error": "client max_inflight reached"})
+            else:
+                await inflight.acquire()
+                tasks.append(asyncio.create_task(fire(queries[i % len(queries)])))
+            i += 1
+            next_t += rng.expovariate(rps)
+        await asyncio.gather(*tasks)
+    if dropped:
+        print(f"[WARN] {dropped} arrivals dropped at --max_inflight {max_inflight}")
+    return results
+
+def summarize(results: List[Dict], wall_s: float, args) -> Dict:
+    ok = [r for r in results if r.get("status") == 200]
+    statuses: Dict[str, int] = {}
+    degradations: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r.get("status"))] = statuses.get(str(r.get("status")), 0) + 1
+        for d in filter(None, (r.get("degradations") or "").split("|")):
+            degradations[d] = degradations.get(d, 0) + 1
+    return {
+        "mode": args.mode,
+        "concurrency": args.concurrency if args.mode == "closed" else None,
+        "target_rps": args.rps if args.mode == "open" else None,
+        "duration_s": round(wall_s, 2),
+        "requests": len(results),
+        "ok": len(ok),
+        "throughput_rps": round(len(ok) / wall_s, 2) if wall_s else 0.0,
+        "statuses": statuses,
+        "degradations": degradations,
+        "latency_ms": {stage: percentiles([r.get(stage) for r in ok]) for stage in STAGES},
+    }
+
+# ---------- Spawned stub + API ----------
+
+def wait_http(url: str, timeout_s: float = 60.0) -> None:
+    t_end = time.time() + timeout_s
+    while time.time() < t_end:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise SystemExit(f"Timed out waiting for {url}")
+
+def spawn(args) -> List[subprocess.Popen]:
+    stub_cmd = [sys.executable, "-m", "scripts.ollama_stub", "--port", str(args.stub_port),
+                "--load_ms", str(args.load_ms), "--prefill_ms_per_token", str(args.prefill_ms_per_token),
+                "--decode_ms_per_token", str(args.decode_ms_per_token), "--num_predict", str(args.num_predict)]
+    api_env = {**os.environ, "OLLAMA_HOST": f"http://127.0.0.1:{args.stub_port}", "ANSWER_CACHE": os.getenv("ANSWER_CACHE", "0")}
+    api_cmd = [sys.executable, "-m", "uvicorn", "app.api.main:app", "--port", str(args.api_port), "--log-level", "warning"]
+    procs = [subprocess.Popen(stub_cmd, cwd=ROOT)]
+    wait_http(f"http://127.0.0.1:{args.stub_port}/api/tags")
+    procs.append(subprocess.Popen(api_cmd, cwd=ROOT, env=api_env))
+    wait_http(f"http://127.0.0.1:{args.api_port}/health")
+    return procs
+
+# ---------- CLI ----------
+
+def main():
+    ap = argparse.ArgumentParser(description="Load-test the RAG API (closed or open loop) and report per-stage latency.")
+    ap.add_argument("--url", default="http://127.0.0.1:8000", help="API base URL (ignored with --spawn)")
+    ap.add_argument("--mode", choices=["closed", "open"], default="closed")
+    ap.add_argument("--concurrency", type=int, default=8, help="closed loop: concurrent clients")
+    ap.add_argument("--rps", type=float, default=5.0, help="open loop: mean arrival rate")
+    ap.add_argument("--max_inflight", type=int, default=256, help="open loop: client-side cap on open requests")
+    ap.add_argument("--duration_s", type=float, default=30.0)
+    ap.add_argument("--warmup_s", type=float, default=0.0, help="discard requests started in the first seconds")
+    ap.add_argument("--questions", nargs="+", default=["evaluation/datasets/*.jsonl"])
+    ap.add_argument("--from_db", action="store_true", help="replay queries from the telemetry DB instead")
+    ap.add_argument("--db", default=str(ROOT / "data" / "monitoring" / "telemetry.db"))
+    ap.add_argument("--limit", type=int, default=None, help="use only the first N queries")
+    ap.add_argument("--top_k", type=int, default=5)
+    ap.add_argument("--deadline_ms", type=int, default=None)
+    ap.add_argument("--timeout_s", type=float, default=180.0)
+    ap.add_argument("--seed", type=int, default=0)
+    # spawned stub + API
+    ap.add_argument("--spawn", action="store_true", help="start the Ollama stub and the API locally")
+    ap.add_argument("--api_port", type=int, default=8765)
+    ap.add_argument("--stub_port", type=int, default=11436)
+    ap.add_argument("--load_ms", type=float, default=0.0)
+    ap.add_argument("--prefill_ms_per_token", type=float, default=0.4)
+    ap.add_argument("--decode_ms_per_token", type=float, default=15.0)
+    ap.add_argument("--num_predict", type=int, default=40)
+    ap.add_argument("--out_json", default=None)
+    ap.add_argument("--out_csv", default=None)
+    args = ap.parse_args()
+
+    queries = load_queries(args.questions, args.from_db, args.db, args.limit)
+    random.Random(args.seed).shuffle(queries)
+    body_extra: Dict = {"top_k": args.top_k}
+    if args.deadline_ms is not None:
+        body_extra["deadline_ms"] = args.deadline_ms
+
+    procs: List[subprocess.Popen] = []
+    url = args.url.rstrip("/")
+    if args.spawn:
+        procs = spawn(args)
+        url = f"http://127.0.0.1:{args.api_port}"
+    print(f"[INFO] {args.mode} loop against {url} for {args.duration_s:.0f}s ({len(queries)} distinct queries)")
+
+    try:
+        t0 = time.perf_counter()
+        if args.mode == "closed":
+            results = asyncio.run(run_closed(url, queries, args.concurrency, args.duration_s, body_extra, args.timeout_s))
+        else:
+            results = asyncio.run(run_open(url, queries, args.rps, args.duration_s, args.max_inflight,
+                                           body_extra, args.timeout_s, args.seed))
+        wall_s = time.perf_counter() - t0
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+            p.wait(timeout=10)
+
+    measured = [r for r in results if r["t_start"] >= args.warmup_s]
+    summary = summarize(measured, wall_s - args.warmup_s, args)
+
+    print(f"\n{summary['ok']}/{summary['requests']} ok, {summary['throughput_rps']} req/s, statuses {summary['statuses']}")
+    if summary["degradations"]:
+        print(f"degradations: {summary['degradations']}")
+    for stage, p in summary["latency_ms"].items():
+        if p.get("n"):
+            print(f"  {stage:>14}: p50 {p['p50']:>8} | p95 {p['p95']:>8} | p99 {p['p99']:>8} ms")
+
+    if args.out_json:
+        pathlib.Path(args.out_json).parent.mkdir(parents=True, exist_ok=True)
+        pathlib.Path(args.out_json).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        print(f"✅ Saved: {args.out_json}")
+    if args.out_csv:
+        pathlib.Path(args.out_csv).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out_csv, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(measured)
+        print(f"✅ Saved: {args.out_csv}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+# Running:
+# python -m scripts.ollama_stub --port 11435
+# OLLAMA_HOST=http://127.0.0.1:11435 streamlit run app/ui_streamlit/Home.py
+# python -m scripts.ollama_stub --port 11435 --load_ms 0 --fail_rate 0.1 --hang_rate 0.05 --seed 7
+"""
+Ollama-compatible stub server (stdlib only) that emulates the latency structure of a real
+server, to measure client-side changes without a GPU:
+
+- cold start: the first request for a model (or one after its keep_alive expired) pays --load_ms
+- prefill:    --prefill_ms_per_token for every prompt token NOT covered by a cached prefix;
+              each model keeps --slots recent prompts (like OLLAMA_NUM_PARALLEL slots) and a
+              request reuses the longest common token prefix with any of them
+- decode:     --decode_ms_per_token for each generated token (--num_predict per answer)
+- embeddings: --embed_ms_per_token for every input token
+
+Outputs are deterministic: the answer words are drawn from the prompt with a generator seeded
+by (--seed, options.seed, model, prompt), and embeddings are hashed bag-of-words vectors
+(--embed_dim, L2-normalized), so texts sharing words have a positive cosine similarity.
+
+Failures can be injected (on the generate/chat/embeddings endpoints, seeded by --seed):
+  --fail_rate / --fail_every N   answer --fail_status (default 500) with an Ollama-style error
+  --hang_rate                    stall --hang_ms before answering (client timeouts)
+  --drop_rate                    close the connection halfway through the response
+They can be changed while running: GET/POST /stub/config (JSON with StubConfig fields).
+
+Tokens are whitespace-separated words. Responses carry Ollama's timing fields
+(load_duration, prompt_eval_count, prompt_eval_duration, eval_count, eval_duration,
+total_duration, all durations in ns) and honor `stream` and `keep_alive`.
+Endpoints: POST /api/generate, /api/chat, /api/embeddings, /api/embed; GET /api/tags, /api/ps.
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field, fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+@dataclass
+class StubConfig:
+    load_ms: float = 1500.0
+    prefill_ms_per_token: float = 0.4
+    decode_ms_per_token: float = 15.0
+    num_predict: int = 40
+    slots: int = 4
+    default_keep_alive_s: float = 300.0
+    embed_ms_per_token: float = 0.05
+    embed_dim: int = 768
+    seed: int = 0
+    # failure injection
+    fail_rate: float = 0.0
+    fail_every: int = 0
+    fail_status: int = 500
+    hang_rate: float = 0.0
+    hang_ms: float = 30000.0
+    drop_rate: float = 0.0
+
+@dataclass
+class _ModelState:
+    expires_at: float = 0.0          # loaded while now < expires_at (inf = forever / in use)
+    active: int = 0
+    slots: List[List[str]] = field(default_factory=list)
+
+def parse_keep_alive(v, default_s: float) -> float:
+    """Ollama keep_alive: seconds (int/float), duration strings ('30s', '5m', '1h'), negative = forever."""
+    if v is None or v == "":
+        return default_s
+    if isinstance(v, (int, float)):
+        return float("inf") if v < 0 else float(v)
+    m = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", str(v))
+    if not m:
+        return default_s
+    n = float(m.group(1))
+    if n < 0:
+        return float("inf")
+    return n * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[m.group(2)]
+
+def _common_prefix(a: List[str], b: List[str]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def _digest(*parts) -> int:
+    return int.from_bytes(hashlib.blake2b("\x1f".join(map(str, parts)).encode("utf-8"), digest_size=8).digest(), "big")
+
+def fake_answer(model: str, prompt_tokens: List[str], n: int, seed: int = 0) -> List[str]:
+    """Deterministic pseudo-answer: n words drawn from the prompt (same inputs, same words)."""
+    rng = random.Random(_digest(seed, model, " ".join(prompt_tokens)))
+    vocab = [t for t in prompt_tokens if t.isalnum()] or prompt_tokens or ["ok"]
+    return [rng.choice(vocab) for _ in range(n)]
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Hashed bag of words (signed feature hashing), L2-normalized."""
+    vec = [0.0] * dim
+    for tok in re.findall(r"\w+", text.lower()):
+        h = _digest(tok)
+        vec[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = math.sqrt(sum(v * v for v in vec))
+    return [round(v / norm, 6) for v in vec] if norm else vec
+
+
+class StubState:
+    def __init__(self, cfg: StubConfig) -> None:
+        self.cfg = cfg
+        self.models: Dict[str, _ModelState] = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.faults: Dict[str, int] = {"fail": 0, "hang": 0, "drop": 0}
+        self._rng = random.Random(cfg.seed)
+
+    def fault(self) -> Optional[str]:
+        """Draws the injected failure for one request: None, 'fail', 'hang' or 'drop'."""
+        cfg = self.cfg
+        with self.lock:
+            self.requests += 1
+            r = self._rng.random()
+            if (cfg.fail_every and self.requests % cfg.fail_every == 0) or r < cfg.fail_rate:
+                kind = "fail"
+            elif r < cfg.fail_rate + cfg.hang_rate:
+                kind = "hang"
+            elif r < cfg.fail_rate + cfg.hang_rate + cfg.drop_rate:
+                kind = "drop"
+            else:
+                return None
+            self.faults[kind] += 1
+            return kind
+
+    def configure(self, updates: Dict) -> Dict:
+        known = {f.name for f in fields(StubConfig)}
+        with self.lock:
+            for k, v in updates.items():
+                if k not in known:
+                    raise ValueError(f"unknown config field {k!r}")
+                setattr(self.cfg, k, type(getattr(self.cfg, k))(v))
+            if "seed" in updates:
+                self._rng = random.Random(self.cfg.seed)
+            return asdict(self.cfg)
+
+    def admit(self, model: str, prompt_tokens: List[str]) -> Tuple[float, int]:
+        """Returns (load_ms, tokens_to_prefill) and updates the model's slots; call release() when done."""
+        now = time.monotonic()
+        with self.lock:
+            st = self.models.setdefault(model, _ModelState())
+            load_ms = 0.0
+            if st.active == 0 and now >= st.expires_at:
+                load_ms = self.cfg.load_ms
+                st.slots = []  # KV cache is gone with the weights
+            reuse = max((_common_prefix(s, prompt_tokens) for s in st.slots), default=0)
+            if prompt_tokens:
+                st.slots = [s for s in st.slots if s != prompt_tokens] + [prompt_tokens]
+                del st.slots[:-max(1, self.cfg.slots)]  # least recently used slots are overwritten
+            st.active += 1
+        return load_ms, len(prompt_tokens) - reuse
+
+    def release(self, model: str, keep_alive) -> None:
+        """Like Ollama, the keep_alive countdown starts when the last request on the model ends."""
+        ka = parse_keep_alive(keep_alive, self.cfg.default_keep_alive_s)
+        with self.lock:
+            st = self.models[model]
+            st.active -= 1
+            if st.active == 0:
+                st.expires_at = time.monotonic() + ka  # keep_alive 0 unloads right away
+
+    def loaded(self) -> List[str]:
+        now = time.monotonic()
+        with self.lock:
+            return [m for m, st in self.models.items() if st.active or now < st.expires_at]
+
+
+def make_handler(state: StubState):
+    cfg = state.cfg
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _json(self, obj: Dict, status: int = 200) -> None:
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _chunk(self, obj: Dict) -> None:
+            data = (json.dumps(obj) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def _read_json(self) -> Dict:
+            return json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                self._json({"models": [{"name": m} for m in sorted(state.models)] or [{"name": "llama3.1"}]})
+            elif self.path == "/api/ps":
+                self._json({"models": [{"name": m} for m in state.loaded()]})
+            elif self.path == "/stub/config":
+                self._json({**asdict(cfg), "requests": state.requests, "faults": dict(state.faults)})
+            else:
+                self._json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            req = self._read_json()
+            if self.path == "/stub/config":
+                try:
+                    self._json(state.configure(req))
+                except (ValueError, TypeError) as e:
+                    self._json({"error": str(e)}, 400)
+                return
+            if self.path not in {"/api/generate", "/api/chat", "/api/embeddings", "/api/embed"}:
+                self._json({"error": "not found"}, 404)
+                return
+
+            fault = state.fault()
+            if fault == "fail":
+                self._json({"error": "injected failure"}, cfg.fail_status)
+                return
+            if fault == "hang":
+                time.sleep(cfg.hang_ms / 1000)
+
+            model = req.get("model") or "llama3.1"
+            if self.path == "/api/chat":
+                prompt = "\n".join(str(m.get("content") or "") for m in req.get("messages") or [])
+            elif self.path == "/api/embed":
+                inputs = req.get("input") or []
+                prompt = "\n".join([inputs] if isinstance(inputs, str) else inputs)
+            else:
+                prompt = req.get("prompt") or ""
+            prompt_tokens = prompt.split()
+            t0 = time.perf_counter()
+            load_ms, to_prefill = state.admit(model, prompt_tokens)
+            try:
+                if self.path in {"/api/embeddings", "/api/embed"}:
+                    self._embed(req, model, prompt_tokens, t0, load_ms, drop=fault == "drop")
+                else:
+                    self._generate(req, model, prompt_tokens, t0, load_ms, to_prefill,
+                                   chat=self.path == "/api/chat", drop=fault == "drop")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client went away mid-stream (cancelled / hedged request): Ollama aborts too
+            finally:
+                state.release(model, req.get("keep_alive"))
+
+        def _drop(self) -> None:
+            self.close_connection = True  # injected: hang up without completing the response
+
+        def _embed(self, req: Dict, model: str, prompt_tokens: List[str], t0: float, load_ms: float,
+                   drop: bool) -> None:
+            time.sleep((load_ms + len(prompt_tokens) * cfg.embed_ms_per_token) / 1000)
+            if drop:
+                return self._drop()
+            timing = {"model": model, "load_duration": int(load_ms * 1e6),
+                      "total_duration": int((time.perf_counter() - t0) * 1e9)}
+            if self.path == "/api/embed":
+                inputs = req.get("input") or []
+                texts = [inputs] if isinstance(inputs, str) else list(inputs)
+                self._json({**timing, "embeddings": [fake_embedding(t, cfg.embed_dim) for t in texts],
+                            "prompt_eval_count": len(prompt_tokens)})
+            else:
+                self._json({**timing, "embedding": fake_embedding(req.get("prompt") or "", cfg.embed_dim)})
+
+        def _generate(self, req: Dict, model: str, prompt_tokens: List[str], t0: float,
+                      load_ms: float, to_prefill: int, chat: bool = False, drop: bool = False) -> None:
+            time.sleep((load_ms + to_prefill * cfg.prefill_ms_per_token) / 1000)
+            t_prefill = time.perf_counter()
+
+            def piece(text: str) -> Dict:
+                return {"message": {"role": "assistant", "content": text}} if chat else {"response": text}
+
+            if not prompt_tokens:
+                # load-only request (how clients preload a model)
+                self._json({"model": model, **piece(""), "done": True, "done_reason": "load",
+                            "load_duration": int(load_ms * 1e6), "total_duration": int((t_prefill - t0) * 1e9)})
+                return
+
+            options = req.get("options") or {}
+            n_predict = int(options.get("num_predict") or cfg.num_predict)
+            words = fake_answer(model, prompt_tokens, n_predict, seed=_digest(cfg.seed, options.get("seed", 0)))
+
+            def final(t_end: float) -> Dict:
+                return {
+                    "model": model, **piece(""), "done": True, "done_reason": "stop",
+                    "load_duration": int(load_ms * 1e6),
+                    "prompt_eval_count": to_prefill,
+                    "prompt_eval_duration": int((t_prefill - t0) * 1e9 - load_ms * 1e6),
+                    "eval_count": n_predict,
+                    "eval_duration": int((t_end - t_prefill) * 1e9),
+                    "total_duration": int((t_end - t0) * 1e9),
+                }
+
+            if req.get("stream", True):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i, w in enumerate(words):
+                    if drop and i == len(words) // 2:
+                        return self._drop()
+                    time.sleep(cfg.decode_ms_per_token / 1000)
+                    self._chunk({"model": model, **piece((" " if i else "") + w), "done": False})
+                self._chunk(final(time.perf_counter()))
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                time.sleep(n_predict * cfg.decode_ms_per_token / 1000)
+                if drop:
+                    return self._drop()
+                self._json({**final(time.perf_counter()), **piece(" ".join(words))})
+
+    return Handler
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return  # clients closing pooled keep-alive connections
+        super().handle_error(request, client_address)
+
+def serve(host: str = "127.0.0.1", port: int = 11435, cfg: Optional[StubConfig] = None,
+          background: bool = False) -> ThreadingHTTPServer:
+    state = StubState(cfg or StubConfig())
+    server = _Server((host, port), make_handler(state))
+    server.state = state
+    if background:
+        threading.Thread(target=server.serve_forever, name="ollama-stub", daemon=True).start()
+    else:
+        print(f"[INFO] Ollama stub on http://{host}:{port}")
+        server.serve_forever()
+    return server
+
+# ---------- CLI ----------
+
+def main():
+    ap = argparse.ArgumentParser(description="Ollama-compatible stub with latency emulation, deterministic outputs and failure injection.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11435)
+    ap.add_argument("--load_ms", type=float, default=1500.0)
+    ap.add_argument("--prefill_ms_per_token", type=float, default=0.4)
+    ap.add_argument("--decode_ms_per_token", type=float, default=15.0)
+    ap.add_argument("--num_predict", type=int, default=40)
+    ap.add_argument("--slots", type=int, default=4)
+    ap.add_argument("--keep_alive_s", type=float, default=300.0, help="default keep_alive when a request sets none")
+    ap.add_argument("--embed_ms_per_token", type=float, default=0.05)
+    ap.add_argument("--embed_dim", type=int, default=768)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--fail_rate", type=float, default=0.0, help="share of requests answered with --fail_status")
+    ap.add_argument("--fail_every", type=int, default=0, help="also fail every N-th request (0 = off)")
+    ap.add_argument("--fail_status", type=int, default=500)
+    ap.add_argument("--hang_rate", type=float, default=0.0, help="share of requests stalled for --hang_ms")
+    ap.add_argument("--hang_ms", type=float, default=30000.0)
+    ap.add_argument("--drop_rate", type=float, default=0.0, help="share of requests whose connection is cut halfway")
+    args = ap.parse_args()
+    serve(args.host, args.port, StubConfig(
+        load_ms=args.load_ms,
+        prefill_ms_per_token=args.prefill_ms_per_token,
+        decode_ms_per_token=args.decode_ms_per_token,
+        num_predict=args.num_predict,
+        slots=args.slots,
+        default_keep_alive_s=args.keep_alive_s,
+        embed_ms_per_token=args.embed_ms_per_token,
+        embed_dim=args.embed_dim,
+        seed=args.seed,
+        fail_rate=args.fail_rate,
+        fail_every=args.fail_every,
+        fail_status=args.fail_status,
+        hang_rate=args.hang_rate,
+        hang_ms=args.hang_ms,
+        drop_rate=args.drop_rate,
+    ))
+
+if __name__ == "__main__":
+    main()
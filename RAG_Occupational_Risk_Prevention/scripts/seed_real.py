@@ -5,6 +5,7 @@ sys.path.append(str(ROOT))
 
 from retrieval.hybrid import HybridRetriever
 from app.llm.generate import generate_answer
+from app.llm.router import telemetry_labels
 from monitoring.logger import log_interaction
 
 QUESTIONS = [
@@ -33,28 +34,36 @@ def main():
         t1 = time.time()
         retrieval_ms = int((t1 - t0) * 1000)
 
-        ctx = [{"text": h["text"], "source": h["source"]} for h in hits[:6]]
+        ctx = [{"text": h["text"], "source": h["source"], "score": h.get("score")} for h in hits[:6]]
         t2 = time.time()
+        info = {}
         try:
-            ans = generate_answer(q, ctx) if ctx else "Not enough context found."
+            ans = generate_answer(q, ctx, info=info) if ctx else "Not enough context found."
         except Exception as e:
             ans = f"[LLM ERROR] {e}"
         t3 = time.time()
         llm_ms = int((t3 - t2) * 1000)
 
+        provider, model = telemetry_labels(info)
         iid = log_interaction(
             query=q,
             retriever="hybrid",
             topk=6,
             fanout=60,
             latency_ms=retrieval_ms + llm_ms,
-            provider="ollama",
-            model="llama3.1",
+            provider=provider,
+            model=model,
             answer=ans,
             sources=[c["source"] for c in ctx],
+            hits=hits[:6],
             ctx_len=len(ctx),
             latency_ms_retrieval=retrieval_ms,
             latency_ms_llm=llm_ms,
+            tokens_per_s=info.get("tokens_per_s"),
+            prompt_tokens=info.get("prompt_tokens"),
+            completion_tokens=info.get("completion_tokens"),
+            prefill_ms=info.get("prefill_ms"),
+            decode_ms=info.get("decode_ms"),
         )
 
         # feedback aleatorio para alimentar gráficas
@@ -64,7 +73,7 @@ def main():
         if fb != 0:
             update_feedback(iid, fb, "")
 
-        print(f"✓ [{i}/{len(QUESTIONS)}] {q} — id#{iid} — ret:{retrieval_ms}ms llm:{llm_ms}ms fb:{fb}")
+        print(f"✓ [{i}/{len(QUESTIONS)}] {q} — id#{iid.result()} — ret:{retrieval_ms}ms llm:{llm_ms}ms fb:{fb}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file